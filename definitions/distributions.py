@@ -4,9 +4,11 @@
 # TODO: Split this file into several
 
 # owls-hep imports
-from owls_hep.histogramming import Histogram
 from owls_hep.efficiency import Efficiency
 
+# owls-mutau imports
+from owls_mutau.histogramming import Histogram
+
 tau_pt = Histogram(
         'tau_0_pt',
         (20, 0, 200),
@@ -18,12 +18,14 @@ from owls_hep.expression import expression_substitute
 # owls-mutau imports
 import owls_mutau
 from owls_mutau.estimation import OSData, SSData, OSSS
+from owls_mutau.rqcd import load as load_rqcd
+from owls_mutau.histogramming import enable_columnar
 from owls_mutau.uncertainties import \
         TestConfiguration, TestSystFlat, TestSystShape, \
         MuonEffStat, MuonEffSys, \
         MuonEffTrigStat, MuonEffTrigSys, \
         MuonIsoStat, MuonIsoSys, \
-        MuonIdSys, MuonMsSys, MuonScaleSys, \
+        TreeSystematicBase, MuonIdSys, MuonMsSys, MuonScaleSys, \
         TauIdSys, TauRecoSys, TauEleOlrSys, \
         RqcdStat, RqcdSyst, \
         PileupSys, \
@@ -43,6 +45,18 @@ luminosity = float(configuration.get('luminosity', 1000.0)) # 1/fb
 nominal_tree = 'NOMINAL'
 sqrt_s = 13.0 * 1000 * 1000 # MeV
 year = configuration.get('year', '')
+# Fill OS/SS components of all rQCD splits in a single pass
+fused_estimation = configuration.get('fused_estimation', '') == 'True'
+# Fill plain histograms and weight systematics from columns loaded in bulk
+# instead of with TTree.Draw
+enable_columnar(configuration.get('columnar', '') == 'True')
+# Read all MUONS_* trees of an input file while it is open
+TreeSystematicBase.batched = configuration.get('batched_trees', '') == 'True'
+# rQCD file written by compute-rqcd.py, whose values replace the ones of the
+# tables below, and optionally the digest of the inputs the values have to be
+# derived from (as printed by compute-rqcd.py)
+rqcd_file = configuration.get('rqcd_file', '')
+rqcd_inputs = configuration.get('rqcd_inputs', '') or None
 
 if year == '2015':
     trigger = 'HLT_mu20_iloose_L1MU15_OR_HLT_mu40_QualMedium_IsoGradient'
@@ -642,14 +656,18 @@ elif year == '2016':
 else:
     raise RuntimeError('Don\'t know how to handle unknown year "{}.'. \
                        format(year))
+if rqcd_file:
+    # Labels which are not in the file keep the values of the tables above
+    r_qcd = load_rqcd(rqcd_file, year, rqcd_inputs, r_qcd)
 print('Using data {} with year {}'.format(data.label(), year))
 print('...and systematics configuration {}'.format((TestConfiguration())))
 
 
 # Redefitions of estimations
 MonteCarlo = partial(MonteCarlo, luminosity = luminosity)
-OSSS = partial(OSSS, r_qcd = r_qcd, luminosity = luminosity)
-SSData = partial(SSData, r_qcd = r_qcd)
+OSSS = partial(OSSS, r_qcd = r_qcd, luminosity = luminosity,
+               fused = fused_estimation)
+SSData = partial(SSData, r_qcd = r_qcd, fused = fused_estimation)
 
 # Redefitions of uncertainties
 # NOTE: This is a cleaner way to initialize the class with an rQCD value than
@@ -5,6 +5,7 @@
 # System imports
 from functools import partial
 from copy import copy
+from collections import OrderedDict
 
 # owls-hep imports
 from owls_hep.region import Region
@@ -12,6 +13,10 @@ from owls_hep.module import definitions as global_definitions
 from owls_hep.expression import expression_substitute
 from owls_hep.variations import ReplaceWeight
 
+# owls-mutau imports
+import owls_mutau.cuts
+from owls_mutau.regions import RegionFamily
+
 configuration = global_definitions()
 year = configuration.get('year', None)
 tau_pt = configuration.get('tau_pt', None)
@@ -186,6 +191,23 @@ if tau_pt is not None:
 
 expr = partial(expression_substitute, definitions = definitions)
 
+# Atomic cuts, which are evaluated once per event into a bitmask, so that
+# region selections are resolved as bitmask queries
+owls_mutau.cuts.atomic = OrderedDict(
+    (name, expr('[{}]'.format(name)))
+    for name
+    in ('mu_trigger', 'mu_tau', 'tau_pt',
+        'os', 'ss', '1p', '3p', 'tau25',
+        'iso_gradient', 'iso_gradient_loose',
+        'iso_tight', 'iso_medium', 'iso_loose',
+        'bjet', '1bjet', '2bjet', 'bveto',
+        'very_loose_tau', 'loose_tau', 'medium_tau', 'tight_tau',
+        '2jets', 'wcr')
+)
+
+# Region families, by the name of their base region
+families = OrderedDict()
+
 def _vary_me(name, selection, weight, label, patches, metadata, variations):
     if not name in globals():
         globals()[name] = Region(expr(selection),
@@ -193,6 +215,8 @@ def _vary_me(name, selection, weight, label, patches, metadata, variations):
                                  label,
                                  patches,
                                  metadata = metadata)
+    family = families[name] = RegionFamily(name)
+    family.add(name, globals()[name])
     for v in variations:
         m = copy(metadata)
         m['rqcd'] = m['rqcd'] + v[5]
@@ -209,6 +233,7 @@ def _vary_me(name, selection, weight, label, patches, metadata, variations):
                                         l,
                                         patches,
                                         metadata = m)
+        family.add(name + v[0], globals()[name + v[0]])
 
 # mu+tau region and variations for publishing
 _variations = [
@@ -0,0 +1,131 @@
+"""Provides per-event bitmasks of atomic cuts for the mu+tau analysis.
+
+The regions of the analysis are composed from a small vocabulary of atomic
+cuts (OS/SS, 1-prong/3-prong, b-jet requirements, isolation working points,
+...). Instead of evaluating the full selection of every region for every
+event, each atomic cut is evaluated once per event and packed into a 64-bit
+mask, and region selections are resolved into a bitmask query (which cuts
+have to pass or fail) plus whatever residual expression is not covered by the
+atomic cuts.
+
+Region modules configure the atomic cuts by setting atomic to an ordered
+dictionary mapping cut names to expressions.
+"""
+
+# System imports
+from collections import OrderedDict
+
+# numpy imports
+import numpy
+
+# owls-mutau imports
+from owls_mutau.expression import canonical, factored, compiled
+
+# Set up default exports
+__all__ = [
+    'atomic',
+    'CutMask',
+    'query',
+]
+
+
+# The atomic cuts, which are set by the region module
+atomic = OrderedDict()
+
+# The maximum number of atomic cuts that fit into a mask
+MAXIMUM_CUTS = 64
+
+
+class CutMask(object):
+    """A set of atomic cuts, packed into per-event bitmasks.
+
+    Args:
+        cuts: An iterable of (name, expression) tuples, where the i-th cut is
+            stored in the i-th bit of the mask
+
+    Raises:
+        ValueError: If there are too many cuts or a cut can't be vectorized
+    """
+    def __init__(self, cuts):
+        self._cuts = tuple((name, canonical(e)) for name, e in cuts)
+        if len(self._cuts) > MAXIMUM_CUTS:
+            raise ValueError('at most {} atomic cuts are supported'. \
+                             format(MAXIMUM_CUTS))
+        self._kernels = [compiled(e) for _, e in self._cuts]
+
+    def cuts(self):
+        """Returns a tuple of the (name, canonical expression) of each cut.
+        """
+        return self._cuts
+
+    def branches(self):
+        """Returns a sorted tuple of the branches read by the cuts.
+        """
+        return tuple(sorted(set(b
+                                for k
+                                in self._kernels
+                                for b
+                                in k.branches())))
+
+    def evaluate(self, columns, size):
+        """Evaluates all cuts into a bitmask.
+
+        Args:
+            columns: A dictionary mapping (at least) the branches of the cuts
+                to arrays of their values
+            size: The number of events
+
+        Returns:
+            An array of unsigned 64-bit masks, where bit i is set if the
+            event passes the i-th cut.
+        """
+        mask = numpy.zeros(size, dtype = 'uint64')
+        for bit, kernel in enumerate(self._kernels):
+            mask[kernel(columns, size) != 0] |= numpy.uint64(1 << bit)
+        return mask
+
+    def resolve(self, selection):
+        """Resolves a selection into a bitmask query.
+
+        Args:
+            selection: The (weighted) selection
+
+        Returns:
+            A tuple of (required, expected, residual), such that the
+            selection is equal to the residual expression for events whose
+            mask satisfies (mask & required) == expected, and zero for all
+            other events. If the selection can't be parsed, required is 0
+            and the residual is the selection itself.
+        """
+        try:
+            passed, failed, residual = factored(selection,
+                                                [e for _, e in self._cuts])
+        except ValueError:
+            return 0, 0, selection
+
+        # A cut which is both required and vetoed selects nothing
+        if passed & failed:
+            return 0, 0, '0'
+
+        required = 0
+        expected = 0
+        for bit in passed:
+            required |= 1 << bit
+            expected |= 1 << bit
+        for bit in failed:
+            required |= 1 << bit
+        return required, expected, residual
+
+
+def query(mask, required, expected):
+    """Evaluates a bitmask query.
+
+    Args:
+        mask: The array of bitmasks
+        required: The bits which are required to have a certain value
+        expected: The values of these bits
+
+    Returns:
+        A boolean array, which is True for events passing the query.
+    """
+    return (mask & numpy.uint64(required)) == numpy.uint64(expected)
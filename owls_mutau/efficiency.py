@@ -0,0 +1,384 @@
+"""Provides array-based efficiencies for the mu+tau analysis.
+
+The efficiencies of the nominal estimate and of all systematic variations
+share the same bins, so they are kept as (variation x bin) arrays, and
+efficiencies, binomial intervals, normalizations and systematic errors are
+computed for all variations at once. ROOT graphs are only built when needed
+for plotting or writing (see graph).
+
+Errors are represented as (low, high) tuples of arrays.
+"""
+
+# System imports
+from array import array
+
+# numpy imports
+import numpy
+
+# Set up default exports
+__all__ = [
+    'CONFIDENCE',
+    'clopper_pearson',
+    'contents',
+    'sumw2',
+    'normalized',
+    'syst_errors',
+    'combined',
+    'flipped',
+    'relative',
+    'graph',
+    'Efficiencies',
+]
+
+
+# The confidence level of the binomial intervals (one standard deviation)
+CONFIDENCE = 0.682689492137086
+
+
+def clopper_pearson(total, passed, confidence = CONFIDENCE,
+                    variances = None):
+    """Computes Clopper-Pearson intervals of efficiencies.
+
+    Weighted (or background-subtracted) counts are sanitized first: negative
+    totals are set to zero, and passed counts are limited to the range from
+    zero to the total counts. If the variances of the totals are given, the
+    counts are converted to effective numbers of entries (total^2 / variance,
+    with the passed counts scaled alike), so that the intervals reflect the
+    statistical power of the weighted events.
+
+    Args:
+        total: An array of total counts
+        passed: An array of passed counts
+        confidence: The confidence level of the intervals
+        variances: An optional array of the sums of squared weights of the
+            total counts
+
+    Returns:
+        A tuple of (low, high) arrays of the interval bounds. Bins without
+        any total counts have empty intervals at zero.
+    """
+    # scipy is only needed here, so only import it when it's used
+    from scipy.stats import beta
+
+    total = numpy.maximum(numpy.asarray(total, dtype = 'float64'), 0.0)
+    passed = numpy.clip(numpy.asarray(passed, dtype = 'float64'), 0.0, total)
+    if variances is not None:
+        variances = numpy.asarray(variances, dtype = 'float64')
+        usable = (total > 0) & (variances > 0)
+        scale = numpy.where(usable,
+                            total / numpy.where(usable, variances, 1.0),
+                            1.0)
+        total = total * scale
+        passed = passed * scale
+    alpha = (1.0 - confidence) / 2.0
+    failed = total - passed
+    low = numpy.where(passed > 0,
+                      beta.ppf(alpha,
+                               numpy.where(passed > 0, passed, 1.0),
+                               failed + 1.0),
+                      0.0)
+    high = numpy.where(failed > 0,
+                       beta.ppf(1.0 - alpha,
+                                passed + 1.0,
+                                numpy.where(failed > 0, failed, 1.0)),
+                       1.0)
+    return (numpy.where(total > 0, low, 0.0),
+            numpy.where(total > 0, high, 0.0))
+
+
+def contents(histogram):
+    """Extracts the bin contents of a histogram, without under- and overflow.
+
+    Args:
+        histogram: The histogram
+
+    Returns:
+        An array of bin contents.
+    """
+    return numpy.array([histogram.GetBinContent(b)
+                        for b
+                        in range(1, histogram.GetNbinsX() + 1)])
+
+
+def sumw2(histogram):
+    """Extracts the sums of squared weights of the bins of a histogram,
+    without under- and overflow.
+
+    Args:
+        histogram: The histogram
+
+    Returns:
+        An array of the squared bin errors.
+    """
+    return numpy.array([histogram.GetBinError(b) ** 2
+                        for b
+                        in range(1, histogram.GetNbinsX() + 1)])
+
+
+def normalized(nominal, up, down):
+    """Normalizes up and down variations, so that up variations are never
+    below and down variations are never above the nominal values.
+
+    Variations whose up value is below their down value are swapped first.
+
+    Args:
+        nominal: The array of nominal values
+        up: An array of up variations, with the variations along the first
+            axis
+        down: The array of the corresponding down variations
+
+    Returns:
+        A tuple of (up, down, switched, reset), where up and down are the
+        normalized arrays, switched is the number of swapped values, and
+        reset is the number of values reset to the nominal value.
+    """
+    up = numpy.asarray(up, dtype = 'float64')
+    down = numpy.asarray(down, dtype = 'float64')
+    switched = up < down
+    up, down = numpy.where(switched, down, up), numpy.where(switched, up, down)
+    reset = numpy.count_nonzero(up < nominal) \
+            + numpy.count_nonzero(down > nominal)
+    return (numpy.maximum(up, nominal),
+            numpy.minimum(down, nominal),
+            numpy.count_nonzero(switched),
+            reset)
+
+
+def syst_errors(nominal, up, down):
+    """Computes systematic errors from up and down variations, adding the
+    differences to the nominal values in quadrature.
+
+    Args:
+        nominal: The array of nominal values
+        up: An array of up variations, with the variations along the first
+            axis
+        down: The array of the corresponding down variations
+
+    Returns:
+        The (low, high) errors, where the high errors come from the up and
+        the low errors from the down variations.
+    """
+    up = numpy.reshape(up, (-1,) + numpy.shape(nominal))
+    down = numpy.reshape(down, (-1,) + numpy.shape(nominal))
+    return (numpy.sqrt(((nominal - down) ** 2).sum(axis = 0)),
+            numpy.sqrt(((nominal - up) ** 2).sum(axis = 0)))
+
+
+def combined(*errors):
+    """Combines errors in quadrature.
+
+    Args:
+        errors: The (low, high) errors to combine
+
+    Returns:
+        The combined (low, high) errors.
+    """
+    return (numpy.sqrt(sum(numpy.square(low) for low, _ in errors)),
+            numpy.sqrt(sum(numpy.square(high) for _, high in errors)))
+
+
+def flipped(errors):
+    """Swaps the low and high parts of errors.
+    """
+    low, high = errors
+    return high, low
+
+
+def relative(values, errors):
+    """Divides errors by values, where values of zero yield zero errors.
+
+    Args:
+        values: The array of values
+        errors: The (low, high) errors of the values
+
+    Returns:
+        The relative (low, high) errors.
+    """
+    values = numpy.asarray(values, dtype = 'float64')
+    safe = numpy.where(values != 0, values, 1.0)
+    return tuple(numpy.where(values != 0, e / safe, 0.0) for e in errors)
+
+
+def graph(centers, widths, values, errors = None, title = '',
+          x_errors = True, valid = None):
+    """Builds a ROOT graph.
+
+    Args:
+        centers: The array of bin centers
+        widths: The array of bin widths
+        values: The array of values
+        errors: The optional (low, high) errors of the values
+        title: The title of the graph
+        x_errors: Whether to set the X errors to half the bin widths
+        valid: An optional boolean array of the bins to include as points,
+            e.g. the bins with total counts (see Efficiencies.valid)
+
+    Returns:
+        A TGraphAsymmErrors.
+    """
+    # ROOT is only needed here, so only import it when it's used
+    from ROOT import TGraphAsymmErrors
+
+    zeros = numpy.zeros(len(centers))
+    half_widths = numpy.asarray(widths) / 2.0 if x_errors else zeros
+    low, high = errors if errors is not None else (zeros, zeros)
+    if valid is None:
+        valid = numpy.ones(len(centers), dtype = bool)
+    valid = numpy.asarray(valid, dtype = bool)
+    count = int(numpy.count_nonzero(valid))
+    doubles = lambda a: array('d',
+                              numpy.asarray(a, dtype = 'float64')[valid])
+    result = TGraphAsymmErrors(count,
+                               doubles(centers),
+                               doubles(values),
+                               doubles(half_widths),
+                               doubles(half_widths),
+                               doubles(low),
+                               doubles(high))
+    result.SetTitle(title)
+    return result
+
+
+class Efficiencies(object):
+    """The efficiencies of a set of variations in the same bins.
+
+    Negative counts are set to zero, and passed counts are limited to the
+    total counts, before the efficiencies and their Clopper-Pearson intervals
+    are computed. Bins without total counts have zero efficiencies, and are
+    left out of graphs (as with TGraphAsymmErrors::Divide).
+
+    Args:
+        total: An array of total counts of shape (variation, bin)
+        passed: The array of the corresponding passed counts
+        edges: The bin edges
+        titles: The titles of the variations
+        confidence: The confidence level of the intervals
+        variances: An optional array of the sums of squared weights of the
+            total counts, see clopper_pearson
+    """
+    def __init__(self, total, passed, edges, titles,
+                 confidence = CONFIDENCE, variances = None):
+        edges = numpy.asarray(edges, dtype = 'float64')
+        self._edges = edges
+        self._confidence = confidence
+        self._centers = (edges[:-1] + edges[1:]) / 2.0
+        self._widths = edges[1:] - edges[:-1]
+        self._titles = list(titles)
+
+        shape = (len(self._titles), len(self._centers))
+        total = numpy.maximum(numpy.reshape(total, shape), 0.0)
+        passed = numpy.minimum(numpy.maximum(numpy.reshape(passed, shape),
+                                             0.0),
+                               total)
+        self._valid = total > 0
+        self._values = numpy.where(total > 0,
+                                   passed / numpy.where(total > 0, total, 1.0),
+                                   0.0)
+        if variances is not None:
+            variances = numpy.reshape(variances, shape)
+        low, high = clopper_pearson(total, passed, confidence, variances)
+        self._errors = (self._values - low, high - self._values)
+
+    @classmethod
+    def from_histograms(cls, totals, passeds, titles,
+                        confidence = CONFIDENCE):
+        """Computes efficiencies from pairs of histograms.
+
+        Args:
+            totals: The list of total histograms, one per variation
+            passeds: The list of the corresponding passed histograms
+            titles: The titles of the variations
+            confidence: The confidence level of the intervals
+
+        Returns:
+            The Efficiencies.
+        """
+        return cls([contents(h) for h in totals],
+                   [contents(h) for h in passeds],
+                   _edges(totals[0]),
+                   titles,
+                   confidence,
+                   [sumw2(h) for h in totals])
+
+    def varied(self, totals, passeds, titles):
+        """Computes the efficiencies of variations in the same bins.
+
+        Args:
+            totals: The list of total histograms, one per variation
+            passeds: The list of the corresponding passed histograms
+            titles: The titles of the variations
+
+        Returns:
+            The Efficiencies, which may be empty.
+        """
+        return Efficiencies([contents(h) for h in totals],
+                            [contents(h) for h in passeds],
+                            self._edges,
+                            titles,
+                            self._confidence,
+                            [sumw2(h) for h in totals])
+
+    def titles(self):
+        return self._titles
+
+    def centers(self):
+        return self._centers
+
+    def widths(self):
+        return self._widths
+
+    def values(self):
+        """Returns the (variation x bin) array of efficiencies.
+        """
+        return self._values
+
+    def valid(self, index = None):
+        """Returns whether the bins have total counts, either for all
+        variations or for the variation with the given index.
+        """
+        if index is None:
+            return self._valid
+        return self._valid[index]
+
+    def errors(self, index = None):
+        """Returns the (low, high) errors of the efficiencies, either of all
+        variations or of the variation with the given index.
+        """
+        if index is None:
+            return self._errors
+        return self._errors[0][index], self._errors[1][index]
+
+    def with_values(self, values):
+        """Creates a copy with different efficiencies, but the same errors.
+        """
+        result = object.__new__(type(self))
+        result.__dict__.update(self.__dict__)
+        result._values = numpy.reshape(values, self._values.shape)
+        return result
+
+    def selected(self, keyword):
+        """Selects the variations whose title contains a keyword.
+
+        Returns:
+            The (variation x bin) array of their efficiencies.
+        """
+        return self._values[[i
+                             for i, t
+                             in enumerate(self._titles)
+                             if keyword in t]]
+
+    def graph(self, index = 0):
+        """Builds the ROOT graph of a variation, with its statistical errors.
+        """
+        return graph(self._centers,
+                     self._widths,
+                     self._values[index],
+                     self.errors(index),
+                     self._titles[index],
+                     valid = self._valid[index])
+
+
+def _edges(histogram):
+    # Extract the bin edges of a histogram
+    axis = histogram.GetXaxis()
+    return [axis.GetBinLowEdge(b) for b in range(1, axis.GetNbins() + 2)]
@@ -1,6 +1,14 @@
 """Provides background estimation routines for the mu+tau analysis.
 """
 
+# System imports
+from uuid import uuid4
+from functools import partial
+from hashlib import sha1
+
+# Six imports
+from six import iteritems
+
 # owls-hep imports
 from owls_hep.estimation import Estimation
 from owls_hep.uncertainty import Uncertainty
@@ -9,10 +17,109 @@ from owls_hep.variations import Filtered
 # owls-mutau imports
 from owls_mutau.variations import SS, OS
 from owls_mutau.uncertainties import RqcdSyst, RqcdStat
+from owls_mutau.histogramming import fusable, categorized
+from owls_mutau.rqcd import splits_digest
+
+
+class _Prefilled(object):
+    """Calculation proxy which returns histograms that have been filled in
+    advance for specific regions, and falls back to the wrapped calculation
+    for any other region.
+    """
+    def __init__(self, calculation):
+        self.calculation = calculation
+        self._prefilled = []
+
+    def __getattr__(self, name):
+        # Forward anything else (labels etc.) to the wrapped calculation
+        if name == 'calculation':
+            raise AttributeError(name)
+        return getattr(self.calculation, name)
+
+    def clear(self):
+        self._prefilled = []
+
+    def register(self, region, histogram):
+        self._prefilled.append((region, histogram))
+
+    def __call__(self, process, region):
+        # Regions are matched by identity, since the estimation passes the
+        # very same region objects that it registered
+        for r, histogram in self._prefilled:
+            if r is region:
+                return histogram.Clone(uuid4().hex)
+        return self.calculation(process, region)
+
+
+def _prefilled(calculation):
+    """Wraps the innermost histogram of a calculation in a _Prefilled proxy.
+
+    Args:
+        calculation: A Histogram, or an Uncertainty wrapping a Histogram
+
+    Returns:
+        A tuple of (proxy, calculation), where calculation is the calculation
+        to use in place of the original one. If the calculation can't be
+        filled in a fused pass, the proxy is None and the original
+        calculation is returned.
+    """
+    if isinstance(calculation, Uncertainty):
+        if not fusable(calculation.calculation):
+            return None, calculation
+        proxy = _Prefilled(calculation.calculation)
+        return proxy, type(calculation)(proxy)
+    if fusable(calculation):
+        proxy = _Prefilled(calculation)
+        return proxy, proxy
+    return None, calculation
+
+
+def _r_qcd_scales(calculation, nominal, stat, syst):
+    """Computes the (nominal, up, down) rQCD scale factors for a calculation.
+
+    The rQCD uncertainties only differ from the nominal estimation in these
+    scale factors; the underlying SS histograms are identical, and are
+    shared between them when filling in fused mode.
+    """
+    if isinstance(calculation, RqcdStat):
+        return (nominal, nominal+stat, nominal-stat)
+    elif isinstance(calculation, RqcdSyst):
+        return (nominal, nominal+syst, nominal-syst)
+    else:
+        return (nominal, nominal, nominal)
+
+
+def _anded(*selections):
+    # Combine non-empty selections into a conjunction
+    return ' && '.join('({})'.format(s) for s in selections if s)
+
+
+def _prefill(proxy, process, region, categories):
+    """Fills all categories of a region in one pass and registers the
+    resulting histograms with a proxy.
+
+    Args:
+        proxy: The _Prefilled proxy to register the histograms with
+        process: The process whose events should be histogrammed
+        region: The region to fill, without any category selection
+        categories: A list of (split, charge, component_region) tuples, where
+            split is the rQCD split selection, charge is the OS or SS
+            variation class, and component_region is the region the
+            estimation will ask for
+    """
+    proxy.clear()
+    histograms = categorized(process,
+                             region,
+                             proxy.calculation,
+                             [_anded(split, charge.selection)
+                              for split, charge, _
+                              in categories])
+    for (_, _, component_region), histogram in zip(categories, histograms):
+        proxy.register(component_region, histogram)
 
 
 class OSSS(Estimation):
-    def __init__(self, calculation, r_qcd, luminosity = 1000):
+    def __init__(self, calculation, r_qcd, luminosity = 1000, fused = False):
         # Call superclass initializer
         super(OSSS, self).__init__(calculation)
 
@@ -22,21 +129,28 @@ class OSSS(Estimation):
         # Store the luminosity
         self._luminosity = luminosity
 
+        # In fused mode, the OS and SS histograms of all rQCD splits are
+        # filled in a single pass and handed to the calculation through a
+        # proxy
+        self._proxy = None
+        if fused:
+            self._proxy, self._calculation = _prefilled(calculation)
+
     def components(self, process, region):
         # Extract the r_qcd value from the rqcd label
         r_qcd_label = region.metadata()['rqcd']
 
         # Initialize the components and loop over the rQCD splits
         components = []
+        categories = []
         for split, nominal, stat, syst in self._r_qcd[r_qcd_label]:
             r = region.varied(Filtered(split))
+            os_region = r.varied(OS())
+            ss_region = r.varied(SS())
+            categories.append((split, OS, os_region))
+            categories.append((split, SS, ss_region))
 
-            if isinstance(self._calculation, RqcdStat):
-                r_qcd = (nominal, nominal+stat, nominal-stat)
-            elif isinstance(self._calculation, RqcdSyst):
-                r_qcd = (nominal, nominal+syst, nominal-syst)
-            else:
-                r_qcd = (nominal, nominal, nominal)
+            r_qcd = _r_qcd_scales(self._calculation, nominal, stat, syst)
 
             if 'rqcd_split' in process.metadata().get('print_me', []):
                 print('For split {} I\'m using r_qcd = {} for {} and {}'. \
@@ -50,7 +164,7 @@ class OSSS(Estimation):
                 self._luminosity / 1e3,
                 False,
                 process,
-                r.varied(OS())
+                os_region
             ))
 
             # Append SS component, with rQCD correction
@@ -58,9 +172,14 @@ class OSSS(Estimation):
                 tuple([-v*self._luminosity / 1e3 for v in r_qcd]),
                 False,
                 process,
-                r.varied(SS())
+                ss_region
             ))
 
+        # Fill OS and SS of all splits in one pass, with the split index and
+        # charge product as category
+        if self._proxy is not None:
+            _prefill(self._proxy, process, region, categories)
+
         if 'estimation' in process.metadata().get('print_me', []):
             print('OSSS estimation for {} and {} with rQCD label {} and {} '
                   'components'.format(type(self._calculation),
@@ -71,27 +190,31 @@ class OSSS(Estimation):
         return components
 
 class SSData(Estimation):
-    def __init__(self, calculation, r_qcd):
+    def __init__(self, calculation, r_qcd, fused = False):
         # Call superclass initializer
         super(SSData, self).__init__(calculation)
 
         # Store r_qcd dictionary
         self._r_qcd = r_qcd
 
+        # In fused mode, the SS histograms of all rQCD splits are filled in a
+        # single pass
+        self._proxy = None
+        if fused:
+            self._proxy, self._calculation = _prefilled(calculation)
+
     def components(self, process, region):
         # Extract the r_qcd value from the rqcd label
         r_qcd_label = region.metadata()['rqcd']
         # Initialize the components and loop over the rQCD splits
         components = []
+        categories = []
         for split, nominal, stat, syst in self._r_qcd[r_qcd_label]:
             r = region.varied(Filtered(split))
+            ss_region = r.varied(SS())
+            categories.append((split, SS, ss_region))
 
-            if isinstance(self._calculation, RqcdStat):
-                r_qcd = (nominal, nominal+stat, nominal-stat)
-            elif isinstance(self._calculation, RqcdSyst):
-                r_qcd = (nominal, nominal+syst, nominal-syst)
-            else:
-                r_qcd = (nominal, nominal, nominal)
+            r_qcd = _r_qcd_scales(self._calculation, nominal, stat, syst)
 
             if 'rqcd_split' in process.metadata().get('print_me', []):
                 print('For split {} I\'m using r_qcd = {} for {} and {}'. \
@@ -105,9 +228,13 @@ class SSData(Estimation):
                 r_qcd,
                 False,
                 process,
-                r.varied(SS())
+                ss_region
             ))
 
+        # Fill SS of all splits in one pass, with the split index as category
+        if self._proxy is not None:
+            _prefill(self._proxy, process, region, categories)
+
         if 'estimation' in process.metadata().get('print_me', []):
             print('SSData estimation for {} and {} with rQCD label {} and {} '
                   'components'.format(type(self._calculation),
@@ -117,6 +244,65 @@ class SSData(Estimation):
 
         return components
 
+def _unwrapped(estimation):
+    # Unwrap partially applied estimations into the estimation class and its
+    # keywords, where outer keywords take precedence
+    keywords = {}
+    while isinstance(estimation, partial):
+        for name, value in iteritems(estimation.keywords or {}):
+            keywords.setdefault(name, value)
+        estimation = estimation.func
+    return estimation, keywords
+
+def r_qcd_digest(estimation, region):
+    """Computes the digest of the rQCD values an estimation uses in a region.
+
+    Args:
+        estimation: The estimation, usually partially applied with its rQCD
+            table (as in the model modules)
+        region: The region
+
+    Returns:
+        The digest of the rQCD values of the region, or None if the
+        estimation doesn't use rQCD.
+    """
+    estimation, keywords = _unwrapped(estimation)
+    if not isinstance(estimation, type) \
+            or not issubclass(estimation, (OSSS, SSData)):
+        return None
+    table = keywords.get('r_qcd')
+    label = region.metadata().get('rqcd')
+    if table is None or label is None or label not in table:
+        return None
+    return splits_digest(table[label])
+
+def estimation_digest(estimation, region):
+    """Computes the digest of how an estimation estimates a sample in a
+    region.
+
+    The digest covers the estimation class, the keywords it is partially
+    applied with, and the rQCD values of the region (see r_qcd_digest)
+    instead of the whole rQCD table, so that it only changes if the
+    estimation of the region changes.
+
+    Args:
+        estimation: The estimation, possibly partially applied
+        region: The region
+
+    Returns:
+        A hex digest.
+    """
+    unwrapped, keywords = _unwrapped(estimation)
+    return sha1(repr((
+        getattr(unwrapped, '__module__', None),
+        getattr(unwrapped, '__name__', repr(unwrapped)),
+        sorted((n, repr(v))
+               for n, v
+               in iteritems(keywords)
+               if n != 'r_qcd'),
+        r_qcd_digest(estimation, region)
+    )).encode('utf-8')).hexdigest()
+
 class OSData(Estimation):
     def __init__(self, calculation):
         # Call superclass initializer
@@ -0,0 +1,665 @@
+"""Provides canonicalization of selection and weight expressions for the
+mu+tau analysis.
+
+Logically identical selections are often written in different ways (e.g. with
+a different order of conjunctions, extra whitespace or parentheses, or 1
+instead of 1.0), which makes string-keyed caches miss. The canonicalizer
+parses an expression into a syntax tree, normalizes it, and renders it back
+into a TTreeFormula-compatible string:
+
+    - conjunctions and disjunctions are flattened, sorted, and deduplicated
+    - products and sums are flattened and sorted, and factors of 1 are
+      dropped
+    - operands of == and != are sorted, and comparisons are oriented with
+      the constant on the right-hand side
+    - numeric constants are written in a single format
+    - whitespace and parentheses are normalized
+
+Expressions which can't be parsed are returned with normalized whitespace.
+
+The canonical syntax tree can also be compiled into a vectorized numpy kernel,
+which evaluates the expression on arrays of raw branch values (e.g. as loaded
+in bulk by root_numpy) instead of interpreting it event by event. Kernels are
+cached per canonical expression, so equivalent expressions are only compiled
+once.
+"""
+
+# System imports
+import re
+from collections import OrderedDict
+
+# numpy imports
+import numpy
+
+# Set up default exports
+__all__ = [
+    'canonical',
+    'factored',
+    'shared',
+    'UnsupportedExpression',
+    'Kernel',
+    'compiled',
+]
+
+
+# Token specification, with longer operators first
+_TOKEN = re.compile(r'''
+    \s*(?:
+        (?P<number>(?:\d+\.?\d*|\.\d+)(?:[eE][+-]?\d+)?)
+        |(?P<name>[A-Za-z_]\w*(?:(?:::|\.)[A-Za-z_]\w*)*)
+        |(?P<string>"[^"]*"|'[^']*')
+        |(?P<operator>&&|\|\||==|!=|<=|>=|[-+*/%<>!&|^(),\[\]])
+    )''', re.VERBOSE)
+
+# Binary operators by increasing precedence (as in C)
+_PRECEDENCE = (
+    ('||',),
+    ('&&',),
+    ('|',),
+    ('^',),
+    ('&',),
+    ('==', '!='),
+    ('<', '<=', '>', '>='),
+    ('+', '-'),
+    ('*', '/', '%'),
+)
+
+# Associative and commutative operators, which are flattened and sorted
+_COMMUTATIVE = ('||', '&&', '|', '^', '&', '+', '*')
+
+# Operators whose terms may be deduplicated
+_IDEMPOTENT = ('||', '&&')
+
+# Mirrored comparison operators
+_MIRRORED = {'<': '>', '<=': '>=', '>': '<', '>=': '<='}
+
+
+def _tokenize(expression):
+    """Splits an expression into (kind, text) tokens.
+
+    Raises:
+        ValueError: If the expression contains an unknown character
+    """
+    tokens = []
+    position = 0
+    expression = expression.rstrip()
+    while position < len(expression):
+        match = _TOKEN.match(expression, position)
+        if match is None or match.end() == position:
+            raise ValueError('unable to tokenize {!r} at {}'. \
+                             format(expression, position))
+        tokens.append((match.lastgroup, match.group(match.lastgroup)))
+        position = match.end()
+    return tokens
+
+
+class _Parser(object):
+    """A recursive descent parser producing tuple-based syntax trees.
+
+    The node types are:
+        ('number', value)
+        ('atom', text) for names and strings
+        ('call', name, [arguments])
+        ('index', node, index)
+        ('unary', operator, node)
+        ('binary', operator, [operands])
+    """
+    def __init__(self, tokens):
+        self._tokens = tokens
+        self._position = 0
+
+    def _peek(self):
+        if self._position < len(self._tokens):
+            return self._tokens[self._position]
+        return (None, None)
+
+    def _next(self):
+        token = self._peek()
+        self._position += 1
+        return token
+
+    def _expect(self, text):
+        kind, value = self._next()
+        if kind != 'operator' or value != text:
+            raise ValueError('expected {!r}, got {!r}'.format(text, value))
+
+    def parse(self):
+        node = self._binary(0)
+        if self._position != len(self._tokens):
+            raise ValueError('unexpected token {!r}'.format(self._peek()[1]))
+        return node
+
+    def _binary(self, level):
+        if level == len(_PRECEDENCE):
+            return self._unary()
+        node = self._binary(level + 1)
+        while True:
+            kind, value = self._peek()
+            if kind != 'operator' or value not in _PRECEDENCE[level]:
+                return node
+            self._next()
+            node = ('binary', value, [node, self._binary(level + 1)])
+
+    def _unary(self):
+        kind, value = self._peek()
+        if kind == 'operator' and value in ('!', '-', '+'):
+            self._next()
+            return ('unary', value, self._unary())
+        return self._postfix()
+
+    def _postfix(self):
+        node = self._primary()
+        while self._peek() == ('operator', '['):
+            self._next()
+            index = self._binary(0)
+            self._expect(']')
+            node = ('index', node, index)
+        return node
+
+    def _primary(self):
+        kind, value = self._next()
+        if kind == 'number':
+            return ('number', float(value))
+        if kind == 'string':
+            return ('atom', value)
+        if kind == 'name':
+            if self._peek() == ('operator', '('):
+                self._next()
+                arguments = []
+                if self._peek() != ('operator', ')'):
+                    arguments.append(self._binary(0))
+                    while self._peek() == ('operator', ','):
+                        self._next()
+                        arguments.append(self._binary(0))
+                self._expect(')')
+                return ('call', value, arguments)
+            return ('atom', value)
+        if (kind, value) == ('operator', '('):
+            node = self._binary(0)
+            self._expect(')')
+            return node
+        raise ValueError('unexpected token {!r}'.format(value))
+
+
+def _number(value):
+    # Render integral values without a decimal point, so that they remain
+    # usable in bitwise operations
+    if value == int(value) and abs(value) < 1e15:
+        return str(int(value))
+    return repr(value)
+
+
+def _order(node):
+    # Order operands by their rendering, with constants last
+    return (node[0] == 'number', _rendered(node))
+
+
+def _normalized(node):
+    """Normalizes a syntax tree.
+    """
+    kind = node[0]
+    if kind in ('number', 'atom'):
+        return node
+    if kind == 'call':
+        return ('call', node[1], [_normalized(a) for a in node[2]])
+    if kind == 'index':
+        return ('index', _normalized(node[1]), _normalized(node[2]))
+    if kind == 'unary':
+        operand = _normalized(node[2])
+        if node[1] == '+':
+            return operand
+        if node[1] == '-' and operand[0] == 'number':
+            return ('number', -operand[1])
+        return ('unary', node[1], operand)
+
+    # Binary operators
+    operator = node[1]
+    operands = [_normalized(o) for o in node[2]]
+    if operator in _COMMUTATIVE:
+        # Flatten nested applications of the same operator
+        flattened = []
+        for o in operands:
+            if o[0] == 'binary' and o[1] == operator:
+                flattened.extend(o[2])
+            else:
+                flattened.append(o)
+
+        # Drop factors of 1
+        if operator == '*':
+            flattened = [o for o in flattened if o != ('number', 1.0)] \
+                    or [('number', 1.0)]
+
+        # Sort (and possibly deduplicate) the operands by their rendering.
+        # Selection operands are already boolean, so e.g. a && a reduces to
+        # the single operand a.
+        rendered = [(_rendered(o), o) for o in flattened]
+        if operator in _IDEMPOTENT:
+            rendered = list(dict(rendered).items())
+        operands = [o for _, o in sorted(rendered, key = lambda r: r[0])]
+        if len(operands) == 1:
+            return operands[0]
+        return ('binary', operator, operands)
+    if operator in ('==', '!='):
+        return ('binary', operator, sorted(operands, key = _order))
+    if operator in _MIRRORED and operands[0][0] == 'number' \
+            and operands[1][0] != 'number':
+        return ('binary', _MIRRORED[operator], operands[::-1])
+    return ('binary', operator, operands)
+
+
+def _rendered(node):
+    """Renders a normalized syntax tree.
+    """
+    kind = node[0]
+    if kind == 'number':
+        return _number(node[1])
+    if kind == 'atom':
+        return node[1]
+    if kind == 'call':
+        return '{}({})'.format(node[1], ', '.join(_rendered(a)
+                                                  for a
+                                                  in node[2]))
+    if kind == 'index':
+        return '{}[{}]'.format(_rendered(node[1]), _rendered(node[2]))
+    if kind == 'unary':
+        # Nested unary operators and negative constants are parenthesized, so
+        # that e.g. -(-a) doesn't render as the decrement --a
+        operand = _rendered(node[2])
+        if node[2][0] == 'unary' \
+                or (node[2][0] == 'number' and node[2][1] < 0):
+            operand = '({})'.format(operand)
+        return '{}{}'.format(node[1], operand)
+    return '({})'.format(' {} '.format(node[1]).join(_rendered(o)
+                                                     for o
+                                                     in node[2]))
+
+
+def canonical(expression):
+    """Computes the canonical form of a selection or weight expression.
+
+    Args:
+        expression: The expression to canonicalize
+
+    Returns:
+        The canonical expression, which is logically identical to the
+        original expression, and identical for equivalent expressions which
+        only differ in ordering, whitespace, redundant terms or the format of
+        constants.
+    """
+    try:
+        return _rendered(_tree(expression))
+    except ValueError:
+        return ' '.join(expression.split())
+
+
+# Operators with a boolean result
+_BOOLEAN = ('||', '&&', '==', '!=', '<', '<=', '>', '>=')
+
+
+def _tree(expression):
+    # Parse and normalize an expression
+    return _normalized(_Parser(_tokenize(expression)).parse())
+
+
+def _boolean(node):
+    return (node[0] == 'binary' and node[1] in _BOOLEAN) \
+            or (node[0] == 'unary' and node[1] == '!')
+
+
+def _terms(node):
+    # Split a node into the terms of its conjunction
+    if node[0] == 'binary' and node[1] == '&&':
+        return node[2]
+    return [node]
+
+
+def factored(expression, atoms):
+    """Factors boolean atoms out of a selection.
+
+    The selection is split into its multiplicative factors, and the terms of
+    each boolean factor are matched against the atoms (and their negations).
+    An atom which is a conjunction itself matches if all of its terms are
+    present, and larger atoms are matched first.
+
+    Args:
+        expression: The selection
+        atoms: A list of boolean expressions
+
+    Returns:
+        A tuple of (required, vetoed, residual), where required and vetoed
+        are sets of the indices of the atoms which have to be true and false
+        respectively, and residual is the remaining expression. The selection
+        equals the residual for events which satisfy the atom conditions, and
+        zero for all others.
+
+    Raises:
+        ValueError: If the selection or an atom can't be parsed
+    """
+    tree = _tree(expression)
+    atoms = [(i,
+              set(_rendered(t) for t in _terms(a)),
+              _rendered(('unary', '!', a)))
+             for i, a
+             in enumerate(_tree(a) for a in atoms)]
+    atoms.sort(key = lambda a: -len(a[1]))
+
+    required = set()
+    vetoed = set()
+    residual = []
+    if tree[0] == 'binary' and tree[1] == '*':
+        factors = tree[2]
+    else:
+        factors = [tree]
+    for factor in factors:
+        if not _boolean(factor):
+            residual.append(factor)
+            continue
+        terms = OrderedDict((_rendered(t), t) for t in _terms(factor))
+        for i, atom_terms, _ in atoms:
+            if atom_terms <= set(terms):
+                required.add(i)
+                for t in atom_terms:
+                    del terms[t]
+        for i, _, negation in atoms:
+            if negation in terms:
+                vetoed.add(i)
+                del terms[negation]
+        if len(terms) == len(_terms(factor)):
+            residual.append(factor)
+        elif len(terms) > 1:
+            residual.append(('binary', '&&', list(terms.values())))
+        elif len(terms) == 1:
+            # A single remaining term has to stay boolean
+            term = list(terms.values())[0]
+            if not _boolean(term):
+                term = ('binary', '!=', [term, ('number', 0.0)])
+            residual.append(term)
+
+    if len(residual) == 0:
+        return required, vetoed, '1'
+    if len(residual) == 1:
+        return required, vetoed, _rendered(residual[0])
+    return required, vetoed, _rendered(('binary', '*', residual))
+
+
+def _decomposed(tree):
+    # Split a tree into its non-boolean factors and the terms of its boolean
+    # factors (whose product is the conjunction of their terms)
+    if tree[0] == 'binary' and tree[1] == '*':
+        factors = tree[2]
+    else:
+        factors = [tree]
+    return ([f for f in factors if not _boolean(f)],
+            [t for f in factors if _boolean(f) for t in _terms(f)])
+
+
+def _composed(factors, terms):
+    # Combine factors and conjunction terms into a rendered expression
+    if len(terms) == 1 and not _boolean(terms[0]):
+        factors = factors + [('binary', '!=', [terms[0], ('number', 0.0)])]
+    elif len(terms) == 1:
+        factors = factors + terms
+    elif len(terms) > 1:
+        factors = factors + [('binary', '&&', terms)]
+    if len(factors) == 0:
+        return '1'
+    if len(factors) == 1:
+        return canonical(_rendered(factors[0]))
+    return canonical(_rendered(('binary', '*', factors)))
+
+
+def _split(nodes, common):
+    # Split nodes into those matching a list of renderings (one occurrence
+    # each) and the rest
+    common = list(common)
+    matched = []
+    rest = []
+    for node in nodes:
+        rendering = _rendered(node)
+        if rendering in common:
+            common.remove(rendering)
+            matched.append(node)
+        else:
+            rest.append(node)
+    return matched, rest
+
+
+def _intersection(lists):
+    # Compute the multiset intersection of lists of renderings
+    result = lists[0]
+    for other in lists[1:]:
+        remaining = list(other)
+        common = []
+        for r in result:
+            if r in remaining:
+                remaining.remove(r)
+                common.append(r)
+        result = common
+    return result
+
+
+def shared(expressions):
+    """Splits the common part out of a list of (weighted) selections.
+
+    Args:
+        expressions: A non-empty list of selections
+
+    Returns:
+        A tuple of (base, residuals), where base is the product of the
+        factors and conjunction terms which all selections share, and
+        residuals is a list of the remaining expressions, such that each
+        selection equals base * residual.
+
+    Raises:
+        ValueError: If any of the selections can't be parsed
+    """
+    decomposed = [_decomposed(_tree(e)) for e in expressions]
+    common_factors = _intersection([[_rendered(n) for n in factors]
+                                    for factors, _
+                                    in decomposed])
+    common_terms = _intersection([[_rendered(n) for n in terms]
+                                  for _, terms
+                                  in decomposed])
+
+    base_factors, _ = _split(decomposed[0][0], common_factors)
+    base_terms, _ = _split(decomposed[0][1], common_terms)
+    return (_composed(base_factors, base_terms),
+            [_composed(_split(factors, common_factors)[1],
+                       _split(terms, common_terms)[1])
+             for factors, terms
+             in decomposed])
+
+
+# Functions which may be called in compiled expressions, and their numpy
+# implementations
+_FUNCTIONS = {
+    'abs': 'numpy.abs',
+    'fabs': 'numpy.abs',
+    'TMath::Abs': 'numpy.abs',
+    'sqrt': 'numpy.sqrt',
+    'TMath::Sqrt': 'numpy.sqrt',
+    'exp': 'numpy.exp',
+    'TMath::Exp': 'numpy.exp',
+    'log': 'numpy.log',
+    'TMath::Log': 'numpy.log',
+    'cos': 'numpy.cos',
+    'TMath::Cos': 'numpy.cos',
+    'sin': 'numpy.sin',
+    'TMath::Sin': 'numpy.sin',
+    'pow': 'numpy.power',
+    'TMath::Power': 'numpy.power',
+    'min': 'numpy.minimum',
+    'TMath::Min': 'numpy.minimum',
+    'max': 'numpy.maximum',
+    'TMath::Max': 'numpy.maximum',
+}
+
+# Binary operators and the numpy functions implementing them, along with the
+# conversion applied to their operands. As in TTreeFormula, arithmetic is
+# done in double precision (with division by zero yielding zero), and bitwise
+# operations and the modulus on 64-bit integers (with the sign of the modulus
+# following C).
+_OPERATORS = {
+    '||': ('numpy.logical_or', ''),
+    '&&': ('numpy.logical_and', ''),
+    '|': ('numpy.bitwise_or', '_integer'),
+    '^': ('numpy.bitwise_xor', '_integer'),
+    '&': ('numpy.bitwise_and', '_integer'),
+    '==': ('numpy.equal', ''),
+    '!=': ('numpy.not_equal', ''),
+    '<': ('numpy.less', ''),
+    '<=': ('numpy.less_equal', ''),
+    '>': ('numpy.greater', ''),
+    '>=': ('numpy.greater_equal', ''),
+    '+': ('numpy.add', '_double'),
+    '-': ('numpy.subtract', '_double'),
+    '*': ('numpy.multiply', '_double'),
+    '/': ('_divide', '_double'),
+    '%': ('numpy.fmod', '_integer'),
+}
+
+
+def _double(value):
+    return numpy.asarray(value, dtype = 'float64')
+
+
+def _integer(value):
+    return numpy.asarray(value).astype('int64')
+
+
+def _divide(numerator, denominator):
+    # Divide as TTreeFormula does, which yields zero for a zero denominator
+    with numpy.errstate(divide = 'ignore', invalid = 'ignore'):
+        return numpy.where(denominator != 0,
+                           numpy.true_divide(numerator, denominator),
+                           0.0)
+
+
+def _source(node, branches):
+    """Generates the Python source of a kernel for a normalized syntax tree.
+
+    Args:
+        node: The syntax tree
+        branches: A set, which is updated with the names of the branches the
+            expression reads
+
+    Raises:
+        ValueError: If the expression uses a construct which can't be
+            vectorized (strings, indexing, member access or unknown functions)
+    """
+    kind = node[0]
+    if kind == 'number':
+        return repr(node[1])
+    if kind == 'atom':
+        if not re.match(r'^[A-Za-z_]\w*$', node[1]):
+            raise ValueError('unable to vectorize {!r}'.format(node[1]))
+        branches.add(node[1])
+        return 'columns[{!r}]'.format(node[1])
+    if kind == 'call':
+        if node[1] not in _FUNCTIONS:
+            raise ValueError('unable to vectorize function {!r}'. \
+                             format(node[1]))
+        return '{}({})'.format(_FUNCTIONS[node[1]],
+                               ', '.join(_source(a, branches)
+                                         for a
+                                         in node[2]))
+    if kind == 'index':
+        raise ValueError('unable to vectorize indexing')
+    if kind == 'unary':
+        operand = _source(node[2], branches)
+        if node[1] == '!':
+            return 'numpy.logical_not({})'.format(operand)
+        return 'numpy.negative(_double({}))'.format(operand)
+
+    # Binary operators, applied from left to right
+    function, conversion = _OPERATORS[node[1]]
+    operands = ['{}({})'.format(conversion, _source(o, branches))
+                for o
+                in node[2]]
+    result = operands[0]
+    for operand in operands[1:]:
+        result = '{}({}, {})'.format(function, result, operand)
+    return result
+
+
+class UnsupportedExpression(ValueError):
+    """Raised by compiled for expressions which can't be compiled into a
+    kernel (and have to be interpreted by TTreeFormula instead).
+    """
+    pass
+
+
+class Kernel(object):
+    """A vectorized evaluator of an expression.
+
+    Kernels are created with compiled, and evaluate an expression on a
+    dictionary mapping branch names to arrays of their values.
+    """
+    def __init__(self, expression, branches, function):
+        self._expression = expression
+        self._branches = branches
+        self._function = function
+
+    def expression(self):
+        """Returns the canonical expression of the kernel.
+        """
+        return self._expression
+
+    def branches(self):
+        """Returns a sorted tuple of the branches read by the kernel.
+        """
+        return self._branches
+
+    def __call__(self, columns, size):
+        """Evaluates the expression.
+
+        Args:
+            columns: A dictionary mapping (at least) the branches of the
+                kernel to arrays of their values
+            size: The number of events, used for expressions which don't
+                read any branches
+
+        Returns:
+            An array of the value of the expression for each event, in
+            double precision.
+        """
+        result = _double(self._function(columns))
+        if result.shape != (size,):
+            result = result + numpy.zeros(size)
+        return result
+
+
+# Compiled kernels by canonical expression
+_kernels = {}
+
+
+def compiled(expression):
+    """Compiles an expression into a vectorized kernel.
+
+    Args:
+        expression: The selection, weight or distribution expression
+
+    Returns:
+        The Kernel of the expression. Kernels are cached, so equivalent
+        expressions share a single kernel.
+
+    Raises:
+        UnsupportedExpression: If the expression can't be parsed or
+            vectorized
+    """
+    key = canonical(expression)
+    kernel = _kernels.get(key)
+    if kernel is None:
+        branches = set()
+        try:
+            source = _source(_tree(key), branches)
+        except ValueError as e:
+            raise UnsupportedExpression('unable to compile {!r}: {}'. \
+                                        format(key, e))
+        function = eval('lambda columns: {}'.format(source),
+                        {'numpy': numpy,
+                         '_double': _double,
+                         '_integer': _integer,
+                         '_divide': _divide})
+        kernel = _kernels[key] = Kernel(key, tuple(sorted(branches)), function)
+    return kernel
@@ -0,0 +1,1067 @@
+"""Provides fused histogramming of mutually exclusive event categories for the
+mu+tau analysis.
+
+Instead of drawing one histogram per category (e.g. OS and SS) and thereby
+reading the same tree once per category, the category index is used as an
+extra (Y) axis of a two-dimensional histogram, which is filled in a single
+pass. The per-category histograms are then projected out of the combined
+histogram.
+
+Fills don't interpret the selection event by event: the raw branches are
+loaded in bulk, and the selection, weight and distribution expressions are
+evaluated on them by compiled numpy kernels (see owls_mutau.expression).
+Plain histograms and weight systematics only take these columnar paths once
+they are enabled (see enable_columnar); otherwise they are drawn by owls-hep
+as before.
+
+The combined histograms are also kept in a small in-memory cache, so that the
+nominal estimation and the rQCD variations (which only differ in how the
+categories are scaled) share a single fill within a process.
+
+In the same spirit, weight systematics (which only swap one factor of the
+event weight for an up or down variant) are filled together: the selection is
+evaluated once per event with the varied weight factors read as plain
+columns, and the nominal plus every up/down variant are histogrammed from
+these columns, with the variation index on the Y axis. Systematics which are
+stored as alternative trees (e.g. the muon momentum variations) are filled
+from a single open of each input file, unless the process has friend trees.
+
+All fills are cached on the canonical form of the weighted selection (see
+owls_mutau.expression) instead of on the region, so that regions which are
+built differently but select the same events (e.g. mu_tau_ss and
+mu_tau.varied(SS())) share their histograms.
+
+Finally, the distributions a tool plots can be filled together (see
+fill_together): every fill then histograms all distributions of the group
+from the same selection and columns, so that a process is read once per
+region (and weight variation) instead of once per distribution. The fills are
+still cached per distribution, so changing the group never refills the
+distributions which are cached.
+"""
+
+# System imports
+import re
+from uuid import uuid4
+from array import array
+from collections import OrderedDict
+from functools import wraps
+
+# Six imports
+from six import iteritems, itervalues
+
+# owls-cache imports
+from owls_cache.persistent import cached as persistently_cached
+
+# owls-parallel imports
+from owls_parallel import parallelized
+
+# owls-hep imports
+from owls_hep.histogramming import Histogram as _Histogram
+from owls_hep.utility import make_selection, add_overflow_to_last_bin
+
+# owls-mutau imports
+from owls_mutau.expression import canonical, compiled, shared, \
+        UnsupportedExpression
+from owls_mutau.cuts import atomic, CutMask, query, MAXIMUM_CUTS
+from owls_mutau.regions import family_of
+
+# numpy imports
+import numpy
+
+# ROOT imports
+from ROOT import gROOT, TFile, TH2D
+from root_numpy import tree2array
+
+# Set up default exports
+__all__ = [
+    'Histogram',
+    'enable_columnar',
+    'columnar',
+    'fusable',
+    'fill_together',
+    'categorized',
+    'family_filled',
+    'weight_varied',
+    'tree_varied',
+]
+
+
+class Histogram(_Histogram):
+    """A owls-hep histogram which remembers its expression and binning, so
+    that it can be filled together with other categories or distributions.
+
+    The arguments are the same as for owls_hep.histogramming.Histogram.
+    """
+    def __init__(self, expression, binning, title, x_label, y_label,
+                 **kwargs):
+        # Call superclass initializer
+        super(Histogram, self).__init__(expression, binning, title,
+                                        x_label, y_label, **kwargs)
+
+        # Store the parameters needed for fused filling
+        self._expression = expression
+        self._binning = binning
+        self._title = title
+        self._include_overflow = kwargs.get('include_overflow', False)
+
+    def expression(self):
+        return self._expression
+
+    def binning(self):
+        return self._binning
+
+    def title(self):
+        return self._title
+
+    def include_overflow(self):
+        return self._include_overflow
+
+    def __call__(self, process, region):
+        if fusable(self):
+            # Regions of an enabled family are filled together with all
+            # other regions of the family
+            family = family_of(region)
+            if family is not None:
+                return family_filled(process,
+                                     family.regions(),
+                                     self)[family.index(region)]
+
+            # If enabled, fill through the columnar path, whose cache is
+            # keyed on the canonical selection rather than on the region, so
+            # that equivalent regions share a single fill
+            if _columnar:
+                return categorized(process, region, self, ('',))[0]
+        return super(Histogram, self).__call__(process, region)
+
+
+# Whether plain histograms and weight systematics are filled through the
+# columnar paths
+_columnar = False
+
+
+def enable_columnar(enabled = True):
+    """Enables (or disables) filling plain histograms and weight systematics
+    through the columnar paths.
+
+    Args:
+        enabled: Whether to enable the columnar paths
+    """
+    global _columnar
+    _columnar = enabled
+
+
+def columnar():
+    """Checks whether the columnar paths are enabled.
+    """
+    return _columnar
+
+
+def fusable(calculation):
+    """Checks whether a calculation can be filled in a fused pass.
+
+    Args:
+        calculation: The calculation to check
+
+    Returns:
+        True if the calculation is a one-dimensional owls-mutau Histogram.
+    """
+    return isinstance(calculation, Histogram) \
+            and ':' not in calculation.expression().replace('::', '')
+
+
+# The groups of histograms which are filled together
+_groups = []
+
+
+def fill_together(histograms):
+    """Fills a group of histograms together from now on.
+
+    Whenever one histogram of the group has to be filled, the other
+    (fusable) histograms of the group are filled in the same pass, and are
+    served from the cache when they are requested. Histograms are cached
+    individually, so cached histograms are never filled again when the group
+    changes.
+
+    Args:
+        histograms: An iterable of histograms
+    """
+    group = tuple(h for h in histograms if fusable(h))
+    if len(group) > 1:
+        _groups.append(group)
+
+
+def _grouped(histogram):
+    """Finds the group a histogram is filled with.
+
+    Histograms are matched by identity, since they are not hashable.
+
+    Args:
+        histogram: The owls-mutau Histogram
+
+    Returns:
+        A tuple of (distribution, group), where distribution is the
+        (canonical expression, binning) of the histogram, and group is a
+        tuple of the (canonical expression, binning) of each histogram of its
+        group.
+    """
+    group = (histogram,)
+    for g in _groups:
+        if any(h is histogram for h in g):
+            group = g
+            break
+    return ((canonical(histogram.expression()), histogram.binning()),
+            tuple((canonical(h.expression()), h.binning()) for h in group))
+
+
+def bin_edges(binning):
+    """Converts a owls-hep binning specification to a tuple of bin edges.
+
+    Args:
+        binning: Either a (bins, low, high) tuple, a tuple of bin edges, or a
+            ('custom', edge, edge, edge) tuple
+
+    Returns:
+        A tuple of bin edges.
+    """
+    if binning[0] == 'custom':
+        return tuple(float(e) for e in binning[1:])
+    if len(binning) == 3:
+        bins, low, high = binning
+        width = (high - low) / float(bins)
+        return tuple(low + i * width for i in range(bins)) + (float(high),)
+    return tuple(float(e) for e in binning)
+
+
+# The number of combined histograms to keep in memory
+MEMOIZED_HISTOGRAMS = 64
+
+_memoized_histograms = OrderedDict()
+
+def _recalled(key):
+    # Look up a result kept in memory, marking it as most recently used.
+    # Raises KeyError if there is none.
+    result = _memoized_histograms.pop(key)
+    _memoized_histograms[key] = result
+    return result
+
+def _remember(key, result):
+    # Keep a result in memory, evicting the least recently used one
+    _memoized_histograms.pop(key, None)
+    if len(_memoized_histograms) >= MEMOIZED_HISTOGRAMS:
+        _memoized_histograms.popitem(last = False)
+    _memoized_histograms[key] = result
+
+def _memoized(function):
+    """Decorator to keep the most recently used results of a function in
+    memory, keyed on its (hashable) arguments.
+
+    NOTE: This has to be applied below @parallelized, so that fake values
+    returned while capturing never end up in memory.
+    """
+    @wraps(function)
+    def wrapper(*args):
+        key = (function.__name__,) + args
+        try:
+            return _recalled(key)
+        except KeyError:
+            result = function(*args)
+        _remember(key, result)
+        return result
+    return wrapper
+
+
+def _persisted(name, process, arguments, distribution, fill):
+    """Looks up the result of a distribution in the persistent cache.
+
+    The cache is keyed on name and the (process, arguments, distribution)
+    only, so that the fill function (which may fill other distributions as
+    well) is not part of the key.
+
+    Args:
+        name: The name of the cache
+        process: The process
+        arguments: A tuple of the further arguments of the fill
+        distribution: The (expression, binning) of the distribution
+        fill: A function without arguments, which computes the result if it
+            is not cached
+
+    Returns:
+        The cached or computed result.
+    """
+    return persistently_cached(name)(lambda p, a, d: fill())(process,
+                                                             arguments,
+                                                             distribution)
+
+
+def _per_distribution(name):
+    """Decorator to cache the results of a group fill per distribution.
+
+    The decorated function is called with a process, any number of further
+    arguments and a tuple of distributions, and returns a list with one
+    result per distribution. The returned function is called with the
+    process, the same further arguments, a single distribution and the group
+    of distributions which should be filled together with it, and returns the
+    result of the single distribution.
+
+    Results are cached per distribution, both persistently (under name) and
+    in memory, so that the group is not part of the key: distributions which
+    are cached are never filled again when the group changes. If a
+    distribution isn't cached, it is filled together with all other
+    distributions of its group which aren't in memory yet, and each of their
+    results is cached separately.
+
+    NOTE: This has to be applied below @parallelized, so that fake values
+    returned while capturing never end up in memory.
+    """
+    def decorator(function):
+        @wraps(function)
+        def wrapper(*args):
+            process, arguments = args[0], tuple(args[1:-2])
+            distribution, group = args[-2:]
+            key = (name, process, arguments, distribution)
+            try:
+                return _recalled(key)
+            except KeyError:
+                pass
+
+            def fill():
+                # Fill the distribution along with the distributions of its
+                # group whose results aren't in memory
+                filled = [distribution]
+                for d in group:
+                    if d not in filled and (name, process, arguments, d) \
+                            not in _memoized_histograms:
+                        filled.append(d)
+                results = function(*((process,)
+                                     + arguments
+                                     + (tuple(filled),)))
+
+                # Cache the other distributions of the group, which keeps
+                # the stored results of distributions which are already
+                # cached persistently
+                for d, result in zip(filled[1:], results[1:]):
+                    _remember((name, process, arguments, d),
+                              _persisted(name,
+                                         process,
+                                         arguments,
+                                         d,
+                                         lambda: result))
+                return results[0]
+
+            result = _persisted(name, process, arguments, distribution, fill)
+            _remember(key, result)
+            return result
+        return wrapper
+    return decorator
+
+
+def _canonical_selection(process, region):
+    # Build the weighted selection in canonical form, so that equivalent
+    # regions (e.g. with the same cuts applied in a different order) share
+    # cached histograms
+    return canonical(make_selection(process, region))
+
+
+def _create_categorized(binning, count):
+    # Create a uniquely named histogram with count categories on the Y axis
+    name = uuid4().hex
+    edges = bin_edges(binning)
+    histogram = TH2D(name, name,
+                     len(edges) - 1, array('d', edges),
+                     count, -0.5, count - 0.5)
+    histogram.Sumw2()
+    return histogram
+
+
+def _projected(combined, histogram, count):
+    # Project out each category, including under- and overflow along X
+    result = []
+    for i in range(count):
+        projection = combined.ProjectionX(uuid4().hex, i + 1, i + 1, 'e')
+        projection.SetDirectory(0)
+        projection.SetTitle(histogram.title())
+        if histogram.include_overflow():
+            add_overflow_to_last_bin(projection)
+        result.append(projection)
+    return result
+
+
+@_memoized
+@persistently_cached('owls_mutau.histogramming._cut_bits')
+def _cut_bits(process, cuts):
+    """Evaluates the bitmask of a set of atomic cuts for all events of a
+    process.
+
+    Args:
+        process: The process whose events should be evaluated
+        cuts: A tuple of (name, expression) tuples of the atomic cuts
+
+    Returns:
+        An array of unsigned 64-bit masks, or None if any of the cuts reads
+        a branch which isn't a scalar.
+    """
+    mask = CutMask(cuts)
+    data = tree2array(process.load(), branches = list(mask.branches()))
+    columns = dict((b, data[b]) for b in mask.branches())
+    if not _scalar(columns):
+        return None
+    return mask.evaluate(columns, len(data))
+
+
+# The bitmasks of the atomic cuts, keyed on the atomic cuts
+_masks = {}
+
+def _mask():
+    """Creates the bitmask of the atomic cuts which can be vectorized.
+
+    Atomic cuts which can't be compiled (and any cuts beyond MAXIMUM_CUTS)
+    are left out of the mask, so that selections containing them evaluate
+    these cuts as ordinary terms of the residual expression.
+
+    Returns:
+        The CutMask, or None if there are no vectorizable atomic cuts.
+    """
+    cuts = tuple(iteritems(atomic))
+    if cuts not in _masks:
+        vectorizable = []
+        for name, expression in cuts:
+            try:
+                compiled(expression)
+            except UnsupportedExpression:
+                continue
+            vectorizable.append((name, expression))
+        _masks[cuts] = CutMask(vectorizable[:MAXIMUM_CUTS]) \
+                if len(vectorizable) > 0 else None
+    return _masks[cuts]
+
+
+def _scalar(columns):
+    # Check whether loaded columns are plain scalars. Vector and array
+    # branches are loaded as object or multi-dimensional arrays, which the
+    # kernels can't handle.
+    return all(c.dtype != object and c.ndim == 1 for c in itervalues(columns))
+
+
+def _interpreted(chain, expressions, base):
+    # Evaluate expressions with TTreeFormula, restricted to events passing
+    # the base (which is the first expression, if given). Repeated
+    # expressions (e.g. distributions with several binnings) are only
+    # evaluated once, and the fields are mapped back by position, since
+    # their names are derived from the expressions.
+    unique = list(OrderedDict.fromkeys(expressions))
+    data = tree2array(chain,
+                      branches = unique,
+                      selection = '({}) != 0'.format(base)
+                      if base is not None else None)
+    fields = dict((e, data[n].astype('float64'))
+                  for e, n
+                  in zip(unique, data.dtype.names))
+    return [fields[e] for e in expressions], len(data)
+
+
+def _vectorized(process, chain, expressions, base):
+    # Evaluate expressions with compiled kernels, see _evaluated. Returns
+    # None if they can't be vectorized.
+    mask = _mask()
+    queries = [mask.resolve(e) if mask is not None else (0, 0, e)
+               for e
+               in expressions]
+    try:
+        kernels = [compiled(r) for _, _, r in queries]
+    except UnsupportedExpression:
+        return None
+    branches = sorted(set(b for k in kernels for b in k.branches()))
+    if len(branches) > 0:
+        data = tree2array(chain, branches = branches)
+        columns = dict((b, data[b]) for b in branches)
+        size = len(data)
+    else:
+        columns = {}
+        size = chain.GetEntries()
+    if not _scalar(columns):
+        return None
+
+    bits = None
+    if any(required != 0 for required, _, _ in queries):
+        bits = _cut_bits(process, mask.cuts())
+        if bits is None:
+            return None
+
+    values = []
+    for (required, expected, _), kernel in zip(queries, kernels):
+        # Kernels may return the loaded columns themselves, so never modify
+        # their results in place
+        value = kernel(columns, size)
+        if required != 0:
+            value = value * query(bits, required, expected)
+        values.append(value)
+
+        # Restrict everything after the base to events passing it
+        if base is not None and len(values) == 1:
+            passed = value != 0
+            columns = dict((b, c[passed]) for b, c in iteritems(columns))
+            bits = bits[passed] if bits is not None else None
+            size = numpy.count_nonzero(passed)
+            values[0] = value[passed]
+    return values, size
+
+
+def _evaluated(process, expressions, base = None):
+    """Evaluates a list of expressions for all events of a process.
+
+    The raw branches read by the expressions are loaded in bulk and the
+    expressions are evaluated by compiled, vectorized kernels. Terms of the
+    expressions which are atomic cuts are not evaluated, but looked up in
+    the (cached) bitmask of the atomic cuts instead. Expressions which can't
+    be compiled or evaluated as vectors (e.g. because they read vector
+    branches) are interpreted by TTreeFormula.
+
+    Args:
+        process: The process whose events should be evaluated
+        expressions: The list of expressions
+        base: An optional selection, which is evaluated first. If given,
+            the expressions are only evaluated for events passing the base.
+
+    Returns:
+        A tuple of (values, size), where values is a list with an array of
+        doubles for each expression, and size is the number of events. If a
+        base is given, the values of the base itself are prepended, and only
+        events passing the base are included.
+    """
+    chain = process.load()
+    expressions = list(expressions)
+    if base is not None:
+        expressions = [base] + expressions
+    result = _vectorized(process, chain, expressions, base)
+    if result is None:
+        result = _interpreted(chain, expressions, base)
+    return result
+
+
+def _lattice(binnings):
+    """Computes the lattice of a set of binnings, i.e. the union of their bin
+    edges.
+
+    Every bin of the lattice (including under- and overflow) lies entirely
+    within one bin of each of the binnings, so that the histograms of all of
+    them can be derived exactly by merging the bins of a single histogram
+    filled with the lattice.
+
+    Args:
+        binnings: An iterable of binnings
+
+    Returns:
+        A sorted array of bin edges.
+    """
+    return numpy.array(sorted(set(e for b in binnings for e in bin_edges(b))))
+
+
+def _binned(edges, x, weights):
+    """Computes the sums of weights and squared weights in each bin, including
+    under- and overflow.
+
+    Args:
+        edges: The array of bin edges
+        x: The array of values
+        weights: A list of weight arrays, one per row
+
+    Returns:
+        A list of (sums, squares) array tuples, one per row, with the
+        underflow at index 0 and the overflow at index len(edges).
+    """
+    indices = numpy.searchsorted(edges, x, side = 'right')
+    return [(numpy.bincount(indices, weights = w, minlength = len(edges) + 1),
+             numpy.bincount(indices, weights = w * w,
+                            minlength = len(edges) + 1))
+            for w
+            in weights]
+
+
+def _merged(lattice, edges, rows):
+    """Merges bins filled with a lattice into the bins of a coarser binning.
+
+    Args:
+        lattice: The array of bin edges of the lattice
+        edges: The array of bin edges to merge into, which have to be a
+            subset of the lattice
+        rows: The (sums, squares) tuples of the lattice, as returned by
+            _binned
+
+    Returns:
+        The (sums, squares) tuples of the coarser binning.
+    """
+    # Map each lattice bin (by its lower edge) onto the bin containing it
+    lows = numpy.concatenate(([-numpy.inf], lattice))
+    target = numpy.searchsorted(edges, lows, side = 'right')
+    return [(numpy.bincount(target, weights = s, minlength = len(edges) + 1),
+             numpy.bincount(target, weights = q, minlength = len(edges) + 1))
+            for s, q
+            in rows]
+
+
+def _filled(distributions, values, weights):
+    """Creates and fills the combined histograms of a group of distributions.
+
+    Distributions which share an expression (e.g. tau_pt with different
+    binnings or ranges) are binned only once, using the lattice of all their
+    binnings, and each histogram is derived from it by merging bins.
+
+    Args:
+        distributions: A tuple of (expression, binning) tuples
+        values: A list of the arrays of the values of each expression
+        weights: A list of weight arrays, one per row
+
+    Returns:
+        A list of TH2D, one per distribution.
+    """
+    # Bin every expression once, with the lattice of all its binnings
+    binnings = OrderedDict()
+    for (expression, binning), x in zip(distributions, values):
+        binnings.setdefault(expression, (x, []))[1].append(binning)
+    lattices = {}
+    for expression, (x, bs) in iteritems(binnings):
+        lattice = _lattice(bs)
+        lattices[expression] = (lattice, _binned(lattice, x, weights))
+
+    # Merge the bins into each requested binning
+    result = []
+    for expression, binning in distributions:
+        lattice, rows = lattices[expression]
+        edges = numpy.array(bin_edges(binning))
+        if len(edges) != len(lattice) or any(edges != lattice):
+            rows = _merged(lattice, edges, rows)
+        histogram = _create_categorized(binning, len(weights))
+        _fill(histogram, rows)
+        result.append(histogram)
+    return result
+
+
+def _fill(histogram, rows):
+    """Fills the rows of a two-dimensional histogram, including under- and
+    overflow along X.
+
+    Args:
+        histogram: The TH2D to fill
+        rows: The (sums, squares) tuples of each row, as returned by _binned
+    """
+    for i, (sums, squares) in enumerate(rows):
+        for b in range(len(sums)):
+            histogram.SetBinContent(b, i + 1, sums[b])
+            histogram.SetBinError(b, i + 1, numpy.sqrt(squares[b]))
+
+
+# Dummy function to return fake values when parallelizing
+def _categorized_mocker(process, selection, categories, distribution, group):
+    return _create_categorized(distribution[1], len(categories))
+
+
+# Parallelization mapper batching on process and selection
+def _categorized_mapper(process, selection, categories, distribution, group):
+    return (process, selection)
+
+
+@parallelized(_categorized_mocker, _categorized_mapper)
+@_per_distribution('owls_mutau.histogramming._categorized_histogram')
+def _categorized_histogram(process, selection, categories, distributions):
+    """Histograms distributions of a process in a region, with the index of
+    the category an event belongs to on the Y axis.
+
+    This is cached per distribution (see _per_distribution), and called with
+    a single distribution and its group instead of the distributions.
+
+    Args:
+        process: The process whose events should be histogrammed
+        selection: The canonical weighted selection of the region
+        categories: A tuple of mutually exclusive selections
+        distributions: A tuple of (expression, binning) tuples
+
+    Returns:
+        A list of TH2D, one per distribution, with the expression on the X
+        axis and the category index on the Y axis.
+    """
+    if 'selection' in process.metadata().get('print_me', []):
+        print('Categorized selection for {}: {}'.format(process.label(),
+                                                        selection))
+
+    # Evaluate the selection, and the expressions and all categories for the
+    # selected events, on columns loaded in a single pass over the tree
+    count = len(distributions)
+    values, _ = _evaluated(process,
+                           [e for e, _ in distributions] \
+                           + [c for c in categories if c],
+                           base = selection)
+    weight, selected = values[0], iter(values[1 + count:])
+    weights = [weight * (next(selected) != 0) if c else weight
+               for c
+               in categories]
+
+    # Histogram all distributions and categories
+    result = _filled(distributions, values[1:1 + count], weights)
+    for histogram in result:
+        histogram.SetEntries(numpy.count_nonzero(weight))
+    return result
+
+
+def categorized(process, region, histogram, categories):
+    """Fills a histogram of a process in a region for several mutually
+    exclusive categories in a single pass.
+
+    Args:
+        process: The process whose events should be histogrammed
+        region: The region whose weighted selection should be used
+        histogram: The owls-mutau Histogram to fill
+        categories: A tuple of mutually exclusive selections, where an empty
+            selection selects all events
+
+    Returns:
+        A list of one-dimensional histograms, one per category. The
+        histograms are copies and may be scaled freely.
+    """
+    selection = _canonical_selection(process, region)
+    distribution, group = _grouped(histogram)
+    combined = _categorized_histogram(process,
+                                      selection,
+                                      tuple(canonical(c) if c else c
+                                            for c
+                                            in categories),
+                                      distribution,
+                                      group)
+    return _projected(combined, histogram, len(categories))
+
+
+# Dummy function to return fake values when parallelizing
+def _family_mocker(process, selections, distribution, group):
+    return _create_categorized(distribution[1], len(selections))
+
+
+# Parallelization mapper batching on process and selections
+def _family_mapper(process, selections, distribution, group):
+    return (process, selections)
+
+
+@parallelized(_family_mocker, _family_mapper)
+@_per_distribution('owls_mutau.histogramming._family_histogram')
+def _family_histogram(process, selections, distributions):
+    """Histograms distributions of a process in a family of regions, with the
+    index of the region on the Y axis.
+
+    The part of the selections which all regions share is evaluated once,
+    and the remaining cuts of each region are only evaluated for events
+    passing it.
+
+    This is cached per distribution (see _per_distribution), and called with
+    a single distribution and its group instead of the distributions.
+
+    Args:
+        process: The process whose events should be histogrammed
+        selections: A tuple of the canonical weighted selections of the
+            regions
+        distributions: A tuple of (expression, binning) tuples
+
+    Returns:
+        A list of TH2D, one per distribution, with the expression on the X
+        axis and the region index on the Y axis.
+    """
+    try:
+        base, residuals = shared(selections)
+    except ValueError:
+        base, residuals = '1', list(selections)
+
+    if 'selection' in process.metadata().get('print_me', []):
+        print('Family base selection for {}: {}'.format(process.label(),
+                                                        base))
+
+    count = len(distributions)
+    values, _ = _evaluated(process,
+                           [e for e, _ in distributions] + residuals,
+                           base = base)
+    weight = values[0]
+
+    result = _filled(distributions,
+                     values[1:1 + count],
+                     [weight * r for r in values[1 + count:]])
+    for histogram in result:
+        histogram.SetEntries(numpy.count_nonzero(weight))
+    return result
+
+
+def family_filled(process, regions, histogram):
+    """Fills a histogram of a process in a family of regions (see
+    owls_mutau.regions) in a single pass.
+
+    Args:
+        process: The process whose events should be histogrammed
+        regions: The list of regions of the family
+        histogram: The owls-mutau Histogram to fill
+
+    Returns:
+        A list of one-dimensional histograms, one per region. The histograms
+        are copies and may be scaled freely.
+    """
+    selections = tuple(_canonical_selection(process, r) for r in regions)
+    distribution, group = _grouped(histogram)
+    combined = _family_histogram(process, selections, distribution, group)
+    return _projected(combined, histogram, len(selections))
+
+
+def _weight_factors(selection, systematics):
+    """Resolves the weight factors that weight systematics vary in a
+    selection.
+
+    The nominal factors are regular expressions (exactly as used by
+    ReplaceWeight), so the factors actually present in the selection are
+    looked up, and the up/down templates are expanded against them.
+
+    Args:
+        selection: The weighted selection string
+        systematics: A tuple of (name, nominal, up, down) tuples
+
+    Returns:
+        A tuple of (unweighted, nominal_factors, variations), where
+        unweighted is the selection with every varied nominal factor replaced
+        by 1, nominal_factors is a dictionary mapping each nominal pattern to
+        the list of factors it matched, and variations is a list of (nominal,
+        up_factors, down_factors) tuples in the order of systematics.
+    """
+    unweighted = selection
+    nominal_factors = OrderedDict()
+    variations = []
+    for _, nominal, up, down in systematics:
+        matches = list(re.finditer(nominal, selection))
+        if nominal not in nominal_factors:
+            nominal_factors[nominal] = [m.group(0) for m in matches]
+            unweighted = re.sub(nominal, '(1)', unweighted)
+        variations.append((nominal,
+                           [m.expand(up) for m in matches],
+                           [m.expand(down) for m in matches]))
+    return unweighted, nominal_factors, variations
+
+
+def _product(columns, factors, size):
+    # Multiply the columns of a list of factors
+    result = numpy.ones(size)
+    for factor in factors:
+        result *= columns[factor]
+    return result
+
+
+# Dummy function to return fake values when parallelizing
+def _weight_varied_mocker(process, selection, systematics, distribution,
+                          group):
+    return _create_categorized(distribution[1], 1 + 2 * len(systematics))
+
+
+# Parallelization mapper batching on process and selection
+def _weight_varied_mapper(process, selection, systematics, distribution,
+                          group):
+    return (process, selection)
+
+
+@parallelized(_weight_varied_mocker, _weight_varied_mapper)
+@_per_distribution('owls_mutau.histogramming._weight_varied_histogram')
+def _weight_varied_histogram(process, selection, systematics, distributions):
+    """Histograms distributions of a process in a region for the nominal
+    weight and every up/down variant of a set of weight systematics, in a
+    single pass over the tree.
+
+    NOTE: This assumes that the varied weight factors enter the weighted
+    selection multiplicatively, which is how event weights are composed.
+
+    This is cached per distribution (see _per_distribution), and called with
+    a single distribution and its group instead of the distributions.
+
+    Args:
+        process: The process whose events should be histogrammed
+        selection: The canonical weighted selection of the region
+        systematics: A tuple of (name, nominal, up, down) tuples
+        distributions: A tuple of (expression, binning) tuples
+
+    Returns:
+        A list of TH2D, one per distribution, with the expression on the X
+        axis and the variation index on the Y axis, where index 0 is the
+        nominal weight and indices 2*i + 1 and 2*i + 2 are the up and down
+        variants of the i-th systematic.
+    """
+    unweighted, nominal_factors, variations = _weight_factors(selection,
+                                                              systematics)
+
+    if 'selection' in process.metadata().get('print_me', []):
+        print('Weight-varied selection for {}: {}'.format(process.label(),
+                                                          unweighted))
+
+    # Evaluate the expressions, the unweighted selection and all factors in a
+    # single pass, skipping events that fail the selection
+    count = len(distributions)
+    factors = []
+    for f in [f for fs in itervalues(nominal_factors) for f in fs] \
+             + [f for _, ups, downs in variations for f in ups + downs]:
+        if f not in factors:
+            factors.append(f)
+    values, size = _evaluated(process,
+                              [e for e, _ in distributions] + factors,
+                              base = unweighted)
+    columns = dict(zip([unweighted] + factors,
+                       values[:1] + values[1 + count:]))
+
+    # Compute the weights of each variation from the unweighted selection and
+    # the nominal factors of all other systematics
+    nominals = dict((n, _product(columns, fs, size))
+                    for n, fs
+                    in iteritems(nominal_factors))
+    weight = columns[unweighted]
+    nominal = weight.copy()
+    for value in itervalues(nominals):
+        nominal *= value
+    weights = [nominal]
+    for n, ups, downs in variations:
+        others = weight.copy()
+        for other, value in iteritems(nominals):
+            if other != n:
+                others *= value
+        weights.append(others * _product(columns, ups, size))
+        weights.append(others * _product(columns, downs, size))
+
+    # Histogram all distributions and variations
+    result = _filled(distributions, values[1:1 + count], weights)
+    for histogram in result:
+        histogram.SetEntries(size)
+        histogram.SetDirectory(0)
+
+    return result
+
+
+def weight_varied(process, region, histogram, systematics):
+    """Fills a histogram of a process in a region for the nominal weight and
+    every up/down variant of a set of weight systematics in a single pass.
+
+    Args:
+        process: The process whose events should be histogrammed
+        region: The region whose weighted selection should be used
+        histogram: The owls-mutau Histogram to fill
+        systematics: A tuple of (name, nominal, up, down) tuples, where
+            nominal is a regular expression matching the nominal weight
+            factor, and up and down are its replacements
+
+    Returns:
+        A tuple of (nominal, variations), where nominal is the nominal
+        histogram and variations is a dictionary mapping the name of each
+        systematic to its (up, down) histograms. The histograms are copies
+        and may be scaled freely.
+    """
+    systematics = tuple(tuple(s) for s in systematics)
+    selection = _canonical_selection(process, region)
+    distribution, group = _grouped(histogram)
+    combined = _weight_varied_histogram(process,
+                                        selection,
+                                        systematics,
+                                        distribution,
+                                        group)
+    histograms = _projected(combined,
+                            histogram,
+                            1 + 2 * len(systematics))
+    return histograms[0], dict(
+        (s[0], (histograms[2 * i + 1], histograms[2 * i + 2]))
+        for i, s
+        in enumerate(systematics)
+    )
+
+
+# Dummy function to return fake values when parallelizing
+def _tree_varied_mocker(process, selection, expression, binning, trees):
+    return _create_categorized(binning, len(trees))
+
+
+# Parallelization mapper batching on process and selection
+def _tree_varied_mapper(process, selection, expression, binning, trees):
+    return (process, selection)
+
+
+@parallelized(_tree_varied_mocker, _tree_varied_mapper)
+@_memoized
+@persistently_cached('owls_mutau.histogramming._tree_varied_histogram')
+def _tree_varied_histogram(process, selection, expression, binning, trees):
+    """Histograms a distribution of a process in a region for several
+    alternative trees, opening each input file only once.
+
+    The trees are read directly from the input files, which doesn't attach
+    the friend trees of the process. Processes with friend trees are thus
+    drawn tree by tree from the chains built by process.load(), which have
+    their friends attached.
+
+    Args:
+        process: The process whose events should be histogrammed
+        selection: The canonical weighted selection of the region
+        expression: The expression to histogram
+        binning: The binning of the expression
+        trees: A tuple of tree names
+
+    Returns:
+        A TH2D with the expression on the X axis and the index of the tree on
+        the Y axis.
+    """
+    if 'selection' in process.metadata().get('print_me', []):
+        print('Tree-varied selection for {}: {}'.format(process.label(),
+                                                        selection))
+
+    histogram = _create_categorized(binning, len(trees))
+
+    # Draw processes with friend trees tree by tree
+    if process.load().GetListOfFriends():
+        for i, name in enumerate(trees):
+            chain = process.retreed(name).load()
+            # Loading the chain (and its friends) may change the current
+            # directory, so keep the histogram where TTree.Draw looks for it
+            gROOT.cd()
+            histogram.SetDirectory(gROOT)
+            chain.Draw('{}:{}>>+{}'.format(i,
+                                           expression,
+                                           histogram.GetName()),
+                       selection,
+                       'goff')
+        histogram.SetDirectory(0)
+        return histogram
+
+    for path in process.files():
+        # Visit all trees while the file (and its read buffers) is open. The
+        # histogram has to live in the file for TTree.Draw to find it, and
+        # is detached again before the file is closed.
+        input_file = TFile.Open(path)
+        if not input_file or input_file.IsZombie():
+            raise RuntimeError('unable to open {}'.format(path))
+        histogram.SetDirectory(input_file)
+        for i, name in enumerate(trees):
+            tree = input_file.Get(name)
+            if not tree:
+                raise RuntimeError('unable to find tree {} in {}'. \
+                                   format(name, path))
+            tree.Draw('{}:{}>>+{}'.format(i, expression, histogram.GetName()),
+                      selection,
+                      'goff')
+        histogram.SetDirectory(0)
+        input_file.Close()
+
+    return histogram
+
+
+def tree_varied(process, region, histogram, trees):
+    """Fills a histogram of a process in a region for several alternative
+    trees, visiting all trees of an input file while it is open.
+
+    Args:
+        process: The process whose events should be histogrammed
+        region: The region whose weighted selection should be used
+        histogram: The owls-mutau Histogram to fill
+        trees: A tuple of tree names
+
+    Returns:
+        A dictionary mapping each tree name to its histogram. The histograms
+        are copies and may be scaled freely.
+    """
+    trees = tuple(trees)
+    selection = _canonical_selection(process, region)
+    combined = _tree_varied_histogram(process,
+                                      selection,
+                                      canonical(histogram.expression()),
+                                      histogram.binning(),
+                                      trees)
+    return dict(zip(trees, _projected(combined, histogram, len(trees))))
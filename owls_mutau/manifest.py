@@ -0,0 +1,186 @@
+"""Provides a content-addressed manifest of rendered plots for the mu+tau
+analysis.
+
+Rendering and writing plots (often in several formats) is a large part of the
+run time of the plotting tools, even when only a few of the plots changed. The
+manifest records a digest of the inputs of each plot (bin contents and
+errors, styles, labels, and plot options), so that rendering is skipped if
+the digest matches and all requested output files exist.
+
+Objects whose content can't be extracted contribute their (per-process)
+representation to the digest, so that plots drawing them are always
+re-rendered.
+"""
+
+# System imports
+import json
+from fcntl import flock, LOCK_EX, LOCK_UN
+from os import rename
+from os.path import join, exists, relpath
+from hashlib import sha1
+from uuid import uuid4
+
+# Six imports
+from six import iteritems, string_types
+
+# Set up default exports
+__all__ = [
+    'plot_digest',
+    'Manifest',
+]
+
+
+# The style attributes of ROOT objects which affect their rendering (names
+# are left out, since they are usually random)
+_STYLE_GETTERS = (
+    'GetTitle',
+    'GetLineColor',
+    'GetLineStyle',
+    'GetLineWidth',
+    'GetFillColor',
+    'GetFillStyle',
+    'GetMarkerColor',
+    'GetMarkerStyle',
+    'GetMarkerSize',
+    'GetMinimum',
+    'GetMaximum',
+)
+
+
+def _axis(axis):
+    # Extract the bin edges and labels of an axis
+    bins = axis.GetNbins()
+    return ([axis.GetBinLowEdge(b) for b in range(1, bins + 2)],
+            [axis.GetBinLabel(b) for b in range(1, bins + 1)],
+            axis.GetTitle())
+
+
+def _content(value):
+    """Converts a value into a representation of its rendered content.
+    """
+    if value is None or isinstance(value, (bool, int, float) + string_types):
+        return value
+    if isinstance(value, (list, tuple)):
+        return [_content(v) for v in value]
+    if isinstance(value, dict):
+        return sorted((_content(k), _content(v)) for k, v in iteritems(value))
+
+    # ROOT objects
+    result = [type(value).__name__]
+    result.extend((g, getattr(value, g)())
+                  for g
+                  in _STYLE_GETTERS
+                  if hasattr(value, g))
+    if hasattr(value, 'GetHists'):
+        # Stacks
+        hists = value.GetHists()
+        result.append([_content(h) for h in hists] if hists else [])
+    elif hasattr(value, 'GetSize') and hasattr(value, 'GetXaxis'):
+        # Histograms, including under- and overflow
+        bins = range(value.GetSize())
+        result.append([_axis(value.GetXaxis()),
+                       _axis(value.GetYaxis()),
+                       [value.GetBinContent(b) for b in bins],
+                       [value.GetBinError(b) for b in bins]])
+    elif hasattr(value, 'GetN'):
+        # Graphs
+        points = []
+        for i in range(value.GetN()):
+            point = [value.GetX()[i], value.GetY()[i]]
+            for g in ('GetErrorXlow', 'GetErrorXhigh',
+                      'GetErrorYlow', 'GetErrorYhigh'):
+                if hasattr(value, g):
+                    point.append(getattr(value, g)(i))
+            points.append(point)
+        result.append(points)
+    else:
+        result.append(repr(value))
+    return result
+
+
+def plot_digest(*inputs):
+    """Computes the digest of the inputs of a plot.
+
+    Args:
+        inputs: The drawables (histograms, stacks, graphs, ...), labels and
+            options of the plot, which may be nested in lists, tuples and
+            dictionaries
+
+    Returns:
+        A hex digest of the inputs.
+    """
+    return sha1(json.dumps(_content(list(inputs)),
+                           sort_keys = True).encode('utf-8')).hexdigest()
+
+
+class Manifest(object):
+    """A record of the input digests of the plots in an output directory.
+
+    Args:
+        directory: The output directory, in which the manifest is stored
+    """
+    NAME = 'manifest.json'
+    LOCK = 'manifest.lock'
+
+    def __init__(self, directory):
+        self._directory = directory
+        self._entries = self._load()
+        self._recorded = {}
+
+    def _load(self):
+        path = join(self._directory, self.NAME)
+        if not exists(path):
+            return {}
+        with open(path, 'r') as f:
+            return json.load(f)
+
+    def _key(self, path):
+        return relpath(path, self._directory)
+
+    def unchanged(self, path, extensions, digest):
+        """Checks whether a plot is up to date.
+
+        Args:
+            path: The output path of the plot, without extension
+            extensions: The extensions the plot is saved with
+            digest: The digest of the inputs of the plot
+
+        Returns:
+            True if the plot was rendered from the same inputs, and all
+            output files exist.
+        """
+        return self._entries.get(self._key(path)) == digest \
+                and all(exists('{}.{}'.format(path, e)) for e in extensions)
+
+    def record(self, path, digest):
+        """Records the digest of a rendered plot.
+
+        Args:
+            path: The output path of the plot, without extension
+            digest: The digest of the inputs of the plot
+        """
+        self._entries[self._key(path)] = digest
+        self._recorded[self._key(path)] = digest
+
+    def save(self):
+        """Writes the manifest, merging in entries written by others in the
+        meantime.
+
+        Writers (e.g. parallel plotting jobs) are serialized by a lock file,
+        so that none of them overwrites the entries of another.
+        """
+        if len(self._recorded) == 0:
+            return
+        with open(join(self._directory, self.LOCK), 'a') as lock:
+            flock(lock, LOCK_EX)
+            try:
+                entries = self._load()
+                entries.update(self._recorded)
+                self._entries = entries
+                temporary = join(self._directory, uuid4().hex + '.json')
+                with open(temporary, 'w') as f:
+                    json.dump(entries, f, indent = 1, sort_keys = True)
+                rename(temporary, join(self._directory, self.NAME))
+            finally:
+                flock(lock, LOCK_UN)
+        self._recorded = {}
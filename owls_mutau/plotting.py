@@ -3,8 +3,10 @@ region.
 """
 
 # System imports
+import atexit
 from uuid import uuid4
 from array import array
+from itertools import count
 
 # owls-parallel imports
 from owls_parallel import parallelized
@@ -12,19 +14,80 @@ from owls_parallel import parallelized
 # owls-hep imports
 from owls_hep.plotting import Plot, enable_fit
 
+# owls-mutau imports
+from owls_mutau.manifest import Manifest, plot_digest
+
 # Set up default exports
 __all__ = [
     'plot',
     'plot2d',
+    'save_manifests',
 ]
 
 # Dummy function to return fake values when parallelizing
 def _plotting_mocker(*args, **kwargs):
     return
 
-# Parallelization mapper batching on file path (i.e. one job per plot)
+# The number of plots to render in a single parallelized job. Rendering a
+# plot only takes a few milliseconds, so with one job per plot the dispatch
+# overhead dominates.
+PLOTS_PER_JOB = 50
+
+# Counter of the plots requested so far
+_plot_counter = count()
+
+# The manifests of rendered plots used by this process, keyed on their
+# directory. Each manifest is loaded once, and saved after every job (see
+# _finished) instead of after every plot.
+_manifests = {}
+
+# The number of plots handled by this process since the manifests were saved
+_unsaved_plots = count(1)
+
+def save_manifests():
+    """Saves the plots recorded in the manifests of this process.
+
+    This happens automatically after every job of PLOTS_PER_JOB plots and
+    when the process exits, but tools calling plot or plot2d directly may
+    call it once they're done.
+    """
+    global _unsaved_plots
+    for manifest in _manifests.values():
+        manifest.save()
+    _unsaved_plots = count(1)
+
+atexit.register(save_manifests)
+
+# Check a plot against a manifest of rendered plots, returning whether it is
+# up to date, along with the manifest and digest to record it with
+def _checked(drawables, path, kwargs):
+    directory = kwargs.get('manifest', None)
+    if directory is None:
+        return False, None, None
+    options = dict((k, v) for k, v in kwargs.items() if k != 'manifest')
+    if directory not in _manifests:
+        _manifests[directory] = Manifest(directory)
+    manifest = _manifests[directory]
+    digest = plot_digest(drawables, options)
+    extensions = kwargs.get('extensions', ['pdf'])
+    return manifest.unchanged(path, extensions, digest), manifest, digest
+
+# Record a rendered plot in a manifest
+def _record(manifest, path, digest):
+    if manifest is not None:
+        manifest.record(path, digest)
+
+# Count a handled (rendered or skipped) plot, and save the manifests once a
+# job's worth of plots is handled, since the mapper hands out consecutive
+# plots in jobs of PLOTS_PER_JOB
+def _finished():
+    if next(_unsaved_plots) >= max(PLOTS_PER_JOB, 1):
+        save_manifests()
+
+# Parallelization mapper batching consecutive plots (i.e. one job per
+# PLOTS_PER_JOB plots)
 def _plotting_mapper(drawables, path, *args, **kwargs):
-    return hash(path)
+    return next(_plot_counter) // max(PLOTS_PER_JOB, 1)
 
 @parallelized(_plotting_mocker, _plotting_mapper, parallel_pass=2)
 def plot(drawables_styles_options, path, *args, **kwargs):
@@ -43,7 +106,17 @@ def plot(drawables_styles_options, path, *args, **kwargs):
         atlas_label: ''
         extensions: ['pdf']
         enable_fit: None,
+        manifest: None (the directory of a manifest of rendered plots, in
+            which case rendering is skipped if the inputs are unchanged)
     """
+    # Skip the plot if it is up to date
+    up_to_date, manifest, digest = _checked(drawables_styles_options,
+                                            path,
+                                            kwargs)
+    if up_to_date:
+        _finished()
+        return
+
     # Create a plot
     x_label = kwargs.get('x_label', '')
     y_label = kwargs.get('y_label', '')
@@ -82,6 +155,8 @@ def plot(drawables_styles_options, path, *args, **kwargs):
 
     # Save
     plot.save(path, extensions)
+    _record(manifest, path, digest)
+    _finished()
 
 @parallelized(_plotting_mocker, _plotting_mapper, parallel_pass=2)
 def plot2d(drawable, path, *args, **kwargs):
@@ -96,7 +171,15 @@ def plot2d(drawable, path, *args, **kwargs):
         y_label: ''
         title: ''
         options: 'COLZ'
+        manifest: None (the directory of a manifest of rendered plots, in
+            which case rendering is skipped if the inputs are unchanged)
     """
+    # Skip the plot if it is up to date
+    up_to_date, manifest, digest = _checked(drawable, path, kwargs)
+    if up_to_date:
+        _finished()
+        return
+
     # Create a plot
     x_label = kwargs.get('x_label', '')
     y_label = kwargs.get('y_label', '')
@@ -120,3 +203,5 @@ def plot2d(drawable, path, *args, **kwargs):
 
     # Save
     plot.save(path, extensions)
+    _record(manifest, path, digest)
+    _finished()
@@ -0,0 +1,279 @@
+"""Provides automatic pruning of systematic uncertainties for the mu+tau
+analysis.
+
+Before the full set of histograms is computed, the effect of each systematic
+uncertainty on a sample is measured in a cheap pass: on a single-bin yield
+histogram and, optionally, bin by bin on one coarse reference distribution
+(see coarse). Systematics whose relative shifts of the yield and of every
+reference bin are below a threshold, or below a fraction of the respective
+statistical uncertainty, are pruned, so that their shape histograms of the
+plotted distributions (which would be invisible in the uncertainty band
+anyway) are never computed. Comparing reference bins as well as yields keeps
+shape-only systematics (e.g. the muon momentum scale), which move events
+between bins but leave the yield almost unchanged.
+
+The reference distribution has a binning of its own, so it is not filled
+together with the plotted distributions (see
+owls_mutau.histogramming.fill_together), and the measurement only costs two
+small histograms per systematic, sample and region.
+"""
+
+# System imports
+from itertools import product
+
+# Six imports
+from six import iteritems
+
+# numpy imports
+import numpy
+
+# owls-mutau imports
+from owls_mutau.histogramming import Histogram, bin_edges
+
+# Set up default exports
+__all__ = [
+    'yield_histogram',
+    'REFERENCE_BINS',
+    'coarse',
+    'Pruning',
+    'measure',
+]
+
+
+# A single-bin histogram containing the event yield
+yield_histogram = Histogram('1', (1, 0.5, 1.5), 'Yield', 'Yield', 'Events')
+
+
+# The maximum number of bins of coarse reference distributions
+REFERENCE_BINS = 4
+
+
+def coarse(histogram, bins = None):
+    """Creates a coarse reference distribution for measuring the shape
+    effects of systematics.
+
+    Args:
+        histogram: The owls-mutau Histogram, usually one of the plotted
+            distributions
+        bins: The maximum number of bins, by default REFERENCE_BINS
+
+    Returns:
+        A Histogram of the same expression, whose bins are formed by merging
+        adjacent bins of the histogram. Histograms which are not finer than
+        that are returned as they are.
+    """
+    bins = bins or REFERENCE_BINS
+    edges = bin_edges(histogram.binning())
+    if len(edges) - 1 <= bins:
+        return histogram
+    indices = numpy.unique(numpy.round(numpy.linspace(0, len(edges) - 1,
+                                                      bins + 1)).astype(int))
+    return Histogram(histogram.expression(),
+                     ('custom',) + tuple(edges[i] for i in indices),
+                     histogram.title(),
+                     '',
+                     'Events',
+                     include_overflow = histogram.include_overflow())
+
+
+def _contents(histogram):
+    # Extract the bin contents and errors, including under- and overflow
+    bins = range(histogram.GetSize())
+    return ([histogram.GetBinContent(b) for b in bins],
+            [histogram.GetBinError(b) for b in bins])
+
+
+class Pruning(object):
+    """Records the effects of systematic uncertainties and decides which of
+    them to prune.
+
+    A systematic is kept if, in any measured distribution of a sample (the
+    yield histogram or the reference distribution), its larger up or down
+    shift relative to the nominal yield, or relative to the nominal content
+    of any bin, is at least relative_threshold, and at least stat_threshold
+    times the relative statistical uncertainty of that yield or bin content.
+    Either threshold may be None to disable it.
+    """
+    def __init__(self, relative_threshold = None, stat_threshold = None):
+        self._relative_threshold = relative_threshold
+        self._stat_threshold = stat_threshold
+        self._measurements = {}
+
+    def enabled(self):
+        return self._relative_threshold is not None \
+                or self._stat_threshold is not None
+
+    def record(self, region_name, sample_name, nominal, results):
+        """Records the effects of a set of systematics on a distribution.
+
+        Measurements of several distributions of the same region and sample
+        are combined, keeping a systematic if it is significant in any of
+        them.
+
+        Args:
+            region_name: The name of the region
+            sample_name: The name of the sample
+            nominal: The nominal histogram
+            results: A list of (uncertainty, result) tuples, where result is
+                the (overall_up, overall_down, shape_up, shape_down) tuple
+                computed on the histogram
+        """
+        contents, errors = _contents(nominal)
+        count = sum(contents)
+        stat = sum(e * e for e in errors) ** 0.5
+        for uncertainty, result in results:
+            overall_up, overall_down, shape_up, shape_down = result
+            shifted = [_contents(s)[0]
+                       for s
+                       in (shape_up, shape_down)
+                       if s is not None]
+            factors = [abs(f - 1.0)
+                       for f
+                       in (overall_up, overall_down)
+                       if f is not None]
+
+            # The relative effect on the yield
+            size = None
+            keep = False
+            if count != 0.0 and (shifted or factors):
+                size = max([abs(sum(s) / count - 1.0) for s in shifted]
+                           + factors)
+                keep = self._significant(size, stat / abs(count))
+
+            # The largest relative shift of any bin, and whether any bin is
+            # shifted significantly
+            shift = 0.0
+            for b, (content, error) in enumerate(zip(contents, errors)):
+                if content == 0.0:
+                    continue
+                bin_shift = max([abs(s[b] / content - 1.0) for s in shifted]
+                                + factors + [0.0])
+                shift = max(shift, bin_shift)
+                if self._significant(bin_shift, error / abs(content)):
+                    keep = True
+            if not any(c != 0.0 for c in contents):
+                # Without a nominal there is nothing to compare to, so keep
+                # the systematic
+                shift = None
+                keep = True
+
+            key = (region_name, sample_name, uncertainty.name)
+            previous = self._measurements.get(key)
+            if previous is None:
+                self._measurements[key] = (count, stat, size, shift, keep)
+                continue
+            shifts = [s for s in (shift, previous[3]) if s is not None]
+            self._measurements[key] = previous[:3] + (
+                max(shifts) if shifts else None,
+                keep or previous[4]
+            )
+
+    def _significant(self, size, relative_stat):
+        if self._relative_threshold is not None \
+                and size < self._relative_threshold:
+            return False
+        if self._stat_threshold is not None \
+                and size < self._stat_threshold * relative_stat:
+            return False
+        return True
+
+    def kept(self, uncertainties, sample_name, *region_names):
+        """Filters a list of uncertainties of a sample.
+
+        Args:
+            uncertainties: The list of uncertainties
+            sample_name: The name of the sample
+            region_names: The names of the regions; an uncertainty is kept if
+                it is significant in any of them
+
+        Returns:
+            The uncertainties which are not pruned. Uncertainties which have
+            not been measured are always kept.
+        """
+        result = []
+        for u in uncertainties:
+            decisions = [self._measurements.get((r, sample_name, u.name))
+                         for r
+                         in region_names]
+            if any(d is None or d[4] for d in decisions):
+                result.append(u)
+        return result
+
+    def write_report(self, path):
+        """Writes the measured effects and pruning decisions to a text file.
+
+        The yield columns refer to the first measured distribution, and the
+        bin column is the largest relative shift of any bin in any measured
+        distribution.
+
+        Args:
+            path: The path of the report
+        """
+        with open(path, 'w') as f:
+            f.write('Relative threshold: {}\n'. \
+                    format(self._relative_threshold))
+            f.write('Statistical threshold: {}\n\n'. \
+                    format(self._stat_threshold))
+            f.write('{:30s} {:20s} {:25s} {:>12s} {:>10s} {:>8s} {:>8s} '
+                    '{:>8s} {}\n'.format('Region', 'Sample', 'Systematic',
+                                         'Yield', 'Stat', 'Stat %', 'Syst %',
+                                         'Bin %', 'Decision'))
+            for (region_name, sample_name, name), \
+                    (count, stat, size, shift, keep) \
+                    in sorted(iteritems(self._measurements)):
+                f.write('{:30s} {:20s} {:25s} {:12.1f} {:10.1f} {:8.3f} '
+                        '{:>8s} {:>8s} {}\n'. \
+                        format(region_name,
+                               sample_name,
+                               name,
+                               count,
+                               stat,
+                               stat / abs(count) * 100.0 if count else 0.0,
+                               '{:.3f}'.format(size * 100.0)
+                               if size is not None else '-',
+                               '{:.3f}'.format(shift * 100.0)
+                               if shift is not None else '-',
+                               'kept' if keep else 'pruned'))
+
+
+def measure(parallel, pruning, regions, samples, reference = None):
+    """Runs the measurement pass for all regions and samples and records the
+    results.
+
+    Args:
+        parallel: The ParallelizedEnvironment to run in. This should be a
+            separate environment from the one used for the full computation.
+        pruning: The Pruning instance to record the results in
+        regions: A dictionary mapping region names to regions
+        samples: A dictionary mapping sample names to dictionaries with
+            'process', 'estimation', and (optionally) 'uncertainties' keys
+        reference: An optional coarse reference distribution (see coarse),
+            on which the effects are measured bin by bin in addition to the
+            single-bin yield histogram
+    """
+    distributions = [yield_histogram]
+    if reference is not None:
+        distributions.append(reference)
+    while parallel.run():
+        for (region_name, region), (sample_name, sample), distribution \
+                in product(iteritems(regions),
+                           iteritems(samples),
+                           distributions):
+            process = sample['process']
+            estimation = sample['estimation']
+            uncertainties = sample.get('uncertainties', [])
+            if len(uncertainties) == 0:
+                continue
+
+            # Compute the nominal and varied histograms
+            nominal = estimation(distribution)(process, region)
+            results = [(u, estimation(u(distribution))(process, region))
+                       for u
+                       in uncertainties]
+
+            # If we're in capture mode, the histograms are bogus, so ignore
+            # them
+            if parallel.capturing():
+                continue
+
+            pruning.record(region_name, sample_name, nominal, results)
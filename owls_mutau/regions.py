@@ -0,0 +1,99 @@
+"""Provides region families for the mu+tau analysis.
+
+Most regions are variations of a base region which only add a few cuts to its
+selection (e.g. mu_tau_tau25_1p_os is mu_tau with the tau25, 1-prong and OS
+cuts). A region family groups a base region with all its variations. When a
+family is enabled, histograms of any of its regions are filled for all regions
+of the family in a single pass, where the selection the regions share is
+evaluated only once (see owls_mutau.histogramming.family_filled).
+"""
+
+# System imports
+from collections import OrderedDict
+
+# Six imports
+from six import itervalues
+
+# Set up default exports
+__all__ = [
+    'RegionFamily',
+    'family_of',
+]
+
+
+# The enabled region families
+_enabled = []
+
+
+class RegionFamily(object):
+    """A base region and its variations.
+
+    Args:
+        name: The name of the family, which is the name of the base region
+    """
+    def __init__(self, name):
+        self._name = name
+        self._regions = OrderedDict()
+
+    def name(self):
+        return self._name
+
+    def add(self, name, region):
+        """Adds a region to the family.
+
+        Args:
+            name: The name of the region
+            region: The region
+        """
+        self._regions[name] = region
+
+    def names(self):
+        """Returns a list of the names of all regions of the family.
+        """
+        return list(self._regions)
+
+    def named_regions(self):
+        """Returns an ordered dictionary mapping region names to regions.
+        """
+        return OrderedDict(self._regions)
+
+    def regions(self):
+        """Returns a list of all regions of the family.
+        """
+        return list(itervalues(self._regions))
+
+    def index(self, region):
+        """Finds the index of a region within the family.
+
+        Regions are matched by identity, since the family is only used for
+        the very region objects it was built with.
+
+        Returns:
+            The index of the region, or None if it isn't part of the family.
+        """
+        for i, r in enumerate(itervalues(self._regions)):
+            if r is region:
+                return i
+        return None
+
+    def enable(self):
+        """Fills the regions of the family together from now on.
+        """
+        if self not in _enabled:
+            _enabled.append(self)
+
+
+def family_of(region):
+    """Finds the enabled family of a region.
+
+    Args:
+        region: The region
+
+    Returns:
+        The RegionFamily, or None if the region isn't part of an enabled
+        family.
+    """
+    for family in _enabled:
+        if family.index(region) is not None:
+            return family
+    return None
@@ -0,0 +1,274 @@
+"""Provides rendering of data/model comparison plots, either in the main
+process or in a pool of render workers.
+
+Render workers must be started before PyROOT is initialized, so that they
+don't inherit its state, and thus this module only imports ROOT-based
+modules inside the functions which need them. Plots are handed to the
+workers as plain values: the ROOT objects of a plot are serialized into a
+temporary ROOT file (see serialized), which the worker reads back (see
+render_serialized).
+"""
+
+# System imports
+from os import close, remove
+from tempfile import mkstemp
+from itertools import count
+
+# Six imports
+from six import iteritems
+
+# Set up default exports
+__all__ = [
+    'style',
+    'render',
+    'serialized',
+    'render_serialized',
+]
+
+
+def style(publish = False):
+    """Sets up the plot style.
+
+    Args:
+        publish: Whether or not to use the style of public tau trigger plots
+    """
+    # owls-hep imports
+    from owls_hep.plotting import Plot
+
+    Plot.PLOT_HEADER_HEIGHT = 500
+    Plot.PLOT_LEGEND_LEFT = 0.70
+
+    # Style for tau triger public plots
+    # TODO: Plotting style should be more configurable
+    if publish:
+        Plot.PLOT_MARGINS_WITH_RATIO = (0.125, 0.025, 0.025, 0.025)
+        Plot.PLOT_RATIO_MARGINS = (0.125, 0.025, 0.325, 0.035)
+        Plot.PLOT_HEADER_HEIGHT = 450 # px
+        Plot.PLOT_LEGEND_TOP_WITH_RATIO = 0.95
+        Plot.PLOT_LEGEND_LEFT = 0.62
+        Plot.PLOT_LEGEND_TEXT_SIZE_WITH_RATIO = 0.055
+        Plot.PLOT_LEGEND_ROW_SIZE_WITH_RATIO = 0.08
+        Plot.PLOT_ATLAS_STAMP_TOP_WITH_RATIO = 0.88
+        Plot.PLOT_ATLAS_STAMP_LEFT = 0.18
+        Plot.PLOT_ATLAS_STAMP_TEXT_SIZE_WITH_RATIO = 0.065
+        Plot.PLOT_RATIO_Y_AXIS_MINIMUM = 0.6
+        Plot.PLOT_RATIO_Y_AXIS_MAXIMUM = 1.4
+        Plot.PLOT_RATIO_Y_AXIS_NDIVISIONS = 204
+
+        Plot.PLOT_ERROR_BAND_FILL_STYLE = 3013
+        Plot.PLOT_ERROR_BAND_FILL_COLOR = 1
+        Plot.PLOT_RATIO_ERROR_BAND_FILL_STYLE = 3001
+        Plot.PLOT_RATIO_ERROR_BAND_FILL_COLOR = 632
+
+
+def render(job):
+    """Renders and saves a plot.
+
+    Args:
+        job: A tuple of (plot_output_path, x_label, y_label, label, settings,
+            data_histogram, signal_histograms, signal_histogram,
+            signal_uncertainty_bands, background_histograms,
+            background_histogram, background_uncertainty_bands), where
+            settings is a dictionary of the plain plot settings ratio,
+            subtract_background, error_label, ratio_title, label,
+            atlas_label, luminosity, sqrt_s, extensions and publish
+
+    Returns:
+        The plot output path.
+    """
+    # owls-hep imports
+    from owls_hep.uncertainty import combined_uncertainty_band, \
+        ratio_uncertainty_band
+    from owls_hep.plotting import Plot, histogram_stack, ratio_histogram
+
+    plot_output_path, x_label, y_label, label, settings, \
+            data_histogram, signal_histograms, signal_histogram, \
+            signal_uncertainty_bands, background_histograms, \
+            background_histogram, background_uncertainty_bands = job
+
+    # Set up the style
+    style(settings['publish'])
+
+    # Create a plot
+    plot = Plot('',
+                x_label,
+                y_label,
+                ratio = settings['ratio'])
+
+    # Plot data with background subtraction vs signal
+    if signal_histogram is not None and settings['subtract_background']:
+        # Create a signal stack
+        signal_stack = histogram_stack(*signal_histograms)
+
+        # Compute combined uncertainties on the signal
+        uncertainty = combined_uncertainty_band(
+            signal_uncertainty_bands,
+            signal_histogram,
+            settings['error_label']
+        )
+        ratio_uncertainty = ratio_uncertainty_band(
+            signal_histogram,
+            uncertainty
+        )
+
+        # Subtract background from data
+        data_histogram = data_histogram - background_histogram
+
+        # Draw the histograms
+        plot.draw(((signal_stack, uncertainty), None, 'hist'),
+                  (data_histogram, None, 'ep'))
+
+        # Draw the ratio plot
+        if data_histogram is not None:
+            ratio = ratio_histogram(data_histogram,
+                                    signal_stack,
+                                    settings['ratio_title'])
+            plot.draw_ratio_histogram(ratio,
+                                      error_band = ratio_uncertainty)
+
+        legend_entries = (data_histogram,
+                          signal_stack,
+                          uncertainty)
+
+    # Plot data vs background model with optional signal overlay
+    else:
+
+        # Create a background stack
+        background_stack = histogram_stack(*background_histograms)
+
+        # Compute combined uncertainties
+        uncertainty = combined_uncertainty_band(
+            background_uncertainty_bands,
+            background_histogram,
+            settings['error_label']
+        )
+        ratio_uncertainty = ratio_uncertainty_band(
+            background_histogram,
+            uncertainty
+        )
+
+        # Draw the histograms
+        plot.draw(((background_stack, uncertainty), None, 'hist'),
+                  (signal_histogram, None, 'hist'),
+                  (data_histogram, None, 'ep'))
+
+        # Draw the ratio plot
+        if data_histogram is not None:
+            ratio = ratio_histogram(data_histogram,
+                                    background_stack,
+                                    settings['ratio_title'])
+            plot.draw_ratio_histogram(ratio,
+                                      error_band = ratio_uncertainty)
+
+        legend_entries = (data_histogram,
+                          signal_histogram,
+                          background_stack,
+                          uncertainty)
+
+    # Draw a legend
+    plot.draw_legend(legend_entries = legend_entries)
+
+    # Draw an ATLAS stamp
+    if settings['label']:
+        label = label + settings['label']
+    plot.draw_atlas_label(settings['luminosity'],
+                          settings['sqrt_s'],
+                          custom_label = label,
+                          atlas_label = settings['atlas_label'])
+
+    # Save plot
+    plot.save(plot_output_path, settings['extensions'])
+    return plot_output_path
+
+
+class _Serialized(object):
+    """Placeholder for a ROOT object in a serialized job.
+    """
+
+    def __init__(self, key):
+        self.key = key
+
+
+def _stored(value, output, keys):
+    # ROOT imports
+    from ROOT import TObject
+
+    # Replace ROOT objects, also within containers, by placeholders
+    if isinstance(value, TObject):
+        key = 'object{}'.format(next(keys))
+        output.WriteTObject(value, key)
+        return _Serialized(key)
+    if isinstance(value, (tuple, list)):
+        return type(value)(_stored(v, output, keys) for v in value)
+    if isinstance(value, dict):
+        return dict((k, _stored(v, output, keys))
+                    for k, v
+                    in iteritems(value))
+    return value
+
+
+def _loaded(value, input):
+    # Replace placeholders by the ROOT objects they stand for, detaching
+    # histograms from the file so that they outlive it
+    if isinstance(value, _Serialized):
+        result = input.Get(value.key)
+        if hasattr(result, 'SetDirectory'):
+            result.SetDirectory(0)
+        return result
+    if isinstance(value, (tuple, list)):
+        return type(value)(_loaded(v, input) for v in value)
+    if isinstance(value, dict):
+        return dict((k, _loaded(v, input)) for k, v in iteritems(value))
+    return value
+
+
+def serialized(job):
+    """Serializes a render job for a render worker.
+
+    Args:
+        job: The render job, as accepted by render
+
+    Returns:
+        A tuple of (path, job), where path is the path of a temporary ROOT
+        file holding the ROOT objects of the job, and job is a copy of the
+        job with only plain values, suitable for render_serialized. The
+        temporary file is removed by render_serialized.
+    """
+    # ROOT imports
+    from ROOT import TFile
+
+    # Create the temporary file
+    handle, path = mkstemp(suffix = '.root')
+    close(handle)
+
+    # Write the ROOT objects of the job
+    output = TFile.Open(path, 'RECREATE')
+    try:
+        job = _stored(job, output, count())
+    finally:
+        output.Close()
+    return path, job
+
+
+def render_serialized(path, job):
+    """Renders and saves a serialized plot.
+
+    This is the entry point of render workers.
+
+    Args:
+        path: The path of the temporary ROOT file of the job, which is
+            removed once the plot is rendered
+        job: The serialized render job
+
+    Returns:
+        The plot output path.
+    """
+    # ROOT imports
+    from ROOT import TFile
+
+    input = TFile.Open(path, 'READ')
+    try:
+        return render(_loaded(job, input))
+    finally:
+        input.Close()
+        remove(path)
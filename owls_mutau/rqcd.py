@@ -0,0 +1,426 @@
+"""Provides vectorized derivations of rQCD for the mu+tau analysis.
+
+rQCD is the ratio of the opposite sign (OS) to same sign (SS) yields of the
+QCD multijet background, measured in data (after subtracting all simulated
+backgrounds) in control regions. Instead of deriving it one region and split
+at a time, the yields of all regions and splits are assembled into arrays,
+and rQCD and its uncertainties are computed for the whole table at once.
+
+The statistical uncertainty can also be estimated with a Poisson bootstrap
+(see bootstrap), which draws replicas of the yields of all regions, splits and
+processes at once, and takes the uncertainty from the quantiles of the
+resulting rQCD distribution.
+
+Derived values are written to a JSON file (see save), which model modules load
+through a cached loader (see load) instead of pasting the values into the
+module. Each table is stored per rQCD label and year, together with a digest
+of the inputs it was derived from.
+"""
+
+# System imports
+import json
+from os import rename, stat
+from os.path import abspath, dirname, exists, join
+from collections import OrderedDict
+from hashlib import sha1
+from uuid import uuid4
+
+# Six imports
+from six import iteritems
+
+# owls-cache imports
+from owls_cache.persistent import cached as persistently_cached
+
+# numpy imports
+import numpy
+
+# Set up default exports
+__all__ = [
+    'subtracted',
+    'r_qcd',
+    'cumulative',
+    'IsolationScan',
+    'poisson_replicas',
+    'bootstrap',
+    'RqcdTable',
+    'splits_digest',
+    'save',
+    'load',
+]
+
+
+def subtracted(data, backgrounds):
+    """Subtracts the yields of the simulated backgrounds from data.
+
+    Args:
+        data: An array of data yields (or bin contents)
+        backgrounds: A list of arrays of the same shape, one per background
+
+    Returns:
+        An array of the subtracted yields.
+    """
+    result = numpy.array(data, dtype = 'float64')
+    for background in backgrounds:
+        result -= background
+    return result
+
+
+def r_qcd(os, ss):
+    """Computes rQCD and its statistical uncertainty.
+
+    The statistical uncertainties of the yields are taken as the square root
+    of the (subtracted) yields.
+
+    Args:
+        os: An array of the OS yields
+        ss: An array of the SS yields
+
+    Returns:
+        A tuple of (r_qcd, stat) arrays.
+
+    Raises:
+        ZeroDivisionError: If any of the SS yields is zero
+    """
+    os = numpy.asarray(os, dtype = 'float64')
+    ss = numpy.asarray(ss, dtype = 'float64')
+    if numpy.any(ss == 0):
+        raise ZeroDivisionError('SS yield is zero')
+    ratio = os / ss
+    return ratio, numpy.sqrt(1.0 / os + 1.0 / ss) * ratio
+
+
+def _above(contents):
+    # Sum the contents of each bin and all bins above it
+    return numpy.cumsum(contents[..., ::-1], axis = -1)[..., ::-1]
+
+
+def cumulative(contents):
+    """Computes the cumulative yields above each bin of histograms.
+
+    Args:
+        contents: An array of bin contents, with the bins along the last axis,
+            including under- and overflow
+
+    Returns:
+        An array with an entry per regular bin, which is the yield of all
+        bins above it (including overflow).
+    """
+    return _above(numpy.asarray(contents, dtype = 'float64'))[..., 2:]
+
+
+class IsolationScan(object):
+    """The cumulative OS and SS yields above isolation thresholds.
+
+    The isolation distributions are filled once with a fine binning, and the
+    yields above any threshold are read off prefix sums, so that rQCD can be
+    scanned as a function of the threshold without filling again.
+
+    Args:
+        edges: The bin edges of the isolation distributions
+        os: An array of the bin contents of the OS isolation distributions,
+            with the bins along the last axis, including under- and overflow
+        ss: The same for the SS isolation distributions
+    """
+    def __init__(self, edges, os, ss):
+        self._edges = numpy.asarray(edges, dtype = 'float64')
+        self._os = numpy.asarray(os, dtype = 'float64')
+        self._ss = numpy.asarray(ss, dtype = 'float64')
+
+        # The yields of all bins from each bin on, including overflow
+        self._os_above = _above(self._os)
+        self._ss_above = _above(self._ss)
+
+    def edges(self):
+        return self._edges
+
+    def thresholds(self):
+        """Returns the default thresholds of the scan, which are the upper
+        edges of the bins.
+        """
+        return self._edges[1:]
+
+    def arrays(self):
+        """Returns a dictionary of the arrays of the scan (edges, os, ss),
+        e.g. for saving them with numpy.savez.
+        """
+        return {'edges': self._edges, 'os': self._os, 'ss': self._ss}
+
+    def _indices(self, thresholds):
+        # Round each threshold to the closest bin edge, and find the first bin
+        # above it
+        if thresholds is None:
+            thresholds = self.thresholds()
+        centers = (self._edges[:-1] + self._edges[1:]) / 2.0
+        return numpy.searchsorted(centers, thresholds) + 1
+
+    def yields(self, thresholds = None):
+        """Computes the cumulative yields above thresholds.
+
+        Args:
+            thresholds: An array of thresholds, which are rounded to the
+                closest bin edge (by default the upper bin edges)
+
+        Returns:
+            A tuple of (os, ss) arrays, with the thresholds along the last
+            axis, containing the yields of all bins above each threshold
+            (including overflow).
+        """
+        indices = self._indices(thresholds)
+        return self._os_above[..., indices], self._ss_above[..., indices]
+
+    def r_qcd(self, thresholds = None):
+        """Computes the ratio of the cumulative OS and SS yields above
+        thresholds, which is zero where the SS yield vanishes.
+
+        Args:
+            thresholds: An array of thresholds, see yields
+
+        Returns:
+            An array with the thresholds along the last axis.
+        """
+        os, ss = self.yields(thresholds)
+        return numpy.where(ss != 0, os / numpy.where(ss != 0, ss, 1.0), 0.0)
+
+    def syst(self, thresholds = None):
+        """Computes the systematic uncertainty of rQCD from its variation
+        with the isolation threshold.
+
+        Args:
+            thresholds: An array of thresholds, see yields
+
+        Returns:
+            An array of half the spread of the cumulative ratio over the
+            thresholds, i.e. the absolute systematic uncertainty of rQCD.
+        """
+        ratio = self.r_qcd(thresholds)
+        return (ratio.max(axis = -1) - ratio.min(axis = -1)) / 2.0
+
+
+def poisson_replicas(yields, variances, replicas, random):
+    """Draws Poisson replicas of (weighted) yields.
+
+    Each yield is treated as a scaled Poisson count with the effective number
+    of events yield^2 / variance, so that data yields (with unit weights) are
+    drawn from plain Poisson distributions. Yields which are not positive or
+    have no variance are not fluctuated.
+
+    Args:
+        yields: An array of yields
+        variances: An array of the sums of squared weights of the yields
+        replicas: The number of replicas
+        random: The numpy.random.RandomState to draw from
+
+    Returns:
+        An array of shape (replicas,) + yields.shape.
+    """
+    yields = numpy.asarray(yields, dtype = 'float64')
+    variances = numpy.asarray(variances, dtype = 'float64')
+    fluctuated = (yields > 0) & (variances > 0)
+    safe_yields = numpy.where(fluctuated, yields, 1.0)
+    safe_variances = numpy.where(fluctuated, variances, 1.0)
+    scales = safe_variances / safe_yields
+    draws = random.poisson(safe_yields / scales,
+                           size = (replicas,) + yields.shape) * scales
+    return numpy.where(fluctuated, draws, yields)
+
+
+def _nested(array):
+    # Convert an array into nested tuples, which can be used as cache keys
+    array = numpy.asarray(array, dtype = 'float64')
+    if array.ndim == 0:
+        return float(array)
+    return tuple(_nested(a) for a in array)
+
+
+@persistently_cached('owls_mutau.rqcd._bootstrapped')
+def _bootstrapped(yields, variances, replicas, seed, quantiles):
+    """Computes quantiles of the bootstrapped rQCD distribution, see
+    bootstrap.
+    """
+    random = numpy.random.RandomState(seed)
+    draws = poisson_replicas(yields, variances, replicas, random)
+    os = draws[:, 0, 0] - draws[:, 1:, 0].sum(axis = 1)
+    ss = draws[:, 0, 1] - draws[:, 1:, 1].sum(axis = 1)
+    ratio = numpy.where(ss != 0,
+                        os / numpy.where(ss != 0, ss, 1.0),
+                        numpy.nan)
+    return numpy.nanpercentile(ratio,
+                               [100.0 * q for q in quantiles],
+                               axis = 0)
+
+
+def bootstrap(yields, variances, replicas = 1000, seed = 0,
+              quantiles = (0.15865, 0.5, 0.84135)):
+    """Estimates the distribution of rQCD with a Poisson bootstrap.
+
+    Replicas of the OS and SS yields of data and all backgrounds are drawn
+    for all entries of a table at once, and rQCD is computed for every
+    replica. The draws are seeded, and the results are cached persistently,
+    so that repeated runs are reproducible and fast.
+
+    Args:
+        yields: An array of shape (process, charge, entry), where the first
+            process is data, the remaining processes are the backgrounds to
+            subtract, and charge 0 and 1 are OS and SS
+        variances: An array of the sums of squared weights of the yields
+        replicas: The number of replicas
+        seed: The seed of the random number generator
+        quantiles: The quantiles of the rQCD distribution to compute (by
+            default the median and the central 68% interval)
+
+    Returns:
+        An array of shape (quantile, entry). Replicas with a vanishing SS
+        yield are ignored.
+    """
+    return _bootstrapped(_nested(yields),
+                         _nested(variances),
+                         replicas,
+                         seed,
+                         tuple(quantiles))
+
+
+class RqcdTable(object):
+    """The rQCD values of all labels of a year, indexed by label.
+
+    Tables can be used wherever the estimations expect a dictionary mapping
+    rQCD labels to lists of (split, r_qcd, stat, syst) tuples.
+
+    Args:
+        entries: An iterable of (label, splits) tuples, where splits is a
+            list of (split, r_qcd, stat, syst) tuples
+        defaults: An optional dictionary mapping rQCD labels to lists of
+            (split, r_qcd, stat, syst) tuples, which provides the values of
+            labels that are not in entries
+    """
+    def __init__(self, entries, defaults = None):
+        self._entries = OrderedDict((label, tuple(tuple(s) for s in splits))
+                                    for label, splits
+                                    in entries)
+        for label, splits in sorted(iteritems(defaults or {})):
+            if label not in self._entries:
+                self._entries[label] = tuple(tuple(s) for s in splits)
+
+    def __getitem__(self, label):
+        return self._entries[label]
+
+    def __contains__(self, label):
+        return label in self._entries
+
+    def __len__(self):
+        return len(self._entries)
+
+    def labels(self):
+        """Returns a list of the rQCD labels of the table.
+        """
+        return list(self._entries)
+
+
+def splits_digest(splits):
+    """Computes the digest of the rQCD values of a label.
+
+    Args:
+        splits: A list of (split, r_qcd, stat, syst) tuples
+
+    Returns:
+        A hex digest, which changes whenever any of the values change.
+    """
+    return sha1(json.dumps([list(s) for s in splits]).encode('utf-8')). \
+            hexdigest()
+
+
+def _read(path):
+    # Read the entries of an rQCD file
+    if not exists(path):
+        return []
+    with open(path, 'r') as f:
+        return json.load(f)['entries']
+
+
+def save(path, year, inputs, table):
+    """Writes rQCD values to an rQCD file, replacing the stored values of the
+    same labels and year.
+
+    Args:
+        path: The path of the rQCD file
+        year: The data-taking year of the values
+        inputs: The digest of the inputs the values were derived from
+        table: A dictionary mapping rQCD labels to lists of (split, r_qcd,
+            stat, syst) tuples
+    """
+    entries = [e
+               for e
+               in _read(path)
+               if e['year'] != year or e['label'] not in table]
+    for label, splits in iteritems(table):
+        entries.append({
+            'label': label,
+            'year': year,
+            'inputs': inputs,
+            'splits': [{'split': split,
+                        'r_qcd': nominal,
+                        'stat': stat_error,
+                        'syst': syst_error}
+                       for split, nominal, stat_error, syst_error
+                       in splits],
+        })
+    entries.sort(key = lambda e: (e['year'], e['label']))
+
+    # Write under a temporary name first, so that readers never see a
+    # partially written file
+    temporary = join(dirname(abspath(path)), uuid4().hex + '.json')
+    with open(temporary, 'w') as f:
+        json.dump({'entries': entries}, f, indent = 1, sort_keys = True)
+    rename(temporary, path)
+
+
+# The loaded tables, keyed on path, year and inputs, with the modification time
+# of the file they were loaded from
+_tables = {}
+
+
+def load(path, year, inputs = None, defaults = None):
+    """Loads the rQCD table of a year from an rQCD file.
+
+    The values are cached in memory until the file is modified. Without an
+    inputs digest, a warning is printed if the values of the year were
+    derived from different inputs.
+
+    Args:
+        path: The path of the rQCD file
+        year: The data-taking year
+        inputs: An optional digest of the inputs, in which case only values
+            derived from these inputs are loaded, and a warning is printed
+            for values derived from other inputs
+        defaults: An optional dictionary mapping rQCD labels to lists of
+            (split, r_qcd, stat, syst) tuples, which provides the values of
+            labels that are not loaded from the file (e.g. the tables of a
+            model module)
+
+    Returns:
+        The RqcdTable.
+    """
+    path = abspath(path)
+    modified = stat(path).st_mtime
+    key = (path, year, inputs)
+    cached = _tables.get(key)
+    if cached is None or cached[0] != modified:
+        entries = [e for e in _read(path) if e['year'] == year]
+        stale = sorted(e['label']
+                       for e
+                       in entries
+                       if inputs is not None and e['inputs'] != inputs)
+        if stale:
+            print('Warning: ignoring rQCD values of {} in {}, which were '
+                  'derived from other inputs'.format(', '.join(stale), path))
+        elif inputs is None and len(set(e['inputs'] for e in entries)) > 1:
+            print('Warning: the rQCD values in {} were derived from different '
+                  'inputs'.format(path))
+        cached = _tables[key] = (modified, [
+            (e['label'], [(s['split'], s['r_qcd'], s['stat'], s['syst'])
+                          for s
+                          in e['splits']])
+            for e
+            in entries
+            if inputs is None or e['inputs'] == inputs
+        ])
+    return RqcdTable(cached[1], defaults)
@@ -0,0 +1,388 @@
+"""Provides an on-disk store of systematic variations for the mu+tau analysis.
+
+For each (model, region, distribution), the bin contents and sum of squared
+weights of the nominal histogram and of the up/down shapes of every systematic
+of every sample are kept in a single numpy array file, which is memory-mapped
+when read. Models are stored separately, since the same sample may be
+estimated differently in different models (e.g. ttbar with MonteCarlo in one
+model and with OSSS in another). A JSON index records the layout of each
+array (samples, systematics, overall variations), together with a digest of
+the inputs that produced it, so that stale entries are never used.
+
+Each systematic is stored with the content hash of its configuration, and new
+results are merged into existing entries, so that adding a systematic to (or
+removing it from) the list of active systematics only computes the systematics
+that are not stored yet. For the same reason, the lists of uncertainties in
+the model module are not part of the input digest.
+
+Likewise, the rQCD tables of the model module are not part of the input
+digest. Instead, every sample is stored with the digest of its estimation in
+the region (see owls_mutau.estimation.estimation_digest), which includes the
+rQCD values of the region, so that changed rQCD values only invalidate the
+samples and regions they affect.
+
+Tools read systematic variations through an estimation wrapper, so that code
+which calls estimation(uncertainty(distribution))(process, region) (such as
+owls-hep's uncertainty bands) transparently uses the stored results, and only
+computes the missing ones.
+"""
+
+# System imports
+import ast
+import json
+from fcntl import flock, LOCK_EX, LOCK_UN
+from os import makedirs, rename
+from os.path import join, exists
+from hashlib import sha1
+from uuid import uuid4
+
+# Six imports
+from six import iteritems
+
+# numpy imports
+import numpy
+
+# owls-hep imports
+from owls_hep.uncertainty import Uncertainty
+
+# owls-mutau imports
+from owls_mutau.uncertainties import uncertainty_hash
+
+# Set up default exports
+__all__ = [
+    'inputs_digest',
+    'Store',
+]
+
+
+# The names of the uncertainty lists in model modules
+UNCERTAINTY_LISTS = (
+    'mc_uncertainties',
+    'ss_data_uncertainties',
+    'osss_uncertainties',
+)
+
+# The names of the rQCD tables in model modules
+RQCD_TABLES = (
+    'r_qcd',
+    'r_qcd_2015',
+    'r_qcd_2016',
+)
+
+
+class _WithoutAssignments(ast.NodeTransformer):
+    # Removes assignments to a set of names from a syntax tree
+    def __init__(self, names):
+        self._names = names
+
+    def visit_Assign(self, node):
+        if any(isinstance(t, ast.Name) and t.id in self._names
+               for t
+               in node.targets):
+            return ast.Pass()
+        return node
+
+
+def inputs_digest(paths, definitions,
+                  ignored = UNCERTAINTY_LISTS + RQCD_TABLES):
+    """Computes a digest of the inputs of a tool.
+
+    Args:
+        paths: The paths of the definition modules (model, regions,
+            distributions, ...)
+        definitions: The dictionary of command line definitions
+        ignored: The names of module-level variables whose assignments
+            should not affect the digest (by default the uncertainty lists
+            and rQCD tables, since stored systematics and rQCD values are
+            validated individually)
+
+    Returns:
+        A hex digest, which changes whenever any of the modules (apart from
+        comments and the ignored assignments) or definitions change.
+    """
+    digest = sha1()
+    for path in paths:
+        with open(path, 'r') as f:
+            tree = _WithoutAssignments(set(ignored)).visit(ast.parse(f.read()))
+        digest.update(ast.dump(tree))
+    digest.update(repr(sorted(iteritems(definitions))))
+    return digest.hexdigest()
+
+
+def _bins(histogram):
+    # Extract the contents and sum of squared weights, including under- and
+    # overflow
+    count = histogram.GetNbinsX() + 2
+    return ([histogram.GetBinContent(b) for b in range(count)],
+            [histogram.GetBinError(b) ** 2 for b in range(count)])
+
+
+def _histogram(nominal, contents, sumw2):
+    # Create a histogram with the binning and style of the nominal histogram
+    result = nominal.Clone(uuid4().hex)
+    for b in range(len(contents)):
+        result.SetBinContent(b, contents[b])
+        result.SetBinError(b, numpy.sqrt(sumw2[b]))
+    return result
+
+
+class _Entry(object):
+    """The stored systematic variations of a (model, region, distribution).
+    """
+    def __init__(self, layout, array):
+        self._samples = dict((s, i) for i, s in enumerate(layout['samples']))
+        self._systematics = layout['systematics']
+        self._digests = layout.get('digests',
+                                   [None] * len(layout['samples']))
+        self._array = array
+
+    def covers(self, sample_name, uncertainties, digest = None):
+        """Checks whether all uncertainties of a sample are stored with their
+        current configuration, and with the given estimation digest.
+        """
+        if sample_name not in self._samples \
+                or self._digests[self._samples[sample_name]] != digest:
+            return False
+        systematics = self._systematics[self._samples[sample_name]]
+        return all(u.name in systematics
+                   and systematics[u.name][5] == uncertainty_hash(u)
+                   for u
+                   in uncertainties)
+
+    def result(self, sample_name, name, nominal):
+        """Reconstructs the result of a systematic.
+
+        Args:
+            sample_name: The name of the sample
+            name: The name of the systematic
+            nominal: The nominal histogram, which provides binning and style
+
+        Returns:
+            The (overall_up, overall_down, shape_up, shape_down) tuple.
+        """
+        sample = self._samples[sample_name]
+        overall_up, overall_down, has_up, has_down, row, _ = \
+                self._systematics[sample][name]
+        data = self._array[sample]
+        return (overall_up,
+                overall_down,
+                _histogram(nominal, data[row, 0], data[row, 1])
+                if has_up else None,
+                _histogram(nominal, data[row + 1, 0], data[row + 1, 1])
+                if has_down else None)
+
+    def records(self):
+        """Extracts the stored records of all samples, see Store.write.
+
+        Returns:
+            A dictionary mapping sample names to (nominal, systematics,
+            digest) tuples.
+        """
+        result = {}
+        for sample_name, sample in iteritems(self._samples):
+            data = self._array[sample]
+            systematics = {}
+            for name, (overall_up, overall_down, has_up, has_down, row,
+                       digest) in iteritems(self._systematics[sample]):
+                systematics[name] = (overall_up,
+                                     overall_down,
+                                     data[row] if has_up else None,
+                                     data[row + 1] if has_down else None,
+                                     digest)
+            result[sample_name] = (data[0],
+                                   systematics,
+                                   self._digests[sample])
+        return result
+
+    def estimation(self, estimation, sample_name, digest = None):
+        """Wraps an estimation so that stored systematics of a sample are
+        read from the store, while all others are computed.
+        """
+        return _StoredEstimation(estimation, self, sample_name, digest)
+
+
+class _StoredEstimation(object):
+    """Estimation wrapper which returns stored systematic variations, and
+    calls the wrapped estimation for anything else.
+
+    The nominal histogram, which provides the binning and style of the
+    stored variations, is computed once per calculation and region.
+    """
+    def __init__(self, estimation, entry, sample_name, digest):
+        self._estimation = estimation
+        self._entry = entry
+        self._sample_name = sample_name
+        self._digest = digest
+        self._nominals = []
+
+    def _nominal(self, calculation, process, region):
+        # Calculations, processes and regions are matched by identity, since
+        # tools pass the very same objects for all systematics of a sample
+        for (c, p, r), nominal in self._nominals:
+            if c is calculation and p is process and r is region:
+                return nominal
+        nominal = self._estimation(calculation)(process, region)
+        self._nominals.append(((calculation, process, region), nominal))
+        return nominal
+
+    def __call__(self, calculation):
+        if not isinstance(calculation, Uncertainty) \
+                or not self._entry.covers(self._sample_name,
+                                          [calculation],
+                                          self._digest):
+            return self._estimation(calculation)
+
+        def stored(process, region):
+            return self._entry.result(self._sample_name,
+                                      calculation.name,
+                                      self._nominal(calculation.calculation,
+                                                    process,
+                                                    region))
+        return stored
+
+
+class Store(object):
+    """A directory of memory-mappable systematic variation arrays.
+
+    Args:
+        path: The directory of the store
+        digest: The digest of the inputs (see inputs_digest); entries written
+            with a different digest are ignored
+        model_name: The name of the model whose variations are stored
+    """
+    INDEX = 'index.json'
+    LOCK = 'index.lock'
+
+    def __init__(self, path, digest, model_name):
+        self._path = path
+        self._digest = digest
+        self._model_name = model_name
+        if not exists(path):
+            makedirs(path)
+
+    def _index(self):
+        index_path = join(self._path, self.INDEX)
+        if not exists(index_path):
+            return {}
+        with open(index_path, 'r') as f:
+            return json.load(f)
+
+    def _key(self, region_name, distribution_name):
+        return '{}/{}/{}'.format(self._model_name,
+                                 region_name,
+                                 distribution_name)
+
+    def entry(self, region_name, distribution_name):
+        """Loads the stored variations of a region and distribution of the
+        model.
+
+        Returns:
+            The entry, or None if there is no valid entry.
+        """
+        layout = self._index().get(self._key(region_name, distribution_name))
+        if layout is None or layout['digest'] != self._digest:
+            return None
+        array = numpy.load(join(self._path, layout['file']), mmap_mode = 'r')
+        return _Entry(layout, array)
+
+    def write(self, region_name, distribution_name, results,
+              digests = None):
+        """Stores the variations of a region and distribution of the model,
+        merging them into the stored variations of other samples and
+        systematics.
+
+        Args:
+            region_name: The name of the region
+            distribution_name: The name of the distribution
+            results: A dictionary mapping sample names to (nominal, results)
+                tuples, where results is a dictionary mapping uncertainties
+                to (overall_up, overall_down, shape_up, shape_down) tuples
+            digests: An optional dictionary mapping sample names to the
+                estimation digests they are stored with (see _Entry.covers)
+
+        Writers (e.g. tools running concurrently on the same store) are
+        serialized by a lock file, and the stored records and index are read
+        again once the lock is held, so that no writer drops the entries of
+        another.
+        """
+        with open(join(self._path, self.LOCK), 'a') as lock:
+            flock(lock, LOCK_EX)
+            try:
+                self._write(region_name,
+                            distribution_name,
+                            results,
+                            digests or {})
+            finally:
+                flock(lock, LOCK_UN)
+
+    def _write(self, region_name, distribution_name, results, digests):
+        # Merge and write the records of a region and distribution, see write
+
+        # Start from the stored records, which are replaced by new results.
+        # Stored systematics of samples whose digest changed are dropped.
+        entry = self.entry(region_name, distribution_name)
+        records = entry.records() if entry is not None else {}
+        for sample_name, (nominal, sample_results) in iteritems(results):
+            digest = digests.get(sample_name)
+            _, systematics, stored_digest = records.get(sample_name,
+                                                        (None, {}, digest))
+            if stored_digest != digest:
+                systematics = {}
+            for u, result in iteritems(sample_results):
+                overall_up, overall_down, shape_up, shape_down = result
+                systematics[u.name] = (
+                    overall_up,
+                    overall_down,
+                    _bins(shape_up) if shape_up is not None else None,
+                    _bins(shape_down) if shape_down is not None else None,
+                    uncertainty_hash(u)
+                )
+            records[sample_name] = (_bins(nominal), systematics, digest)
+
+        # Lay out the records in a single array
+        samples = sorted(records)
+        rows = 1 + 2 * max([len(s) for _, s, _ in records.values()] + [0])
+        bins = max(len(n[0]) for n, _, _ in records.values())
+        array = numpy.zeros((len(samples), rows, 2, bins))
+        systematics = []
+        for i, sample_name in enumerate(samples):
+            nominal, sample_records, _ = records[sample_name]
+            array[i, 0] = nominal
+            layout = {}
+            for j, (name, record) \
+                    in enumerate(sorted(iteritems(sample_records))):
+                overall_up, overall_down, up, down, digest = record
+                row = 1 + 2 * j
+                if up is not None:
+                    array[i, row] = up
+                if down is not None:
+                    array[i, row + 1] = down
+                layout[name] = (overall_up,
+                                overall_down,
+                                up is not None,
+                                down is not None,
+                                row,
+                                digest)
+            systematics.append(layout)
+
+        # Write the array under a temporary name first, so that readers
+        # never see a partially written file
+        file_name = '{}_{}_{}.npy'.format(self._model_name,
+                                          region_name,
+                                          distribution_name)
+        temporary = join(self._path, uuid4().hex + '.npy')
+        numpy.save(temporary, array)
+        rename(temporary, join(self._path, file_name))
+
+        index = self._index()
+        index[self._key(region_name, distribution_name)] = {
+            'digest': self._digest,
+            'file': file_name,
+            'samples': samples,
+            'systematics': systematics,
+            'digests': [records[s][2] for s in samples],
+        }
+        temporary = join(self._path, uuid4().hex + '.json')
+        with open(temporary, 'w') as f:
+            json.dump(index, f, indent = 1, sort_keys = True)
+        rename(temporary, join(self._path, self.INDEX))
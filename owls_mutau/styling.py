@@ -3,7 +3,12 @@
 
 from six import string_types
 
-from ROOT import TColor, kBlack, kRed, kBlue
+# ROOT colour indices (see ROOT's EColor). These are fixed by ROOT, so they are
+# defined here rather than imported, which would initialize PyROOT as soon as
+# a style is imported.
+kBlack = 1
+kRed = 632
+kBlue = 600
 
 # TODO: Pick one good series of divergent and sequential, and instead create
 # series of different lenghts. Make sure divergent series can offer different
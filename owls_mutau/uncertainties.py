@@ -1,13 +1,114 @@
 """Uncertainties for the mu+tau ttbar T&P analysis.
 """
 
+# System imports
+from hashlib import sha1
+from uuid import uuid4
 
 # owls-hep imports
 from owls_hep.uncertainty import Uncertainty, sum_quadrature, to_overall
 from owls_hep.variations import Reweighted, ReplaceWeight
 
+# owls-mutau imports
+from owls_mutau.histogramming import columnar, fusable, weight_varied, \
+        tree_varied
+
 configuration = {}
 
+def content_hash(*names):
+    """Computes a stable hash of the configuration entries of systematics.
+
+    Args:
+        names: The names of the systematics
+
+    Returns:
+        A hex digest of the resolved nominal/up/down weight strings or tree
+        names, which is identical across processes and only changes when the
+        configuration entries do.
+    """
+    return sha1(repr(tuple((n, tuple(configuration[n]))
+                           for n
+                           in sorted(names))).encode('utf-8')).hexdigest()
+
+def uncertainty_hash(uncertainty):
+    """Computes a stable hash identifying an uncertainty class and its
+    configuration.
+
+    Args:
+        uncertainty: The uncertainty class, or an instance of it (e.g. an
+            uncertainty applied to a distribution)
+
+    Returns:
+        The content hash of the configuration entry for configured
+        uncertainties, and the name for all others.
+    """
+    if not isinstance(uncertainty, type):
+        uncertainty = type(uncertainty)
+    if issubclass(uncertainty, ConfiguredUncertainty):
+        return content_hash(uncertainty.name)
+    return uncertainty.name
+
+def evaluated(calculation, requests):
+    """Evaluates a calculation for a list of requests, evaluating identical
+    requests only once.
+
+    Args:
+        calculation: The calculation to evaluate
+        requests: A list of (process, region) tuples, where identical
+            requests use the very same process and region objects
+
+    Returns:
+        A list of results, one per request. Repeated requests receive copies
+        of the first result, so that all results may be scaled freely.
+    """
+    results = []
+    for i, (process, region) in enumerate(requests):
+        for (p, r), result in zip(requests[:i], results):
+            if p is process and r is region:
+                results.append(result.Clone(uuid4().hex))
+                break
+        else:
+            results.append(calculation(process, region))
+    return results
+
+class BatchedUncertainty(Uncertainty):
+    """Base class for shape uncertainties which declare their up and down
+    variations as a single batched request.
+
+    Subclasses implement requests(process, region), returning the (process,
+    region) tuples of the up and down variations. Identical up and down
+    variations (as in symmetric uncertainties) are only evaluated once.
+    """
+    def requests(self, process, region):
+        raise NotImplementedError('abstract method')
+
+    def __call__(self, process, region):
+        up, down = evaluated(self.calculation, self.requests(process, region))
+        return (None, None, up, down)
+
+class ConfiguredUncertainty(BatchedUncertainty):
+    """Base class for uncertainties defined by an entry in the configuration.
+
+    The content hash of the entry is computed when the uncertainty is created,
+    and is part of both the representation and the pickled state, so that
+    cached results of different configurations (e.g. years and triggers) never
+    collide, while identical configurations share them.
+    """
+    def __init__(self, calculation):
+        # Call superclass initializer
+        super(ConfiguredUncertainty, self).__init__(calculation)
+
+        # Resolve the configuration entry
+        self._content_hash = content_hash(self.name)
+
+    def content_hash(self):
+        return self._content_hash
+
+    def __repr__(self):
+        return '{}({}, {!r})'.format(self.name,
+                                     self._content_hash,
+                                     self.calculation)
+
 class TestConfiguration(Uncertainty):
     name = 'TEST_CONFIGURATION'
 
@@ -26,85 +127,90 @@ class TestSystFlat(Uncertainty):
                 None,
                 None)
 
-class TestSystShape(Uncertainty):
+class TestSystShape(BatchedUncertainty):
     name = 'TEST_SYST_SHAPE'
 
-    def __call__(self, process, region):
-        return (None,
-                None,
-                self.calculation(
-                    process,
-                    region.varied(Reweighted('tau_0_jet_bdt_score+1.0'))
-                ),
-                self.calculation(
-                    process,
-                    region.varied(Reweighted('tau_0_jet_bdt_score-0.10'))
-                ))
-
-class RqcdStat(Uncertainty):
+    def requests(self, process, region):
+        return (
+            (process, region.varied(Reweighted('tau_0_jet_bdt_score+1.0'))),
+            (process, region.varied(Reweighted('tau_0_jet_bdt_score-0.10')))
+        )
+
+class RqcdStat(BatchedUncertainty):
     name = 'RQCD_STAT'
 
-    def __call__(self, process, region):
-        return (None,
-                None,
-                self.calculation(process, region),
-                self.calculation(process, region))
+    # The rQCD variations are applied by the estimation, so up and down are
+    # the same (nominal) calculation
+    def requests(self, process, region):
+        return ((process, region), (process, region))
 
-class RqcdSyst(Uncertainty):
+class RqcdSyst(BatchedUncertainty):
     name = 'RQCD_SYST'
 
+    def requests(self, process, region):
+        return ((process, region), (process, region))
+
+class TreeSystematicBase(ConfiguredUncertainty):
+    # Whether to fill all configured tree systematics while visiting each
+    # input file once
+    batched = False
+
+    def _get_up(self):
+        return configuration[self.name][0]
+
+    def _get_down(self):
+        return configuration[self.name][1]
+
     def __call__(self, process, region):
-        return (None,
-                None,
-                self.calculation(process, region),
-                self.calculation(process, region))
+        # If batched, fill all configured tree systematics together. In
+        # fused estimations the histogram is wrapped in a proxy.
+        histogram = getattr(self.calculation, 'calculation', self.calculation)
+        if self.batched and fusable(histogram):
+            variations = tree_varied(process,
+                                     region,
+                                     histogram,
+                                     _configured_tree_systematics())
+            up = variations[self._get_up()]
+            down = variations[self._get_down()]
+            if down is up:
+                down = up.Clone(uuid4().hex)
+            return (None, None, up, down)
+
+        return super(TreeSystematicBase, self).__call__(process, region)
 
-class MuonIdSys(Uncertainty):
+    def requests(self, process, region):
+        up = process.retreed(self._get_up())
+        if self._get_down() == self._get_up():
+            down = up
+        else:
+            down = process.retreed(self._get_down())
+        return ((up, region), (down, region))
+
+class MuonIdSys(TreeSystematicBase):
     name = 'MUON_ID_SYS'
 
-    def __call__(self, process, region):
-        return (None,
-                None,
-                self.calculation(
-                    process.retreed(configuration[self.name][0]),
-                    region
-                ),
-                self.calculation(
-                    process.retreed(configuration[self.name][1]),
-                    region
-                ))
-
-class MuonMsSys(Uncertainty):
+class MuonMsSys(TreeSystematicBase):
     name = 'MUON_MS_SYS'
 
-    def __call__(self, process, region):
-        return (None,
-                None,
-                self.calculation(
-                    process.retreed(configuration[self.name][0]),
-                    region
-                ),
-                self.calculation(
-                    process.retreed(configuration[self.name][1]),
-                    region
-                ))
-
-class MuonScaleSys(Uncertainty):
+class MuonScaleSys(TreeSystematicBase):
     name = 'MUON_SCALE_SYS'
 
-    def __call__(self, process, region):
-        return (None,
-                None,
-                self.calculation(
-                    process.retreed(configuration[self.name][0]),
-                    region
-                ),
-                self.calculation(
-                    process.retreed(configuration[self.name][1]),
-                    region
-                ))
-
-class WeightSystematicBase(Uncertainty):
+# The names of all tree systematics
+_tree_systematics = [
+    MuonIdSys.name,
+    MuonMsSys.name,
+    MuonScaleSys.name,
+]
+
+def _configured_tree_systematics():
+    # Collect the up/down trees of all tree systematics in the current
+    # configuration, so that they can be filled together
+    return tuple(tree
+                 for name in _tree_systematics
+                 if name in configuration
+                 for tree in configuration[name])
+
+class WeightSystematicBase(ConfiguredUncertainty):
     def _get_nominal(self):
         return configuration[self.name][0]
 
@@ -121,21 +227,45 @@ class WeightSystematicBase(Uncertainty):
                          self._get_nominal(),
                          self._get_up(),
                          self._get_down()))
-        return (None,
-                None,
-                self.calculation(
-                    process,
-                    region.varied(ReplaceWeight(self._get_nominal(),
-                                                self._get_up()))
-                ),
-                self.calculation(
-                    process,
-                    region.varied(ReplaceWeight(self._get_nominal(),
-                                                self._get_down()))
-                ))
 
+        # Fill all configured weight systematics in one pass if the columnar
+        # paths are enabled. In fused estimations the histogram is wrapped in
+        # a proxy.
+        histogram = getattr(self.calculation, 'calculation', self.calculation)
+        if columnar() and fusable(histogram):
+            _, variations = weight_varied(process,
+                                          region,
+                                          histogram,
+                                          _configured_weight_systematics())
+            up, down = variations[self.name]
+            return (None, None, up, down)
+
+        return super(WeightSystematicBase, self).__call__(process, region)
+
+    def requests(self, process, region):
+        up = region.varied(ReplaceWeight(self._get_nominal(),
+                                         self._get_up()))
+        if self._get_down() == self._get_up():
+            down = up
+        else:
+            down = region.varied(ReplaceWeight(self._get_nominal(),
+                                               self._get_down()))
+        return ((process, up), (process, down))
+
+
+# The names of all weight systematics, in order of definition
+_weight_systematics = []
+
+def _configured_weight_systematics():
+    # Collect the (name, nominal, up, down) tuples of all weight systematics
+    # in the current configuration, so that they can be filled together
+    return tuple((name,) + tuple(configuration[name])
+                 for name
+                 in _weight_systematics
+                 if name in configuration)
 
 def _define_weight_systematic(name):
+    _weight_systematics.append(name)
     return type(name,
                 (WeightSystematicBase,),
                 dict(name=name))
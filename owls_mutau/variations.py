@@ -11,12 +11,16 @@ class OneProng(Variation):
 
 class ThreeProng(Variation):
     def __call__(self, selection, weight):
-        return (anded(selection, 'tau_0_n_tracks  == 3'), weight)
+        return (anded(selection, 'tau_0_n_tracks == 3'), weight)
 
 class SS(Variation):
+    selection = 'lephad_qxq == 1'
+
     def __call__(self, selection, weight):
-        return (anded(selection, 'lephad_qxq == 1'), weight)
+        return (anded(selection, self.selection), weight)
 
 class OS(Variation):
+    selection = 'lephad_qxq == -1'
+
     def __call__(self, selection, weight):
-        return (anded(selection, 'lephad_qxq == -1'), weight)
+        return (anded(selection, self.selection), weight)
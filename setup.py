@@ -18,6 +18,8 @@ setup(
     # Dependencies
     install_requires = [
         'six >= 1.7.3',
+        'numpy',
+        'root_numpy',
         'owls-cache >= 0.0.2',
         'owls-parallel >= 0.0.2',
         'owls-hep >= 0.0.2',
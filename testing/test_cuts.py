@@ -0,0 +1,62 @@
+# System imports
+import unittest
+
+# The cut masks work on numpy arrays
+try:
+    import numpy
+    from owls_mutau.cuts import CutMask, query, MAXIMUM_CUTS
+except ImportError as e:
+    raise unittest.SkipTest('cut dependencies unavailable: {}'.format(e))
+
+
+class TestCutMask(unittest.TestCase):
+    def setUp(self):
+        self.mask = CutMask([('os', 'q0 * q1 < 0'), ('1p', 'n == 1')])
+        self.columns = {
+            'q0': numpy.array([1, 1, -1, 1]),
+            'q1': numpy.array([-1, 1, 1, 1]),
+            'n': numpy.array([1, 1, 3, 3]),
+        }
+
+    def test_cuts(self):
+        self.assertEqual(self.mask.cuts(), (('os', '((q0 * q1) < 0)'),
+                                            ('1p', '(n == 1)')))
+        self.assertEqual(self.mask.branches(), ('n', 'q0', 'q1'))
+
+    def test_evaluate(self):
+        self.assertEqual(list(self.mask.evaluate(self.columns, 4)),
+                         [3, 2, 1, 0])
+
+    def test_resolve(self):
+        # Equivalent cuts are matched in any order, and the rest of the
+        # selection is kept as residual
+        self.assertEqual(
+            self.mask.resolve('w * ((q1*q0 < 0) && n == 1 && pt > 20)'),
+            (3, 3, '((pt > 20) * w)')
+        )
+
+    def test_query(self):
+        required, expected, residual = \
+                self.mask.resolve('!(n == 1) && (q0 * q1 < 0)')
+        self.assertEqual((required, expected, residual), (3, 1, '1'))
+        mask = self.mask.evaluate(self.columns, 4)
+        self.assertEqual(list(query(mask, required, expected)),
+                         [False, False, True, False])
+
+    def test_contradiction(self):
+        self.assertEqual(self.mask.resolve('(n == 1) && !(n == 1)'),
+                         (0, 0, '0'))
+
+    def test_unparseable(self):
+        self.assertEqual(self.mask.resolve('a &&'), (0, 0, 'a &&'))
+
+    def test_too_many(self):
+        self.assertRaises(ValueError,
+                          CutMask,
+                          [('c{}'.format(i), 'x > {}'.format(i))
+                           for i
+                           in range(MAXIMUM_CUTS + 1)])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,97 @@
+# System imports
+import unittest
+
+# The efficiencies are computed with numpy and scipy
+try:
+    import numpy
+    from scipy.stats import beta
+    from owls_mutau.efficiency import CONFIDENCE, clopper_pearson, \
+        normalized, syst_errors, combined, flipped, relative, Efficiencies
+except ImportError as e:
+    raise unittest.SkipTest('efficiency dependencies unavailable: {}'. \
+                            format(e))
+
+
+class TestClopperPearson(unittest.TestCase):
+    def test_interval(self):
+        alpha = (1.0 - CONFIDENCE) / 2.0
+        low, high = clopper_pearson([10.0], [5.0])
+        self.assertAlmostEqual(low[0], beta.ppf(alpha, 5.0, 6.0))
+        self.assertAlmostEqual(high[0], beta.ppf(1.0 - alpha, 6.0, 5.0))
+
+    def test_sanitized(self):
+        # Bins without total counts have empty intervals, and passed counts
+        # above the total are limited to it
+        low, high = clopper_pearson([0.0, 10.0, -1.0], [0.0, 12.0, 1.0])
+        self.assertEqual((low[0], high[0]), (0.0, 0.0))
+        self.assertEqual(high[1], 1.0)
+        self.assertEqual((low[2], high[2]), (0.0, 0.0))
+
+    def test_effective_entries(self):
+        # Weighted counts are converted to effective numbers of entries
+        weighted = clopper_pearson([10.0], [5.0], variances = [40.0])
+        effective = clopper_pearson([2.5], [1.25])
+        self.assertAlmostEqual(weighted[0][0], effective[0][0])
+        self.assertAlmostEqual(weighted[1][0], effective[1][0])
+
+
+class TestSystematics(unittest.TestCase):
+    def test_normalized(self):
+        up, down, switched, reset = normalized(numpy.array([1.0, 1.0]),
+                                               [[0.9, 1.2]],
+                                               [[1.1, 1.05]])
+        self.assertEqual(up.tolist(), [[1.1, 1.2]])
+        self.assertEqual(down.tolist(), [[0.9, 1.0]])
+        self.assertEqual((switched, reset), (1, 1))
+
+    def test_syst_errors(self):
+        low, high = syst_errors(numpy.array([1.0, 2.0]),
+                                [[1.1, 2.2], [1.2, 2.0]],
+                                [[0.9, 1.9], [1.0, 2.0]])
+        numpy.testing.assert_allclose(low, [0.1, 0.1])
+        numpy.testing.assert_allclose(high, [0.05 ** 0.5, 0.2])
+
+    def test_combined(self):
+        low, high = combined((numpy.array([3.0]), numpy.array([1.0])),
+                             (numpy.array([4.0]), numpy.array([0.0])))
+        self.assertEqual((low.tolist(), high.tolist()), ([5.0], [1.0]))
+        self.assertEqual(flipped((low, high)), (high, low))
+
+    def test_relative(self):
+        low, high = relative([2.0, 0.0],
+                             (numpy.array([1.0, 1.0]),
+                              numpy.array([0.5, 1.0])))
+        self.assertEqual((low.tolist(), high.tolist()),
+                         ([0.5, 0.0], [0.25, 0.0]))
+
+
+class TestEfficiencies(unittest.TestCase):
+    def test_efficiencies(self):
+        efficiencies = Efficiencies([[10.0, 0.0], [10.0, 10.0]],
+                                    [[5.0, 3.0], [6.0, 10.0]],
+                                    [0.0, 1.0, 3.0],
+                                    ['nominal', 'MUON_ID_SYS up'])
+        self.assertEqual(efficiencies.centers().tolist(), [0.5, 2.0])
+        self.assertEqual(efficiencies.widths().tolist(), [1.0, 2.0])
+        self.assertEqual(efficiencies.values().tolist(),
+                         [[0.5, 0.0], [0.6, 1.0]])
+        self.assertEqual(efficiencies.valid(0).tolist(), [True, False])
+        self.assertEqual(efficiencies.selected('SYS').tolist(), [[0.6, 1.0]])
+
+        # The errors are the distances to the interval bounds
+        low, high = efficiencies.errors(0)
+        interval = clopper_pearson([10.0], [5.0])
+        self.assertAlmostEqual(low[0], 0.5 - interval[0][0])
+        self.assertAlmostEqual(high[0], interval[1][0] - 0.5)
+        self.assertEqual((low[1], high[1]), (0.0, 0.0))
+
+    def test_with_values(self):
+        efficiencies = Efficiencies([[10.0]], [[5.0]], [0.0, 1.0], ['a'])
+        shifted = efficiencies.with_values([[0.7]])
+        self.assertEqual(shifted.values().tolist(), [[0.7]])
+        self.assertEqual(efficiencies.values().tolist(), [[0.5]])
+        self.assertIs(shifted.errors(), efficiencies.errors())
+
+
+if __name__ == '__main__':
+    unittest.main()
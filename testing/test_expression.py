@@ -0,0 +1,98 @@
+# System imports
+import unittest
+
+# The expression module works on numpy arrays
+try:
+    import numpy
+    from owls_mutau.expression import canonical, factored, shared, \
+        compiled, UnsupportedExpression
+except ImportError as e:
+    raise unittest.SkipTest('expression dependencies unavailable: {}'. \
+                            format(e))
+
+
+class TestCanonical(unittest.TestCase):
+    def test_ordering(self):
+        self.assertEqual(canonical('b && a'), canonical('a&&b'))
+        self.assertEqual(canonical('(a && b) && c'), '(a && b && c)')
+        self.assertEqual(canonical('  a   ||  b '), '(a || b)')
+        self.assertEqual(canonical('1 == x'), '(x == 1)')
+        self.assertEqual(canonical('2 < x'), '(x > 2)')
+
+    def test_constants(self):
+        self.assertEqual(canonical('x > 1.50'), canonical('x>1.5e0'))
+        self.assertEqual(canonical('x * 1.0'), 'x')
+        self.assertEqual(canonical('1*x'), 'x')
+
+    def test_idempotent(self):
+        self.assertEqual(canonical('a && a'), 'a')
+        self.assertEqual(canonical('(x > 1) || (x > 1.0)'), '(x > 1)')
+        self.assertEqual(canonical('a && b && a'), '(a && b)')
+
+    def test_unary(self):
+        self.assertEqual(canonical('+a'), 'a')
+        self.assertEqual(canonical('!(a)'), '!a')
+
+        # Nested negations mustn't render as a decrement
+        self.assertEqual(canonical('-(-a)'), '-(-a)')
+
+    def test_unparseable(self):
+        self.assertEqual(canonical('a   &&'), 'a &&')
+
+
+class TestFactored(unittest.TestCase):
+    def test_required(self):
+        self.assertEqual(factored('w * (a && b && c)', ['a && b', 'c']),
+                         (set([0, 1]), set(), 'w'))
+
+    def test_vetoed(self):
+        self.assertEqual(factored('w * (a && !c)', ['a', 'c']),
+                         (set([0]), set([1]), 'w'))
+
+    def test_residual(self):
+        # A single remaining term stays boolean
+        self.assertEqual(factored('(a && b)', ['a']),
+                         (set([0]), set(), '(b != 0)'))
+
+
+class TestShared(unittest.TestCase):
+    def test_shared(self):
+        base, residuals = shared(['w * (a && b)', 'w * (a && c)'])
+        self.assertEqual(base, '((a != 0) * w)')
+        self.assertEqual(residuals, ['(b != 0)', '(c != 0)'])
+
+
+class TestKernels(unittest.TestCase):
+    def test_evaluation(self):
+        kernel = compiled('x / y + 1')
+        self.assertEqual(kernel.branches(), ('x', 'y'))
+
+        # Division by zero yields zero, as in TTreeFormula
+        result = kernel({'x': numpy.array([1.0, 2.0]),
+                         'y': numpy.array([0.0, 4.0])},
+                        2)
+        self.assertEqual(list(result), [1.0, 1.5])
+
+    def test_selection(self):
+        result = compiled('x > 1 && y')({'x': numpy.array([0, 2, 3]),
+                                         'y': numpy.array([1, 1, 0])},
+                                        3)
+        self.assertEqual(list(result), [0.0, 1.0, 0.0])
+
+    def test_constant(self):
+        self.assertEqual(list(compiled('1')({}, 3)), [1.0, 1.0, 1.0])
+
+    def test_cached(self):
+        self.assertIs(compiled('x + 1'), compiled('1+x'))
+
+    def test_negation(self):
+        result = compiled('-(-x)')({'x': numpy.array([2.0])}, 1)
+        self.assertEqual(list(result), [2.0])
+
+    def test_unsupported(self):
+        self.assertRaises(UnsupportedExpression, compiled, 'foo[0] > 1')
+        self.assertRaises(UnsupportedExpression, compiled, 'unknown(x)')
+
+
+if __name__ == '__main__':
+    unittest.main()
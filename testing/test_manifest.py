@@ -0,0 +1,93 @@
+# System imports
+import unittest
+from os.path import join
+from shutil import rmtree
+from tempfile import mkdtemp
+
+# owls-mutau imports
+from owls_mutau.manifest import plot_digest, Manifest
+
+
+class Graph(object):
+    """A minimal graph, exposing the getters the digest reads.
+    """
+    def __init__(self, title, x, y):
+        self._title = title
+        self._x = x
+        self._y = y
+
+    def GetTitle(self):
+        return self._title
+
+    def GetN(self):
+        return len(self._x)
+
+    def GetX(self):
+        return self._x
+
+    def GetY(self):
+        return self._y
+
+
+class TestPlotDigest(unittest.TestCase):
+    def test_plain(self):
+        self.assertEqual(plot_digest('label', [1.0, None], {'b': 1, 'a': 2}),
+                         plot_digest('label', (1.0, None), {'a': 2, 'b': 1}))
+        self.assertNotEqual(plot_digest('label', 1.0),
+                            plot_digest('label', 2.0))
+
+    def test_graphs(self):
+        self.assertEqual(plot_digest(Graph('g', [0.0, 1.0], [2.0, 3.0])),
+                         plot_digest(Graph('g', [0.0, 1.0], [2.0, 3.0])))
+        self.assertNotEqual(plot_digest(Graph('g', [0.0, 1.0], [2.0, 3.0])),
+                            plot_digest(Graph('g', [0.0, 1.0], [2.0, 4.0])))
+        self.assertNotEqual(plot_digest(Graph('g', [0.0], [2.0])),
+                            plot_digest(Graph('h', [0.0], [2.0])))
+
+
+class TestManifest(unittest.TestCase):
+    def setUp(self):
+        self.directory = mkdtemp()
+        self.plot = join(self.directory, 'plot')
+
+    def tearDown(self):
+        rmtree(self.directory)
+
+    def touch(self, extension):
+        open('{}.{}'.format(self.plot, extension), 'w').close()
+
+    def test_unchanged(self):
+        manifest = Manifest(self.directory)
+        self.assertFalse(manifest.unchanged(self.plot, ['pdf'], 'digest'))
+        manifest.record(self.plot, 'digest')
+        manifest.save()
+
+        # Plots are only unchanged if all output files exist
+        manifest = Manifest(self.directory)
+        self.assertFalse(manifest.unchanged(self.plot, ['pdf'], 'digest'))
+        self.touch('pdf')
+        self.assertTrue(manifest.unchanged(self.plot, ['pdf'], 'digest'))
+        self.assertFalse(manifest.unchanged(self.plot, ['pdf'], 'other'))
+        self.assertFalse(manifest.unchanged(self.plot,
+                                            ['pdf', 'png'],
+                                            'digest'))
+
+    def test_merge(self):
+        # Manifests saved by concurrent writers keep each other's entries
+        first = Manifest(self.directory)
+        second = Manifest(self.directory)
+        first.record(join(self.directory, 'a'), 'x')
+        second.record(join(self.directory, 'b'), 'y')
+        first.save()
+        second.save()
+
+        manifest = Manifest(self.directory)
+        for name, digest in (('a', 'x'), ('b', 'y')):
+            open(join(self.directory, name + '.pdf'), 'w').close()
+            self.assertTrue(manifest.unchanged(join(self.directory, name),
+                                               ['pdf'],
+                                               digest))
+
+
+if __name__ == '__main__':
+    unittest.main()
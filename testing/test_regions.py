@@ -0,0 +1,42 @@
+# System imports
+import unittest
+
+# owls-mutau imports
+from owls_mutau import regions
+from owls_mutau.regions import RegionFamily, family_of
+
+
+class TestRegionFamily(unittest.TestCase):
+    def setUp(self):
+        self.base = object()
+        self.os = object()
+        self.family = RegionFamily('mu_tau')
+        self.family.add('mu_tau', self.base)
+        self.family.add('mu_tau_os', self.os)
+
+    def tearDown(self):
+        del regions._enabled[:]
+
+    def test_regions(self):
+        self.assertEqual(self.family.name(), 'mu_tau')
+        self.assertEqual(self.family.names(), ['mu_tau', 'mu_tau_os'])
+        self.assertEqual(list(self.family.named_regions().items()),
+                         [('mu_tau', self.base), ('mu_tau_os', self.os)])
+        self.assertEqual(self.family.regions(), [self.base, self.os])
+
+    def test_index(self):
+        # Regions are matched by identity
+        self.assertEqual(self.family.index(self.os), 1)
+        self.assertIsNone(self.family.index(object()))
+
+    def test_enable(self):
+        self.assertIsNone(family_of(self.os))
+        self.family.enable()
+        self.family.enable()
+        self.assertIs(family_of(self.os), self.family)
+        self.assertIsNone(family_of(object()))
+        self.assertEqual(regions._enabled, [self.family])
+
+
+if __name__ == '__main__':
+    unittest.main()
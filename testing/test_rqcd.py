@@ -0,0 +1,132 @@
+# System imports
+import unittest
+from os.path import join
+from shutil import rmtree
+from tempfile import mkdtemp
+
+# The rQCD module caches bootstraps through owls-cache
+try:
+    import numpy
+    from owls_mutau.rqcd import subtracted, r_qcd, cumulative, \
+        IsolationScan, poisson_replicas, bootstrap, RqcdTable, \
+        splits_digest, save, load
+except ImportError as e:
+    raise unittest.SkipTest('rQCD dependencies unavailable: {}'.format(e))
+
+
+class TestDerivation(unittest.TestCase):
+    def test_subtracted(self):
+        result = subtracted([10.0, 20.0], [[1.0, 2.0], [3.0, 4.0]])
+        self.assertEqual(list(result), [6.0, 14.0])
+
+    def test_r_qcd(self):
+        ratio, stat = r_qcd([4.0, 9.0], [2.0, 3.0])
+        self.assertEqual(list(ratio), [2.0, 3.0])
+        self.assertAlmostEqual(stat[0], 2.0 * (0.25 + 0.5) ** 0.5)
+        self.assertAlmostEqual(stat[1], 2.0)
+
+    def test_zero_ss(self):
+        self.assertRaises(ZeroDivisionError, r_qcd, [1.0], [0.0])
+
+    def test_cumulative(self):
+        # Under- and overflow are included in the yields above each bin
+        self.assertEqual(cumulative([[1, 2, 3, 4]]).tolist(), [[7.0, 4.0]])
+
+
+class TestIsolationScan(unittest.TestCase):
+    def setUp(self):
+        self.scan = IsolationScan([0.0, 1.0, 2.0],
+                                  [1.0, 2.0, 3.0, 4.0],
+                                  [1.0, 1.0, 1.0, 2.0])
+
+    def test_yields(self):
+        os, ss = self.scan.yields()
+        self.assertEqual(list(self.scan.thresholds()), [1.0, 2.0])
+        self.assertEqual(list(os), [7.0, 4.0])
+        self.assertEqual(list(ss), [3.0, 2.0])
+
+        # Thresholds are rounded to the closest bin edge
+        os, ss = self.scan.yields([0.9])
+        self.assertEqual((list(os), list(ss)), ([7.0], [3.0]))
+
+    def test_r_qcd(self):
+        ratio = self.scan.r_qcd()
+        self.assertAlmostEqual(ratio[0], 7.0 / 3.0)
+        self.assertAlmostEqual(ratio[1], 2.0)
+        self.assertAlmostEqual(self.scan.syst(), (7.0 / 3.0 - 2.0) / 2.0)
+
+
+class TestBootstrap(unittest.TestCase):
+    def setUp(self):
+        # Data and one background, with OS and SS yields of two entries
+        self.yields = numpy.array([[[1000.0, 2000.0], [500.0, 1000.0]],
+                                   [[100.0, 200.0], [50.0, 100.0]]])
+
+    def test_replicas(self):
+        replicas = poisson_replicas([100.0, 0.0, 50.0],
+                                    [100.0, 0.0, 0.0],
+                                    5,
+                                    numpy.random.RandomState(1))
+        self.assertEqual(replicas.shape, (5, 3))
+
+        # Yields without events or variance aren't fluctuated
+        self.assertEqual(list(replicas[:, 1]), [0.0] * 5)
+        self.assertEqual(list(replicas[:, 2]), [50.0] * 5)
+
+    def test_bootstrap(self):
+        low, median, high = bootstrap(self.yields,
+                                      self.yields,
+                                      replicas = 2000)
+        ratio, stat = r_qcd(self.yields[0, 0] - self.yields[1, 0],
+                            self.yields[0, 1] - self.yields[1, 1])
+        for i in range(2):
+            self.assertAlmostEqual(median[i], ratio[i], delta = 0.05)
+            self.assertLess(low[i], ratio[i] - 0.5 * stat[i])
+            self.assertGreater(high[i], ratio[i] + 0.5 * stat[i])
+
+    def test_seeded(self):
+        self.assertEqual(
+            bootstrap(self.yields, self.yields, 100, seed = 3).tolist(),
+            bootstrap(self.yields, self.yields, 100, seed = 3).tolist()
+        )
+
+
+class TestTables(unittest.TestCase):
+    def setUp(self):
+        self.path = mkdtemp()
+        self.file = join(self.path, 'rqcd.json')
+
+    def tearDown(self):
+        rmtree(self.path)
+
+    def test_defaults(self):
+        table = RqcdTable([('a', [('all', 1.0, 0.1, 0.2)])],
+                          {'a': [('all', 9.0, 0.0, 0.0)],
+                           'b': [('all', 2.0, 0.1, 0.2)]})
+        self.assertEqual(table.labels(), ['a', 'b'])
+        self.assertEqual(table['a'], (('all', 1.0, 0.1, 0.2),))
+        self.assertIn('b', table)
+        self.assertEqual(len(table), 2)
+
+    def test_digest(self):
+        self.assertEqual(splits_digest([('all', 1.0, 0.1, 0.2)]),
+                         splits_digest((['all', 1.0, 0.1, 0.2],)))
+        self.assertNotEqual(splits_digest([('all', 1.0, 0.1, 0.2)]),
+                            splits_digest([('all', 1.1, 0.1, 0.2)]))
+
+    def test_round_trip(self):
+        save(self.file, '2015', 'inputs', {'a': [('all', 1.0, 0.1, 0.2)]})
+        save(self.file, '2016', 'inputs', {'a': [('all', 2.0, 0.1, 0.2)]})
+        save(self.file, '2015', 'other', {'b': [('all', 3.0, 0.1, 0.2)]})
+
+        table = load(self.file, '2015')
+        self.assertEqual(table.labels(), ['a', 'b'])
+        self.assertEqual(table['a'], (('all', 1.0, 0.1, 0.2),))
+
+        # Values derived from other inputs are ignored
+        table = load(self.file, '2015', 'inputs')
+        self.assertEqual(table.labels(), ['a'])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,94 @@
+# System imports
+import unittest
+from shutil import rmtree
+from tempfile import mkdtemp
+from uuid import uuid4
+
+# The store works on ROOT histograms and owls-hep uncertainties
+try:
+    from ROOT import TH1D
+    from owls_hep.uncertainty import Uncertainty
+    from owls_mutau.store import Store
+except ImportError as e:
+    raise unittest.SkipTest('store dependencies unavailable: {}'.format(e))
+
+
+class ShapeSyst(Uncertainty):
+    name = 'TEST_STORE_SHAPE'
+
+    def __call__(self, process, region):
+        raise AssertionError('stored systematic was computed')
+
+
+def histogram(contents):
+    result = TH1D(uuid4().hex, 'title', len(contents), 0.0, len(contents))
+    result.SetDirectory(0)
+    for b, c in enumerate(contents):
+        result.SetBinContent(b + 1, c)
+        result.SetBinError(b + 1, c ** 0.5)
+    return result
+
+
+def contents(histogram):
+    return [histogram.GetBinContent(b)
+            for b
+            in range(histogram.GetNbinsX() + 2)]
+
+
+class TestStore(unittest.TestCase):
+    def setUp(self):
+        self.path = mkdtemp()
+        self.nominal = histogram([4.0, 9.0])
+        self.up = histogram([5.0, 10.0])
+        self.down = histogram([3.0, 8.0])
+
+    def tearDown(self):
+        rmtree(self.path)
+
+    def write(self, store, sample = 'ttbar', digest = 'osss'):
+        store.write('region', 'distribution', {
+            sample: (self.nominal,
+                     {ShapeSyst: (1.1, 0.9, self.up, self.down)}),
+        }, {sample: digest})
+
+    def test_round_trip(self):
+        self.write(Store(self.path, 'inputs', 'model'))
+        entry = Store(self.path, 'inputs', 'model').entry('region',
+                                                          'distribution')
+        self.assertTrue(entry.covers('ttbar', [ShapeSyst], 'osss'))
+
+        # Read the systematic through the estimation wrapper, which is
+        # called with an uncertainty instance
+        nominal = self.nominal
+        calculation = lambda process, region: nominal.Clone(uuid4().hex)
+        estimation = entry.estimation(lambda c: c, 'ttbar', 'osss')
+        overall_up, overall_down, up, down = \
+                estimation(ShapeSyst(calculation))(None, None)
+        self.assertEqual((overall_up, overall_down), (1.1, 0.9))
+        self.assertEqual(contents(up), contents(self.up))
+        self.assertEqual(contents(down), contents(self.down))
+        self.assertAlmostEqual(up.GetBinError(2), 5.0 ** 0.5)
+
+    def test_invalidation(self):
+        self.write(Store(self.path, 'inputs', 'model'))
+
+        # Changed inputs, models and estimations don't see the entry
+        self.assertIsNone(Store(self.path, 'other', 'model'). \
+                          entry('region', 'distribution'))
+        self.assertIsNone(Store(self.path, 'inputs', 'other'). \
+                          entry('region', 'distribution'))
+        entry = Store(self.path, 'inputs', 'model').entry('region',
+                                                          'distribution')
+        self.assertFalse(entry.covers('ttbar', [ShapeSyst], 'mc'))
+
+    def test_merge(self):
+        store = Store(self.path, 'inputs', 'model')
+        self.write(store, 'ttbar')
+        self.write(store, 'wlnu')
+        entry = store.entry('region', 'distribution')
+        self.assertTrue(entry.covers('ttbar', [ShapeSyst], 'osss'))
+        self.assertTrue(entry.covers('wlnu', [ShapeSyst], 'osss'))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,107 @@
+#!/usr/bin/env python
+# encoding: utf-8
+
+
+# System imports
+import argparse
+import sys
+from os import devnull
+from os.path import join, dirname, abspath
+from subprocess import call
+from timeit import default_timer
+
+
+# The tools to benchmark by default
+TOOLS = (
+    'compare-efficiencies.py',
+    'compute-rqcd.py',
+    'plot-compare.py',
+    'plot-fake-composition.py',
+    'plot-syst-variation.py',
+    'plot-tau-efficiency.py',
+    'plot.py',
+)
+
+# The owls-mutau modules to benchmark by default
+MODULES = (
+    'owls_mutau.expression',
+    'owls_mutau.cuts',
+    'owls_mutau.regions',
+    'owls_mutau.manifest',
+    'owls_mutau.styling',
+    'owls_mutau.histogramming',
+)
+
+# Parse command line arguments
+parser = argparse.ArgumentParser(
+    description = 'Measure the startup time of the tools and the import time '
+                  'of the owls-mutau modules'
+)
+parser.add_argument('-n',
+                    '--repeat',
+                    type = int,
+                    default = 5,
+                    help = 'the number of runs per command',
+                    metavar = '<count>')
+parser.add_argument('-t',
+                    '--tools',
+                    nargs = '*',
+                    default = TOOLS,
+                    help = 'the tools to run with --help',
+                    metavar = '<tool>')
+parser.add_argument('-m',
+                    '--modules',
+                    nargs = '*',
+                    default = MODULES,
+                    help = 'the modules to import',
+                    metavar = '<module>')
+arguments = parser.parse_args()
+
+
+def timed(command):
+    """Runs a command repeatedly.
+
+    Args:
+        command: The command, as a list of arguments
+
+    Returns:
+        A tuple of (times, status), where times is a sorted list of the wall
+        times of all runs, and status is the exit status of the last run.
+    """
+    times = []
+    status = None
+    with open(devnull, 'w') as output:
+        for _ in range(arguments.repeat):
+            start = default_timer()
+            status = call(command, stdout = output, stderr = output)
+            times.append(default_timer() - start)
+    return sorted(times), status
+
+
+def report(name, times, status):
+    print('{:40s} {:8.3f} {:8.3f} {:8.3f} {}'.format(
+        name,
+        times[0],
+        times[len(times) // 2],
+        times[-1],
+        'ok' if status == 0 else 'exit status {}'.format(status)
+    ))
+
+
+# Print a header
+print('{:40s} {:>8s} {:>8s} {:>8s}'.format('Command', 'Min [s]',
+                                           'Median', 'Max'))
+
+# Measure the bare interpreter as a baseline
+report('python', *timed([sys.executable, '-c', 'pass']))
+
+# Measure the tools, which should return without loading ROOT for --help
+tools = dirname(abspath(__file__))
+for tool in arguments.tools:
+    report('{} --help'.format(tool),
+           *timed([sys.executable, join(tools, tool), '--help']))
+
+# Measure the module imports
+for module in arguments.modules:
+    report('import {}'.format(module),
+           *timed([sys.executable, '-c', 'import {}'.format(module)]))
@@ -10,26 +10,6 @@ from array import array
 from functools import partial
 from uuid import uuid4
 
-# owls-cache imports
-from owls_cache.persistent import caching_into
-
-# owls-hep imports
-from owls_hep.module import load as load_module
-from owls_hep.utility import load_file
-from owls_hep.plotting import Plot
-from owls_mutau.styling import standard_style
-
-from ROOT import TLine, TF1, TGraph, TGraphAsymmErrors, gStyle
-
-Plot.PLOT_LEGEND_LEFT = 0.60
-Plot.PLOT_LEGEND_RIGHT = 1.0
-Plot.PLOT_LEGEND_TEXT_SIZE = 0.035
-Plot.PLOT_LEGEND_TEXT_SIZE_WITH_RATIO = 0.05
-Plot.PLOT_LEGEND_ROW_SIZE = 0.07
-Plot.PLOT_LEGEND_ROW_SIZE_WITH_RATIO = 0.10
-Plot.PLOT_HEADER_HEIGHT = 300
-Plot.PLOT_Y_AXIS_TITLE_OFFSET = 1.1
-Plot.PLOT_Y_AXIS_TITLE_OFFSET_WITH_RATIO = 0.8
 
 # Parse command line arguments
 parser = argparse.ArgumentParser(
@@ -72,6 +52,30 @@ parser.add_argument('definitions',
                     metavar = '<definition>')
 arguments = parser.parse_args()
 
+# Import the ROOT-based modules only once the arguments are parsed, so that
+# --help and argument errors return without initializing PyROOT
+
+# owls-cache imports
+from owls_cache.persistent import caching_into
+
+# owls-hep imports
+from owls_hep.module import load as load_module
+from owls_hep.utility import load_file
+from owls_hep.plotting import Plot
+from owls_mutau.styling import standard_style
+
+from ROOT import TLine, TF1, TGraph, TGraphAsymmErrors, gStyle
+
+Plot.PLOT_LEGEND_LEFT = 0.60
+Plot.PLOT_LEGEND_RIGHT = 1.0
+Plot.PLOT_LEGEND_TEXT_SIZE = 0.035
+Plot.PLOT_LEGEND_TEXT_SIZE_WITH_RATIO = 0.05
+Plot.PLOT_LEGEND_ROW_SIZE = 0.07
+Plot.PLOT_LEGEND_ROW_SIZE_WITH_RATIO = 0.10
+Plot.PLOT_HEADER_HEIGHT = 300
+Plot.PLOT_Y_AXIS_TITLE_OFFSET = 1.1
+Plot.PLOT_Y_AXIS_TITLE_OFFSET_WITH_RATIO = 0.8
+
 
 # Parse definitions
 definitions = dict((d.split('=') for d in arguments.definitions))
@@ -10,26 +10,6 @@ from os.path import join, exists
 
 from six import iteritems
 
-# owls-cache imports
-from owls_cache.persistent import caching_into
-
-# owls-parallel imports
-from owls_parallel import ParallelizedEnvironment
-
-# owls-hep imports
-from owls_hep.module import load as load_module
-from owls_hep.counting import Count
-from owls_hep.utility import integral
-from owls_hep.histogramming import Histogram
-from owls_hep.plotting import Plot, ratio_histogram
-from owls_hep.variations import Filtered
-
-# owls-mutau imports
-from owls_mutau.variations import OS, SS
-from owls_mutau.styling import default_black, default_red
-
-Plot.PLOT_RATIO_Y_AXIS_TITLE_OFFSET = 0.50
-Plot.PLOT_LEGEND_LEFT = 0.70
 
 # Parse command line arguments
 parser = argparse.ArgumentParser(
@@ -78,11 +58,76 @@ parser.add_argument('-x',
 parser.add_argument('--high-pt',
                     action = 'store_true',
                     help = 'Use high pT rQCD derivation')
+parser.add_argument('--rqcd-file',
+                    help = 'the rQCD file to write the values to (default: '
+                           'rqcd.json in the output directory)',
+                    metavar = '<rqcd-file>')
+parser.add_argument('--scan-bins',
+                    type = int,
+                    default = 300,
+                    help = 'the number of bins of the isolation scan in '
+                           'vectorized mode, a multiple of 30 (default: 300)',
+                    metavar = '<bins>')
+parser.add_argument('--bootstrap',
+                    type = int,
+                    default = 0,
+                    help = 'estimate the statistical uncertainty from this '
+                           'many Poisson replicas in vectorized mode',
+                    metavar = '<replicas>')
+parser.add_argument('--seed',
+                    type = int,
+                    default = 0,
+                    help = 'the seed of the bootstrap replicas',
+                    metavar = '<seed>')
+parser.add_argument('--vectorized',
+                    action = 'store_true',
+                    help = 'fill all regions and splits in one pass per '
+                           'process and derive rQCD for the whole table at '
+                           'once')
 parser.add_argument('definitions',
                     nargs = '*',
                     help = 'definitions to use within modules in the form x=y',
                     metavar = '<definition>')
 arguments = parser.parse_args()
+if arguments.bootstrap > 0 and not arguments.vectorized:
+    parser.error('--bootstrap requires --vectorized')
+# The thresholds of the isolation systematics (the 30 bins of ptcone_syst
+# and etcone_syst) have to be edges of the scan binning, since they are looked
+# up in the scan
+if arguments.scan_bins <= 0 or arguments.scan_bins % 30 != 0:
+    parser.error('--scan-bins must be a positive multiple of 30')
+
+# Import the ROOT-based modules only once the arguments are parsed, so that
+# --help and argument errors return without initializing PyROOT
+
+# owls-cache imports
+from owls_cache.persistent import caching_into
+
+# owls-parallel imports
+from owls_parallel import ParallelizedEnvironment
+
+# owls-hep imports
+from owls_hep.module import load as load_module
+from owls_hep.counting import Count
+from owls_hep.utility import integral
+from owls_hep.plotting import Plot, ratio_histogram
+from owls_hep.variations import Filtered
+
+# owls-mutau imports
+from owls_mutau.variations import OS, SS
+from owls_mutau.histogramming import Histogram, fill_together, \
+        family_filled, bin_edges
+from owls_mutau.pruning import yield_histogram
+from owls_mutau.rqcd import subtracted, r_qcd as r_qcd_table, cumulative, \
+        IsolationScan, bootstrap, save as save_rqcd
+from owls_mutau.store import inputs_digest
+from owls_mutau.styling import default_black, default_red
+
+# numpy imports
+import numpy
+
+Plot.PLOT_RATIO_Y_AXIS_TITLE_OFFSET = 0.50
+Plot.PLOT_LEGEND_LEFT = 0.70
 
 
 # Parse definitions
@@ -126,6 +171,24 @@ etcone_syst = Histogram(
     'Events'
 )
 
+# Finely binned isolation distributions for the isolation scan, which are
+# filled together with the ones above
+ptcone_scan = Histogram(
+    'lep_0_iso_ptvarcone30/lep_0_pt/1000.0',
+    (arguments.scan_bins, 0.1, 0.4),
+    '',
+    'ptvarcone30/p_{T}',
+    'Events'
+)
+
+etcone_scan = Histogram(
+    'lep_0_iso_topoetcone20/lep_0_et/1000.0',
+    (arguments.scan_bins, 0.1, 0.4),
+    '',
+    'topoetcone20/E_{T}',
+    'Events'
+)
+
 if arguments.high_pt:
     all_splits = {
         'default': [('all', ''),],
@@ -150,13 +213,21 @@ backend = getattr(environment_file, 'parallelization_backend', None)
 # Create the parallelization environment
 parallel = ParallelizedEnvironment(backend)
 
+def contents(histogram):
+    return [histogram.GetBinContent(b)
+            for b
+            in range(histogram.GetNbinsX() + 2)]
+
 def sum_cumulative(histogram):
-    for i in range(1, histogram.GetNbinsX()+1):
-        cumulative_count = integral(histogram,
-                                    bin_range = (i+1, histogram.GetNbinsX()+1))
+    for i, cumulative_count in enumerate(cumulative(contents(histogram))):
         stat_error = sqrt(cumulative_count)
-        histogram.SetBinContent(i, cumulative_count)
-        histogram.SetBinError(i, stat_error)
+        histogram.SetBinContent(i + 1, cumulative_count)
+        histogram.SetBinError(i + 1, stat_error)
+
+def splits_of(region_name):
+    if '3p' in region_name and '3p' in all_splits:
+        return all_splits['3p']
+    return all_splits['default']
 
 def compute_syst(region, distribution, label, file_name):
     os = distribution(data['process'], region.varied(OS()))
@@ -178,6 +249,9 @@ def compute_syst(region, distribution, label, file_name):
         #if not parallel.capturing():
             #print('Sum OS/SS: {}/{}'.format(integral(os), integral(ss)))
 
+    return draw_syst(region, os, ss, distribution, label, file_name)
+
+def draw_syst(region, os, ss, distribution, label, file_name):
     sum_cumulative(os)
     sum_cumulative(ss)
     ratio = ratio_histogram(os, ss)
@@ -219,101 +293,246 @@ base_path = arguments.output
 if not exists(base_path):
     makedirs(base_path)
 
-# Run in a cached environment
-with caching_into(cache):
+def derive_vectorized():
+    # List all (region, split) entries of the table, and the OS and SS
+    # variant of each
+    entries = []
+    for region_name, region in iteritems(regions):
+        for label, split in splits_of(region_name):
+            entries.append((region_name,
+                            region,
+                            label,
+                            split,
+                            region.varied(Filtered(split))))
+    charged = tuple(r.varied(c)
+                    for _, _, _, _, r
+                    in entries
+                    for c
+                    in (OS(), SS()))
+    processes = [data['process']] + [b['process']
+                                     for n, b
+                                     in iteritems(backgrounds)
+                                     if n != 'ss_data']
+    distributions = (yield_histogram,
+                     ptcone_syst,
+                     etcone_syst,
+                     ptcone_scan,
+                     etcone_scan)
+
+    # Fill the yields and isolation distributions of all entries in one pass
+    # per process
+    fill_together(distributions)
+    for region_name, _, _, _, _ in entries:
+        r_qcd_dict[regions[region_name].metadata()['rqcd']] = []
     while parallel.run():
-        # Loop over regions
-        for region_name in regions:
-            region = regions[region_name]
-            r_qcd_name = region.metadata()['rqcd']
-            r_qcd_dict[r_qcd_name] = []
-
-            if '3p' in region_name and '3p' in all_splits:
-                splits = all_splits['3p']
-            else:
-                splits = all_splits['default']
-
-            for label,split in splits:
-                # Create a filter of the splitting parameter and vary the
-                # region according to the split
-                f = Filtered(split)
-                r = region.varied(f)
-
-                # Get counts from data
-                ss_counts = Count()(data['process'], r.varied(SS()))
-                os_counts = Count()(data['process'], r.varied(OS()))
-
-                # Subtract MC backgrounds
-                for name,background in iteritems(backgrounds):
-                    if name == 'ss_data':
-                        continue
-                    process = background['process']
-                    ss_counts -= Count()(process, r.varied(SS()))
-                    os_counts -= Count()(process, r.varied(OS()))
-
-                r_qcd_raw_syst_ptcone = \
-                        compute_syst(r,
-                                     ptcone_syst,
-                                     split,
-                                     '{}_{}_ptvarcone30'. \
-                                     format(region_name, label))
-                r_qcd_raw_syst_etcone = \
-                        compute_syst(r,
-                                     etcone_syst,
-                                     split,
-                                     '{}_{}_topoetcone20'. \
-                                     format(region_name, label))
-
-                if parallel.capturing():
-                    continue
-
-                ss_stat = sqrt(ss_counts)
-                os_stat = sqrt(os_counts)
-
-                # print('{0}: Counts OS = {1:.0f}±{2:.1f}, SS = {3:.0f}±{4:.1f}'. \
-                      # format(r.label(),
-                             # os_counts,
-                             # os_stat,
-                             # ss_counts,
-                             # ss_stat))
+        filled = [[family_filled(p, charged, d) for d in distributions]
+                  for p
+                  in processes]
+        if parallel.capturing():
+            continue
 
-                # Compute rQCD and errors
-                try:
-                    r_qcd = os_counts / ss_counts
-                except ZeroDivisionError,e:
+        # Assemble the data minus background bin contents into arrays of
+        # shape (entry, charge, bin)
+        tables = []
+        for i in range(len(distributions)):
+            table = [numpy.array([contents(h) for h in f[i]])
+                     for f
+                     in filled]
+            tables.append(subtracted(table[0], table[1:]). \
+                          reshape(len(entries), 2, -1))
+        counts = tables[0].sum(axis = -1)
+
+        # Compute rQCD and errors for the whole table
+        try:
+            r_qcd, r_qcd_stat = r_qcd_table(counts[:, 0], counts[:, 1])
+        except ZeroDivisionError:
+            for (_, region, _, split, _), ss_counts \
+                    in zip(entries, counts[:, 1]):
+                if ss_counts == 0:
                     print('Error: No SS counts for region {} and split {}'. \
                           format(region.label(), split))
-                    raise e
-
-                r_qcd_stat = sqrt((os_stat / os_counts)**2 +
-                                  (ss_stat / ss_counts)**2) * r_qcd
-                r_qcd_syst_ptcone = r_qcd_raw_syst_ptcone / r_qcd
-                r_qcd_syst_etcone = r_qcd_raw_syst_etcone / r_qcd
-                r_qcd_syst = sqrt(r_qcd_syst_ptcone**2 + r_qcd_syst_etcone**2)
+            raise
+
+        # Replace the statistical uncertainty by half the central 68%
+        # interval of the bootstrapped rQCD distribution
+        if arguments.bootstrap > 0:
+            yields = numpy.array([[[h.GetBinContent(1) for h in f[0][c::2]]
+                                   for c
+                                   in (0, 1)]
+                                  for f
+                                  in filled])
+            variances = numpy.array([[[h.GetBinError(1) ** 2
+                                       for h
+                                       in f[0][c::2]]
+                                      for c
+                                      in (0, 1)]
+                                     for f
+                                     in filled])
+            low, median, high = bootstrap(yields,
+                                          variances,
+                                          arguments.bootstrap,
+                                          arguments.seed)
+            r_qcd_stat = (high - low) / 2.0
+            for (_, region, _, split, _), m, l, h \
+                    in zip(entries, median, low, high):
+                print('{} {}: bootstrapped r_QCD = {:.3f} +{:.3f} -{:.3f}'. \
+                      format(region.label(), split, m, h - m, m - l))
+
+        # Scan rQCD over the isolation thresholds of the original binning
+        scans = dict((name, IsolationScan(bin_edges(distributions[d]. \
+                                                    binning()),
+                                          tables[d][:, 0],
+                                          tables[d][:, 1]))
+                     for d, name
+                     in ((3, 'ptvarcone30'), (4, 'topoetcone20')))
+        r_qcd_syst_ptcone = scans['ptvarcone30']. \
+                syst(bin_edges(ptcone_syst.binning())[1:]) / r_qcd
+        r_qcd_syst_etcone = scans['topoetcone20']. \
+                syst(bin_edges(etcone_syst.binning())[1:]) / r_qcd
+        r_qcd_syst = numpy.sqrt(r_qcd_syst_ptcone ** 2 + r_qcd_syst_etcone ** 2)
+
+        # Save the scans, so that rQCD can be studied for other thresholds
+        # without filling again
+        arrays = {'entries': ['{}_{}'.format(e[0], e[2]) for e in entries]}
+        for name, scan in iteritems(scans):
+            for key, array in iteritems(scan.arrays()):
+                arrays['{}_{}'.format(name, key)] = array
+        numpy.savez(join(base_path, 'isolation_scan.npz'), **arrays)
+
+        for i, (region_name, region, label, split, r) in enumerate(entries):
+            # Draw the isolation plots
+            for d, name in ((1, 'ptvarcone30'), (2, 'topoetcone20')):
+                histograms = [f[d] for f in filled]
+                os = histograms[0][2 * i]
+                ss = histograms[0][2 * i + 1]
+                for background in histograms[1:]:
+                    os = os - background[2 * i]
+                    ss = ss - background[2 * i + 1]
+                draw_syst(r,
+                          os,
+                          ss,
+                          distributions[d],
+                          split,
+                          '{}_{}_{}'.format(region_name, label, name))
+
+            # Round to 3 decimals
+            r_qcd_dict[region.metadata()['rqcd']].append(
+                (split,
+                 round(r_qcd[i], 3),
+                 round(r_qcd_stat[i], 3),
+                 round(r_qcd_syst[i], 3))
+            )
+
+    # Print the result
+    for region_name, region in iteritems(regions):
+        print('{}:'.format(region.label()))
+        for e in r_qcd_dict[region.metadata()['rqcd']]:
+            print('    {0:35s}: {1:.2f} ± {2:.2f} ± {3:.2f}'.format(*e))
 
-                # Round to 3 decimals
-                r_qcd = round(r_qcd, 3)
-                r_qcd_stat = round(r_qcd_stat, 3)
-                r_qcd_syst = round(r_qcd_syst, 3)
-                r_qcd_dict[r_qcd_name].append(
-                    (split, r_qcd, r_qcd_stat, r_qcd_syst)
-                )
+# Run in a cached environment
+with caching_into(cache):
+    if arguments.vectorized:
+        derive_vectorized()
+    else:
+        while parallel.run():
+            # Loop over regions
+            for region_name in regions:
+                region = regions[region_name]
+                r_qcd_name = region.metadata()['rqcd']
+                r_qcd_dict[r_qcd_name] = []
+
+                splits = splits_of(region_name)
+
+                for label,split in splits:
+                    # Create a filter of the splitting parameter and vary the
+                    # region according to the split
+                    f = Filtered(split)
+                    r = region.varied(f)
+
+                    # Get counts from data
+                    ss_counts = Count()(data['process'], r.varied(SS()))
+                    os_counts = Count()(data['process'], r.varied(OS()))
+
+                    # Subtract MC backgrounds
+                    for name,background in iteritems(backgrounds):
+                        if name == 'ss_data':
+                            continue
+                        process = background['process']
+                        ss_counts -= Count()(process, r.varied(SS()))
+                        os_counts -= Count()(process, r.varied(OS()))
+
+                    r_qcd_raw_syst_ptcone = \
+                            compute_syst(r,
+                                         ptcone_syst,
+                                         split,
+                                         '{}_{}_ptvarcone30'. \
+                                         format(region_name, label))
+                    r_qcd_raw_syst_etcone = \
+                            compute_syst(r,
+                                         etcone_syst,
+                                         split,
+                                         '{}_{}_topoetcone20'. \
+                                         format(region_name, label))
+
+                    if parallel.capturing():
+                        continue
 
-                # print('{}: r_QCD = {:.2f} ± {:.2f}(stat) ± '
-                      # '{:.2f}(pt) ± {:.2f}(et)'. \
-                      # format(region.label(), r_qcd, r_qcd_stat,
-                             # r_qcd_syst_ptcone, r_qcd_syst_etcone))
+                    ss_stat = sqrt(ss_counts)
+                    os_stat = sqrt(os_counts)
+
+                    # print('{0}: Counts OS = {1:.0f}±{2:.1f}, SS = {3:.0f}±{4:.1f}'. \
+                          # format(r.label(),
+                                 # os_counts,
+                                 # os_stat,
+                                 # ss_counts,
+                                 # ss_stat))
+
+                    # Compute rQCD and errors
+                    try:
+                        r_qcd = os_counts / ss_counts
+                    except ZeroDivisionError,e:
+                        print('Error: No SS counts for region {} and split {}'. \
+                              format(region.label(), split))
+                        raise e
+
+                    r_qcd_stat = sqrt((os_stat / os_counts)**2 +
+                                      (ss_stat / ss_counts)**2) * r_qcd
+                    r_qcd_syst_ptcone = r_qcd_raw_syst_ptcone / r_qcd
+                    r_qcd_syst_etcone = r_qcd_raw_syst_etcone / r_qcd
+                    r_qcd_syst = sqrt(r_qcd_syst_ptcone**2 + r_qcd_syst_etcone**2)
+
+                    # Round to 3 decimals
+                    r_qcd = round(r_qcd, 3)
+                    r_qcd_stat = round(r_qcd_stat, 3)
+                    r_qcd_syst = round(r_qcd_syst, 3)
+                    r_qcd_dict[r_qcd_name].append(
+                        (split, r_qcd, r_qcd_stat, r_qcd_syst)
+                    )
+
+                    # print('{}: r_QCD = {:.2f} ± {:.2f}(stat) ± '
+                          # '{:.2f}(pt) ± {:.2f}(et)'. \
+                          # format(region.label(), r_qcd, r_qcd_stat,
+                                 # r_qcd_syst_ptcone, r_qcd_syst_etcone))
 
-            if parallel.capturing():
-                continue
+                if parallel.capturing():
+                    continue
 
-            # Print the result
-            print('{}:'.format(region.label()))
-            for e in r_qcd_dict[r_qcd_name]:
-                print('    {0:35s}: {1:.2f} ± {2:.2f} ± {3:.2f}'.format(*e))
+                # Print the result
+                print('{}:'.format(region.label()))
+                for e in r_qcd_dict[r_qcd_name]:
+                    print('    {0:35s}: {1:.2f} ± {2:.2f} ± {3:.2f}'.format(*e))
 
 
 with open(join(base_path, 'rqcd.txt'), 'w') as f:
     for k,v in r_qcd_dict.iteritems():
         f.write('\'{}\': {},\n'.format(k, v))
     f.write('\n')
+
+# Write the values to the rQCD file, which model modules can load with the
+# rqcd_file definition
+rqcd_path = arguments.rqcd_file or join(base_path, 'rqcd.json')
+rqcd_inputs = inputs_digest((arguments.model_file, arguments.regions_file),
+                            definitions)
+save_rqcd(rqcd_path, definitions.get('year', ''), rqcd_inputs, r_qcd_dict)
+print('Wrote rQCD values to {} (load them with rqcd_file={} '
+      'rqcd_inputs={})'.format(rqcd_path, rqcd_path, rqcd_inputs))
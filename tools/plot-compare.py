@@ -14,27 +14,6 @@ from copy import copy
 from six import itervalues
 from six.moves import range
 
-# owls-cache imports
-from owls_cache.persistent import caching_into
-
-# owls-parallel imports
-from owls_parallel import ParallelizedEnvironment
-
-# owls-hep imports
-from owls_hep.module import load as load_module
-from owls_hep.plotting import Plot, combined_histogram, ratio_histogram
-from owls_hep.utility import integral, get_bins_errors
-
-# owls-mutau imports
-from owls_mutau.styling import default_black, default_red
-
-Plot.PLOT_HEADER_HEIGHT = 500
-Plot.PLOT_LEGEND_LEFT = 0.50
-Plot.PLOT_LEGEND_RIGHT = 0.95
-Plot.PLOT_LEGEND_TEXT_SIZE = 0.05
-Plot.PLOT_LEGEND_TEXT_SIZE_WITH_RATIO = 0.055
-Plot.PLOT_LEGEND_ROW_SIZE = 0.06
-Plot.PLOT_LEGEND_ROW_SIZE_WITH_RATIO = 0.065
 
 # Parse command line arguments
 parser = argparse.ArgumentParser(
@@ -139,6 +118,32 @@ parser.add_argument('definitions',
                     metavar = '<definition>')
 arguments = parser.parse_args()
 
+# Import the ROOT-based modules only once the arguments are parsed, so that
+# --help and argument errors return without initializing PyROOT
+
+# owls-cache imports
+from owls_cache.persistent import caching_into
+
+# owls-parallel imports
+from owls_parallel import ParallelizedEnvironment
+
+# owls-hep imports
+from owls_hep.module import load as load_module
+from owls_hep.plotting import Plot, combined_histogram, ratio_histogram
+from owls_hep.utility import integral, get_bins_errors
+
+# owls-mutau imports
+from owls_mutau.styling import default_black, default_red
+from owls_mutau.histogramming import fill_together
+
+Plot.PLOT_HEADER_HEIGHT = 500
+Plot.PLOT_LEGEND_LEFT = 0.50
+Plot.PLOT_LEGEND_RIGHT = 0.95
+Plot.PLOT_LEGEND_TEXT_SIZE = 0.05
+Plot.PLOT_LEGEND_TEXT_SIZE_WITH_RATIO = 0.055
+Plot.PLOT_LEGEND_ROW_SIZE = 0.06
+Plot.PLOT_LEGEND_ROW_SIZE_WITH_RATIO = 0.065
+
 
 # Parse definitions
 definitions = dict((d.split('=') for d in arguments.definitions))
@@ -166,6 +171,11 @@ distributions = dict((
     in arguments.distributions
 ))
 
+# Fill all requested distributions of a selection in a single pass. The fills
+# are cached per distribution, so later runs with other distributions only
+# fill the ones which aren't cached yet.
+fill_together(distributions[d] for d in sorted(distributions))
+
 # Get computation environment
 cache = getattr(environment_file, 'persistent_cache', None)
 backend = getattr(environment_file, 'parallelization_backend', None)
@@ -4,18 +4,6 @@ from os import makedirs
 from os.path import join, exists
 from itertools import product
 
-# owls-cache imports
-from owls_cache.persistent import caching_into
-
-# owls-parallel imports
-from owls_parallel import ParallelizedEnvironment
-
-# owls-hep imports
-from owls_hep.module import load as load_module
-from owls_hep.plotting import Plot, histogram_stack
-from owls_hep.utility import integral
-
-Plot.PLOT_Y_AXIS_TITLE_OFFSET = 1.5
 
 usage_desc = '''\
 Draw true taus, lepton fakes, b-jet fakes, and light jet fakes.
@@ -72,6 +60,22 @@ parser.add_argument('definitions',
                     metavar = '<definition>')
 arguments = parser.parse_args()
 
+# Import the ROOT-based modules only once the arguments are parsed, so that
+# --help and argument errors return without initializing PyROOT
+
+# owls-cache imports
+from owls_cache.persistent import caching_into
+
+# owls-parallel imports
+from owls_parallel import ParallelizedEnvironment
+
+# owls-hep imports
+from owls_hep.module import load as load_module
+from owls_hep.plotting import Plot, histogram_stack
+from owls_hep.utility import integral
+
+Plot.PLOT_Y_AXIS_TITLE_OFFSET = 1.5
+
 
 # Parse definitions
 definitions = dict((d.split('=') for d in arguments.definitions))
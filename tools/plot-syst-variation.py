@@ -4,40 +4,10 @@ import argparse
 from os import makedirs
 from os.path import join, exists
 from itertools import product
+from collections import OrderedDict
 
-from six import itervalues
+from six import itervalues, iteritems
 
-# owls-cache imports
-from owls_cache.persistent import caching_into
-
-# owls-parallel imports
-from owls_parallel import ParallelizedEnvironment
-
-# owls-hep imports
-from owls_hep.module import load as load_module
-from owls_hep.plotting import Plot, style_histogram, combined_histogram
-from owls_hep.utility import integral
-
-# owls-mutau imports
-from owls_mutau.styling import default_black_line, default_red_line, \
-        default_blue_line
-from owls_mutau.uncertainties import TestSystFlat, TestSystShape, \
-        MuonEffStat, MuonEffSys, \
-        MuonEffTrigStat, MuonEffTrigSys, \
-        MuonIsoStat, MuonIsoSys, \
-        MuonIdSys, MuonMsSys, MuonScaleSys, \
-        RqcdStat, RqcdSyst, \
-        PileupSys, \
-        BJetEigenB0, BJetEigenB1, BJetEigenB2, BJetEigenB3, BJetEigenB4, \
-        BJetEigenC0, BJetEigenC1, BJetEigenC2, BJetEigenC3, \
-        BJetEigenLight0, BJetEigenLight1, BJetEigenLight2, BJetEigenLight3, \
-        BJetEigenLight4, BJetEigenLight5, BJetEigenLight6, BJetEigenLight7, \
-        BJetEigenLight8, BJetEigenLight9, BJetEigenLight10, BJetEigenLight11, \
-        BJetEigenLight12, BJetEigenLight13, \
-        BJetExtrapolation
-
-Plot.PLOT_Y_AXIS_TITLE_OFFSET = 1.5
-Plot.PLOT_LEGEND_LEFT = 0.5
 
 usage_desc = '''\
 Draw true taus, lepton fakes, b-jet fakes, and light jet fakes.
@@ -98,12 +68,67 @@ parser.add_argument('-x',
                     nargs = '+',
                     default = ['pdf'],
                     help = 'save these extensions (default: pdf)')
+parser.add_argument('--prune-threshold',
+                    type = float,
+                    default = None,
+                    help = 'prune systematics with a smaller relative shift '
+                    'of the yield and of every bin of a coarse reference '
+                    'distribution',
+                    metavar = '<fraction>')
+parser.add_argument('--prune-stat-threshold',
+                    type = float,
+                    default = None,
+                    help = 'prune systematics with a shift of the yield '
+                    'and of every reference bin smaller than this fraction '
+                    'of its statistical uncertainty',
+                    metavar = '<fraction>')
+parser.add_argument('--store',
+                    help = 'the directory of the systematic variation store',
+                    metavar = '<store>')
 parser.add_argument('definitions',
                     nargs = '*',
                     help = 'definitions to use within modules in the form x=y',
                     metavar = '<definition>')
 arguments = parser.parse_args()
 
+# Import the ROOT-based modules only once the arguments are parsed, so that
+# --help and argument errors return without initializing PyROOT
+
+# owls-cache imports
+from owls_cache.persistent import caching_into
+
+# owls-parallel imports
+from owls_parallel import ParallelizedEnvironment
+
+# owls-hep imports
+from owls_hep.module import load as load_module
+from owls_hep.plotting import Plot, style_histogram, combined_histogram
+from owls_hep.utility import integral
+
+# owls-mutau imports
+from owls_mutau.pruning import Pruning, measure, coarse
+from owls_mutau.store import Store, inputs_digest
+from owls_mutau.estimation import estimation_digest
+from owls_mutau.styling import default_black_line, default_red_line, \
+        default_blue_line
+from owls_mutau.uncertainties import TestSystFlat, TestSystShape, \
+        MuonEffStat, MuonEffSys, \
+        MuonEffTrigStat, MuonEffTrigSys, \
+        MuonIsoStat, MuonIsoSys, \
+        MuonIdSys, MuonMsSys, MuonScaleSys, \
+        RqcdStat, RqcdSyst, \
+        PileupSys, \
+        BJetEigenB0, BJetEigenB1, BJetEigenB2, BJetEigenB3, BJetEigenB4, \
+        BJetEigenC0, BJetEigenC1, BJetEigenC2, BJetEigenC3, \
+        BJetEigenLight0, BJetEigenLight1, BJetEigenLight2, BJetEigenLight3, \
+        BJetEigenLight4, BJetEigenLight5, BJetEigenLight6, BJetEigenLight7, \
+        BJetEigenLight8, BJetEigenLight9, BJetEigenLight10, BJetEigenLight11, \
+        BJetEigenLight12, BJetEigenLight13, \
+        BJetExtrapolation
+
+Plot.PLOT_Y_AXIS_TITLE_OFFSET = 1.5
+Plot.PLOT_LEGEND_LEFT = 0.5
+
 
 # Parse definitions
 definitions = dict((d.split('=') for d in arguments.definitions))
@@ -158,6 +183,30 @@ print('  Output directory: {}'.format(arguments.output))
 print('  Data prefix: {}'.format(definitions.get('data_prefix', 'UNDEFINED')))
 print('  Systematics enabled: {}'.format(model_file.systematics))
 
+# Open the store of systematic variations
+store = None
+if arguments.store is not None:
+    store = Store(arguments.store,
+                  inputs_digest((arguments.model_file,
+                                 arguments.regions_file,
+                                 arguments.distributions_file),
+                                definitions),
+                  arguments.model)
+
+# Measure the effects of the systematics on the yield and, bin by bin, on a
+# coarse version of the first requested distribution, and prune the small
+# ones before the requested distributions are filled
+pruning = Pruning(arguments.prune_threshold, arguments.prune_stat_threshold)
+if pruning.enabled():
+    print('Measuring systematic effects for pruning...')
+    with caching_into(cache):
+        measure(ParallelizedEnvironment(backend),
+                pruning,
+                regions,
+                backgrounds,
+                coarse(distributions[sorted(distributions)[0]]))
+    pruning.write_report(join(arguments.output, 'pruning.txt'))
+
 
 # Run in a cached environment
 with caching_into(cache):
@@ -170,12 +219,44 @@ with caching_into(cache):
                 print('Processing region {}, distribution {}'. \
                       format(region_name, distribution_name))
 
+            # Look up stored systematic variations
+            entry = None
+            if store is not None:
+                entry = store.entry(region_name, distribution_name)
+            stored = True
+            results = OrderedDict()
+            digests = {}
+
             nominal_histograms = []
-            for background in itervalues(backgrounds):
+            samples = []
+            for background_name, background in iteritems(backgrounds):
                 process = background['process']
                 estimation = background['estimation']
-                nominal_histograms.append(
-                    estimation(distribution)(process, region))
+                uncertainties = pruning.kept(background['uncertainties'],
+                                             background_name,
+                                             region_name)
+
+                # Read stored systematic variations and compute only the missing
+                # ones. Samples are only read if their estimation (including
+                # the rQCD values of this region) is unchanged.
+                digest = estimation_digest(estimation, region)
+                digests[background_name] = digest
+                if entry is not None:
+                    estimation = entry.estimation(estimation,
+                                                  background_name,
+                                                  digest)
+                if entry is None or not entry.covers(background_name,
+                                                     uncertainties,
+                                                     digest):
+                    stored = False
+
+                histogram = estimation(distribution)(process, region)
+                nominal_histograms.append(histogram)
+                samples.append((background_name,
+                                process,
+                                estimation,
+                                uncertainties))
+                results[background_name] = (histogram, OrderedDict())
 
             nominal = combined_histogram(nominal_histograms)
             nominal.SetTitle('NOMINAL')
@@ -185,15 +266,13 @@ with caching_into(cache):
 
                 shape_up_histograms = []
                 shape_down_histograms = []
-                for background in itervalues(backgrounds):
-                    process = background['process']
-                    estimation = background['estimation']
-                    uncertainties = background['uncertainties']
-
+                for background_name, process, estimation, uncertainties \
+                        in samples:
                     if s in uncertainties:
                         process_count += 1
-                        _,_,shape_up,shape_down = \
-                                estimation(s(distribution))(process, region)
+                        result = estimation(s(distribution))(process, region)
+                        results[background_name][1][s] = result
+                        _,_,shape_up,shape_down = result
                     else:
                         shape_up = shape_down = \
                                 estimation(distribution)(process, region)
@@ -246,3 +325,7 @@ with caching_into(cache):
                                '{}_{}'.format(distribution_name,
                                                  s.name)),
                           arguments.extensions)
+
+            # Store the systematic variations for the next run
+            if store is not None and not stored and not parallel.capturing():
+                store.write(region_name, distribution_name, results, digests)
@@ -9,40 +9,11 @@ from collections import OrderedDict
 from copy import deepcopy
 from math import sqrt
 from array import array
-from uuid import uuid4
 from itertools import product
 
-from scipy.optimize import curve_fit
-
 # Six imports
 from six import itervalues, iteritems, iterkeys
 
-# owls-cache imports
-from owls_cache.persistent import caching_into
-
-# owls-parallel imports
-from owls_parallel import ParallelizedEnvironment
-
-# owls-hep imports
-from owls_hep.module import load as load_module
-from owls_hep.utility import efficiency, add_histograms, integral, get_bins, \
-        add_overflow_to_last_bin
-from owls_hep.plotting import Plot, style_line
-from owls_hep.variations import Filtered
-from owls_hep.uncertainty import to_shape, sum_quadrature
-
-# owls-mutau imports
-from owls_mutau.variations import OneProng, ThreeProng
-from owls_mutau.styling import default_black, default_red
-
-# ROOT imports
-from ROOT import TGraphAsymmErrors, TFile, SetOwnership, \
-        kCyan, kBlue, kBlack, kRed
-
-Plot.PLOT_LEGEND_LEFT = 0.55
-Plot.PLOT_LEGEND_RIGHT = 1.0
-Plot.PLOT_LEGEND_TOP = 0.88
-Plot.PLOT_HEADER_HEIGHT = 500
 
 # Parse command line arguments
 parser = argparse.ArgumentParser(
@@ -131,12 +102,67 @@ parser.add_argument('--no-inclusive',
                     dest = 'inclusive',
                     default = True,
                     help = 'don\'t do inclusive efficiency')
+parser.add_argument('--prune-threshold',
+                    type = float,
+                    default = None,
+                    help = 'prune systematics with a smaller relative shift '
+                    'of the yield and of every bin of a coarse reference '
+                    'distribution',
+                    metavar = '<fraction>')
+parser.add_argument('--prune-stat-threshold',
+                    type = float,
+                    default = None,
+                    help = 'prune systematics with a shift of the yield '
+                    'and of every reference bin smaller than this fraction '
+                    'of its statistical uncertainty',
+                    metavar = '<fraction>')
+parser.add_argument('--store',
+                    help = 'the directory of the systematic variation store',
+                    metavar = '<store>')
 parser.add_argument('definitions',
                     nargs = '*',
                     help = 'definitions to use within modules in the form x=y',
                     metavar = '<definition>')
 arguments = parser.parse_args()
 
+# Import the ROOT-based modules only once the arguments are parsed, so that
+# --help and argument errors return without initializing PyROOT
+
+# owls-cache imports
+from owls_cache.persistent import caching_into
+
+# owls-parallel imports
+from owls_parallel import ParallelizedEnvironment
+
+# owls-hep imports
+from owls_hep.module import load as load_module
+from owls_hep.utility import add_histograms, integral, get_bins, \
+        add_overflow_to_last_bin
+from owls_hep.plotting import Plot, style_line
+from owls_hep.variations import Filtered
+from owls_hep.uncertainty import to_shape, sum_quadrature
+
+# owls-mutau imports
+from owls_mutau.variations import OneProng, ThreeProng
+from owls_mutau.pruning import Pruning, measure, coarse
+from owls_mutau.store import Store, inputs_digest
+from owls_mutau.estimation import estimation_digest
+from owls_mutau.styling import default_black, default_red
+from owls_mutau.efficiency import Efficiencies, normalized, syst_errors, \
+        combined, flipped, relative, graph
+
+# numpy imports
+import numpy
+
+# ROOT imports
+from ROOT import TFile, SetOwnership, \
+        kCyan, kBlue, kBlack, kRed
+
+Plot.PLOT_LEGEND_LEFT = 0.55
+Plot.PLOT_LEGEND_RIGHT = 1.0
+Plot.PLOT_LEGEND_TOP = 0.88
+Plot.PLOT_HEADER_HEIGHT = 500
+
 
 # Style for tau triger public plots
 if arguments.publish:
@@ -236,36 +262,16 @@ print('  Region: {}'.format(arguments.region))
 print('  Distribution: {}'.format(arguments.distribution))
 print('  Triggers: {}'.format(', '.join(arguments.triggers)))
 
-def normalize_efficiencies(nominal, up, down):
-    if nominal.GetN() != up.GetN() or nominal.GetN() != down.GetN():
-        raise RuntimeError('point count mismatch; nominal, up, and down '
-                           'efficiencies have different number of points')
-    values_x = nominal.GetX()
-    values_y = nominal.GetY()
-    values_y_up = up.GetY()
-    values_y_down = down.GetY()
-    for i, x, y, y_up, y_down in zip(range(nominal.GetN()),
-                                     values_x, values_y,
-                                     values_y_up, values_y_down):
-        # Switch
-        if y_up < y_down:
-            print('  Switching {:.5f} and {:.5f}'.format(y_up, y_down))
-            y_up, y_down = y_down, y_up
-
-        # If up variation is lower than nominal, reset
-        if y_up < y:
-            print('  Resetting {:.5f} < {:.5f}'.format(y_up, y))
-            y_up = y
-
-        # If down variation is greater than nominal, reset
-        if y_down > y:
-            print('  Resetting {:.5f} > {:.5f}'.format(y_down, y))
-            y_down = y
-
-        up.SetPoint(i, x, y_up)
-        down.SetPoint(i, x, y_down)
-
-def do_efficiencies(distribution, region, rqcd_addons, efficiency_filter):
+def efficiency_regions(region, rqcd_addons, efficiency_filter):
+    # Prepare the total and passed regions
+    total_region = deepcopy(region)
+    passed_region = region.varied(efficiency_filter)
+    total_region.metadata()['rqcd'] += rqcd_addons[0]
+    passed_region.metadata()['rqcd'] += rqcd_addons[1]
+    return total_region, passed_region
+
+def do_efficiencies(eff_name, distribution, region, rqcd_addons,
+                    efficiency_filter):
     ##############################################################
     # COMPUTE (DATA-BACKGROUND) AND SIGNAL HISTOGRAMS
     ##############################################################
@@ -273,10 +279,9 @@ def do_efficiencies(distribution, region, rqcd_addons, efficiency_filter):
     estimation = data['estimation']
 
     # Prepare the region
-    total_region = deepcopy(region)
-    passed_region = region.varied(efficiency_filter)
-    total_region.metadata()['rqcd'] += rqcd_addons[0]
-    passed_region.metadata()['rqcd'] += rqcd_addons[1]
+    total_region, passed_region = efficiency_regions(region,
+                                                     rqcd_addons,
+                                                     efficiency_filter)
 
     # Compute the total and passed histograms
     data_total = estimation(distribution)(process, total_region)
@@ -319,6 +324,66 @@ def do_efficiencies(distribution, region, rqcd_addons, efficiency_filter):
             estimation(distribution)(process, passed_region)
         )
 
+    # Look up stored systematic variations of the total and passed regions
+    total_name = eff_name + '_total'
+    passed_name = eff_name + '_passed'
+    total_entry = passed_entry = None
+    if store is not None:
+        total_entry = store.entry(total_name, arguments.distribution)
+        passed_entry = store.entry(passed_name, arguments.distribution)
+    stored = True
+    total_results = OrderedDict()
+    passed_results = OrderedDict()
+    total_digests = {}
+    passed_digests = {}
+
+    samples = []
+    for background_name, background in iteritems(backgrounds):
+        # Extract parameters
+        process = background['process']
+        estimation = background['estimation']
+        uncertainties = pruning.kept(background['uncertainties'],
+                                     background_name,
+                                     total_name,
+                                     passed_name)
+
+        # Read stored systematic variations and compute only the missing
+        # ones. Samples are only read if their estimation (including the rQCD
+        # values of the region) is unchanged.
+        total_digest = estimation_digest(estimation, total_region)
+        passed_digest = estimation_digest(estimation, passed_region)
+        total_digests[background_name] = total_digest
+        passed_digests[background_name] = passed_digest
+        total_estimation = passed_estimation = estimation
+        for entry, digest in ((total_entry, total_digest),
+                              (passed_entry, passed_digest)):
+            if entry is None or not entry.covers(background_name,
+                                                 uncertainties,
+                                                 digest):
+                stored = False
+        if total_entry is not None:
+            total_estimation = total_entry.estimation(estimation,
+                                                      background_name,
+                                                      total_digest)
+        if passed_entry is not None:
+            passed_estimation = passed_entry.estimation(estimation,
+                                                        background_name,
+                                                        passed_digest)
+
+        total_results[background_name] = (
+            estimation(distribution)(process, total_region),
+            OrderedDict()
+        )
+        passed_results[background_name] = (
+            estimation(distribution)(process, passed_region),
+            OrderedDict()
+        )
+        samples.append((background_name,
+                        process,
+                        total_estimation,
+                        passed_estimation,
+                        uncertainties))
+
     systs_total_up = {}
     systs_total_down = {}
     systs_passed_up = {}
@@ -329,19 +394,19 @@ def do_efficiencies(distribution, region, rqcd_addons, efficiency_filter):
         systs_total_down[name] = []
         systs_passed_up[name] = []
         systs_passed_down[name] = []
-        for background in itervalues(backgrounds):
-            # Extract parameters
-            process = background['process']
-            estimation = background['estimation']
-            uncertainties = background['uncertainties']
-
-            nominal_total = estimation(distribution)(process, total_region)
-            nominal_passed = estimation(distribution)(process, passed_region)
+        for background_name, process, total_estimation, passed_estimation, \
+                uncertainties in samples:
+            nominal_total = total_estimation(distribution)(process,
+                                                           total_region)
+            nominal_passed = passed_estimation(distribution)(process,
+                                                             passed_region)
 
             if s in uncertainties:
                 # Get the up/down of the total
-                _, _, up, down = estimation(s(distribution))(process,
-                                                             total_region)
+                result = total_estimation(s(distribution))(process,
+                                                           total_region)
+                total_results[background_name][1][s] = result
+                _, _, up, down = result
                 if up is not None and down is not None:
                     systs_total_up[name].append(up)
                     systs_total_down[name].append(down)
@@ -350,8 +415,10 @@ def do_efficiencies(distribution, region, rqcd_addons, efficiency_filter):
                                        'systematic variation ' + s.name)
 
                 # Get the up/down of the passed
-                _, _, up, down = estimation(s(distribution))(process,
-                                                             passed_region)
+                result = passed_estimation(s(distribution))(process,
+                                                            passed_region)
+                passed_results[background_name][1][s] = result
+                _, _, up, down = result
                 if up is not None and down is not None:
                     systs_passed_up[name].append(up)
                     systs_passed_down[name].append(down)
@@ -386,6 +453,17 @@ def do_efficiencies(distribution, region, rqcd_addons, efficiency_filter):
     if parallel.capturing():
         return None,None,None,None
 
+    # Store the systematic variations for the next run
+    if store is not None and not stored:
+        store.write(total_name,
+                    arguments.distribution,
+                    total_results,
+                    total_digests)
+        store.write(passed_name,
+                    arguments.distribution,
+                    passed_results,
+                    passed_digests)
+
     ##############################################################
     # COMPUTE SIGNAL EFFICIENCY
     ##############################################################
@@ -393,8 +471,9 @@ def do_efficiencies(distribution, region, rqcd_addons, efficiency_filter):
     signal_passed = add_histograms(signals_passed, 'Signal')
     add_overflow_to_last_bin(signal_total)
     add_overflow_to_last_bin(signal_passed)
-    signal_efficiency = efficiency(signal_total, signal_passed)
-    signal_efficiency.SetTitle('MC')
+    signal_efficiency = Efficiencies.from_histograms([signal_total],
+                                                     [signal_passed],
+                                                     ['MC'])
 
 
     ##############################################################
@@ -409,8 +488,9 @@ def do_efficiencies(distribution, region, rqcd_addons, efficiency_filter):
     data_subtracted_total = data_total - background_total
     data_subtracted_passed = data_passed - background_passed
 
-    data_efficiency = efficiency(data_subtracted_total, data_subtracted_passed)
-    data_efficiency.SetTitle(data['process'].label())
+    data_efficiency = Efficiencies.from_histograms([data_subtracted_total],
+                                                   [data_subtracted_passed],
+                                                   [data['process'].label()])
 
     # Write the signal and data counts
     write_counts('Signal total/passed', signal_total, signal_passed)
@@ -426,8 +506,8 @@ def do_efficiencies(distribution, region, rqcd_addons, efficiency_filter):
     ##############################################################
     # COMPUTE EFFICIENCIES FOR SYSTEMATIC VARIATIONS
     ##############################################################
-    data_efficiency_up = []
-    data_efficiency_down = []
+    ups = []
+    downs = []
     total_offset_up = []
     total_offset_down = []
     passed_offset_up = []
@@ -464,46 +544,36 @@ def do_efficiencies(distribution, region, rqcd_addons, efficiency_filter):
                           data_subtracted_passed_up,
                           data_subtracted_passed_down)
 
-        # Compute the efficiencies
+        # Collect the total and passed counts of the variations, whose
+        # efficiencies are computed together below
         if name in ['RQCD_STAT', 'RQCD_SYST']:
             print('Using uncorrelated systematics for {}'.format(name))
-            up = efficiency(data_subtracted_total_down,
-                            data_subtracted_passed)
-            down = efficiency(data_subtracted_total_up,
-                              data_subtracted_passed)
-            normalize_efficiencies(data_efficiency, up, down)
-            up.SetTitle(name + '_UP_TOTAL')
-            down.SetTitle(name + '_DOWN_TOTAL')
-            data_efficiency_up.append(up)
-            data_efficiency_down.append(down)
-
-            up = efficiency(data_subtracted_total,
-                            data_subtracted_passed_up)
-            down = efficiency(data_subtracted_total,
-                              data_subtracted_passed_down)
-            normalize_efficiencies(data_efficiency, up, down)
-            up.SetTitle(name + '_UP_PASSED')
-            down.SetTitle(name + '_DOWN_PASSED')
-            data_efficiency_up.append(up)
-            data_efficiency_down.append(down)
+            ups.append((data_subtracted_total_down,
+                        data_subtracted_passed,
+                        name + '_UP_TOTAL'))
+            downs.append((data_subtracted_total_up,
+                          data_subtracted_passed,
+                          name + '_DOWN_TOTAL'))
+            ups.append((data_subtracted_total,
+                        data_subtracted_passed_up,
+                        name + '_UP_PASSED'))
+            downs.append((data_subtracted_total,
+                          data_subtracted_passed_down,
+                          name + '_DOWN_PASSED'))
 
         else:
             print('Using correlated systematics for {}.'.format(name))
             # NOTE: Reversed up/down results in fewer switches
-            down = efficiency(data_subtracted_total_up,
-                              data_subtracted_passed_up)
-            up = efficiency(data_subtracted_total_down,
-                            data_subtracted_passed_down)
-            normalize_efficiencies(data_efficiency, up, down)
-            up.SetTitle(name + '_UP')
-            down.SetTitle(name + '_DOWN')
-            data_efficiency_up.append(up)
-            data_efficiency_down.append(down)
+            downs.append((data_subtracted_total_up,
+                          data_subtracted_passed_up,
+                          name + '_DOWN'))
+            ups.append((data_subtracted_total_down,
+                        data_subtracted_passed_down,
+                        name + '_UP'))
 
         # Compute the offsets in the total yields and write out the
-        # difference in yields *AFTER* having computed the efficiencies. (The
-        # efficiency calculation sanitizes the graphs so that there are no
-        # negative points, etc.)
+        # difference in yields. (The efficiency calculation sanitizes its own
+        # copy of the counts so that there are no negative values, etc.)
         total_offset_up.append(integral(data_subtracted_total_up) -
                                integral(data_subtracted_total))
         total_offset_down.append(integral(data_subtracted_total) -
@@ -532,83 +602,25 @@ def do_efficiencies(distribution, region, rqcd_addons, efficiency_filter):
                      sum_quadrature(passed_offset_down))
     write_efficiency(signal_efficiency, data_efficiency)
 
+    # Compute the efficiencies of all up and all down variations at once, and
+    # normalize them with respect to the nominal efficiency
+    data_efficiency_up = data_efficiency.varied([t for t, _, _ in ups],
+                                                [p for _, p, _ in ups],
+                                                [n for _, _, n in ups])
+    data_efficiency_down = data_efficiency.varied([t for t, _, _ in downs],
+                                                  [p for _, p, _ in downs],
+                                                  [n for _, _, n in downs])
+    up, down, switched, reset = normalized(data_efficiency.values()[0],
+                                           data_efficiency_up.values(),
+                                           data_efficiency_down.values())
+    print('  Switched {} and reset {} variation efficiencies'. \
+          format(switched, reset))
+    data_efficiency_up = data_efficiency_up.with_values(up)
+    data_efficiency_down = data_efficiency_down.with_values(down)
+
     return data_efficiency, signal_efficiency, \
             data_efficiency_up, data_efficiency_down
 
-def get_error(graph, zeroed = False):
-    errors = graph.Clone(uuid4().hex)
-    for i,x in zip(range(errors.GetN()), errors.GetX()):
-        errors.SetPoint(i, x, 0.0)
-    if zeroed:
-        for i in range(errors.GetN()):
-            errors.SetPointEYlow(i, 0.0)
-            errors.SetPointEYhigh(i, 0.0)
-    return errors
-
-def set_error(graph, errors):
-    if graph.GetN() != errors.GetN():
-        raise RuntimeError('point count mismatch; '
-                           'can\'t set errors from {} on {}'. \
-                           format(errors.GetTitle, graph.GetTitle()))
-    for i in range(graph.GetN()):
-        graph.SetPointEYlow(i, errors.GetErrorYlow(i))
-        graph.SetPointEYhigh(i, errors.GetErrorYhigh(i))
-
-def flip_error(errors):
-    flipped = errors.Clone(uuid4().hex)
-    for i in range(errors.GetN()):
-        flipped.SetPointEYlow(i, errors.GetErrorYhigh(i))
-        flipped.SetPointEYhigh(i, errors.GetErrorYlow(i))
-    return flipped
-
-def clear_error(graph, y_only = False):
-    for i in range(graph.GetN()):
-        if not y_only:
-            graph.SetPointEXlow(i, 0)
-            graph.SetPointEXhigh(i, 0)
-        graph.SetPointEYlow(i, 0)
-        graph.SetPointEYhigh(i, 0)
-
-def combine_errors(*errors):
-    for e in errors[1:]:
-        if errors[0].GetN() != e.GetN():
-            raise RuntimeError('point count mismatch; '
-                               'can\'t combine errors from {} with {}'. \
-                               format(errors[0].GetTitle, e.GetTitle()))
-    total = errors[0].Clone(uuid4().hex)
-    for i in range(total.GetN()):
-        total.SetPointEYlow(i, sum_quadrature([e.GetErrorYlow(i)
-                                               for e
-                                               in errors]))
-        total.SetPointEYhigh(i, sum_quadrature([e.GetErrorYhigh(i)
-                                                for e
-                                                in errors]))
-    return total
-
-def compute_syst_error(nominal, up_variations, down_variations):
-    if any([nominal.GetN() != v.GetN()
-            for v
-            in up_variations + down_variations]):
-        raise RuntimeError('point count mismatch; '
-                           'one or more of the variations don\'t agree '
-                           'with the nominal.')
-
-    y_nominal = nominal.GetY()
-    y_up_variations = [e.GetY() for e in up_variations]
-    y_down_variations = [e.GetY() for e in down_variations]
-
-    errors = get_error(nominal, zeroed = True)
-    for i in range(errors.GetN()):
-        up_error = sum_quadrature([y_nominal[i] - y_variation[i]
-                                   for y_variation
-                                   in y_up_variations])
-        down_error = sum_quadrature([y_nominal[i] - y_variation[i]
-                                     for y_variation
-                                     in y_down_variations])
-        errors.SetPointEYhigh(i, up_error)
-        errors.SetPointEYlow(i, down_error)
-    return errors
-
 def plot_efficiencies(data_efficiency,
                       data_syst_uncertainty,
                       signal_efficiency,
@@ -622,25 +634,48 @@ def plot_efficiencies(data_efficiency,
     data_stat_uncertainty_style = (kCyan-7, kCyan-7, 0)
     signal_stat_uncertainty_style = (kRed, kRed, 0)
 
-    data_stat_uncertainty = get_error(data_efficiency)
-    data_total_uncertainty = combine_errors(data_stat_uncertainty,
-                                            data_syst_uncertainty)
-
-    syst_uncertainty_band = data_efficiency.Clone(uuid4().hex)
-    syst_uncertainty_band.SetTitle('Data Syst.')
-    set_error(syst_uncertainty_band, data_syst_uncertainty)
-
-    #stat_uncertainty_band = data_efficiency.Clone(uuid4().hex)
-    #stat_uncertainty_band.SetTitle('Data Stat.')
-    #set_error(stat_uncertainty_band, data_stat_uncertainty)
-
-    total_uncertainty_band = data_efficiency.Clone(uuid4().hex)
-    total_uncertainty_band.SetTitle('Data Stat. #oplus Syst.')
-    set_error(total_uncertainty_band, data_total_uncertainty)
-
-    data_efficiency = data_efficiency.Clone(uuid4().hex)
-    # data_efficiency.SetTitle('Data')
-    clear_error(data_efficiency)
+    # Build the graphs of the efficiencies and their uncertainty bands
+    centers = data_efficiency.centers()
+    widths = data_efficiency.widths()
+    data_values = data_efficiency.values()[0]
+
+    data_stat_uncertainty = data_efficiency.errors(0)
+    data_total_uncertainty = combined(data_stat_uncertainty,
+                                      data_syst_uncertainty)
+
+    # Bins without total counts are left out of the graphs, and scale
+    # factors need both efficiencies
+    data_valid = data_efficiency.valid(0)
+    sf_valid = data_valid & signal_efficiency.valid(0)
+
+    syst_uncertainty_band = graph(centers,
+                                  widths,
+                                  data_values,
+                                  data_syst_uncertainty,
+                                  'Data Syst.',
+                                  valid = data_valid)
+
+    #stat_uncertainty_band = graph(centers,
+                                  #widths,
+                                  #data_values,
+                                  #data_stat_uncertainty,
+                                  #'Data Stat.')
+
+    total_uncertainty_band = graph(centers,
+                                   widths,
+                                   data_values,
+                                   data_total_uncertainty,
+                                   'Data Stat. #oplus Syst.',
+                                   valid = data_valid)
+
+    data_points = graph(centers,
+                        widths,
+                        data_values,
+                        title = data_efficiency.titles()[0],
+                        x_errors = False,
+                        valid = data_valid)
+
+    signal_points = signal_efficiency.graph()
 
     # Create the plot
     plot = Plot('', distribution.x_label(), 'Efficiency', ratio='True')
@@ -649,31 +684,43 @@ def plot_efficiencies(data_efficiency,
         #(stat_uncertainty_band, data_stat_uncertainty_style, 'e2'),
         (total_uncertainty_band, data_stat_uncertainty_style, 'e2'),
         (syst_uncertainty_band, data_syst_uncertainty_style, 'e2'),
-        (signal_efficiency, default_red, 'ep'),
-        (data_efficiency, default_black, 'p'),
+        (signal_points, default_red, 'ep'),
+        (data_points, default_black, 'p'),
     )
 
     sf_data_syst, sf_data_stat, sf_signal_stat = scale_factor_uncertainties
 
     # TODO: Not sure this is the way to present the uncertainties
-    sf = scale_factor.Clone(uuid4().hex)
-    clear_error(sf)
-
-    sf_data_syst_band = scale_factor.Clone(uuid4().hex)
-    sf_data_syst_band.SetTitle('Data Syst.')
-    set_error(sf_data_syst_band, sf_data_syst)
-
-    sf_signal_stat_band = scale_factor.Clone(uuid4().hex)
-    sf_signal_stat_band.SetTitle('Data Syst. #oplus Signal Stat.')
-    set_error(sf_signal_stat_band, combine_errors(sf_data_syst,
-                                                  sf_signal_stat))
-
-    sf_data_stat_band = scale_factor.Clone(uuid4().hex)
-    sf_signal_stat_band.SetTitle('Data Syst. #oplus Data Stat. '
-                                 '#oplus Signal Stat.')
-    set_error(sf_data_stat_band, combine_errors(sf_data_syst,
-                                                sf_signal_stat,
-                                                sf_data_stat))
+    sf = graph(centers,
+               widths,
+               scale_factor,
+               title = 'Data / exp.',
+               x_errors = False,
+               valid = sf_valid)
+
+    sf_data_syst_band = graph(centers,
+                              widths,
+                              scale_factor,
+                              sf_data_syst,
+                              'Data Syst.',
+                              valid = sf_valid)
+
+    sf_signal_stat_band = graph(centers,
+                                widths,
+                                scale_factor,
+                                combined(sf_data_syst, sf_signal_stat),
+                                'Data Syst. #oplus Signal Stat.',
+                                valid = sf_valid)
+
+    sf_data_stat_band = graph(centers,
+                              widths,
+                              scale_factor,
+                              combined(sf_data_syst,
+                                       sf_signal_stat,
+                                       sf_data_stat),
+                              'Data Syst. #oplus Data Stat. '
+                              '#oplus Signal Stat.',
+                              valid = sf_valid)
 
     plot.draw_ratios(
         (
@@ -688,8 +735,8 @@ def plot_efficiencies(data_efficiency,
     )
 
     # Draw a legend
-    plot.draw_legend(legend_entries = (signal_efficiency,
-                                      data_efficiency,
+    plot.draw_legend(legend_entries = (signal_points,
+                                      data_points,
                                       syst_uncertainty_band,
                                       #stat_uncertainty_band,
                                       total_uncertainty_band,
@@ -708,68 +755,32 @@ def do_scale_factor(data_efficiency,
                     data_efficiency_up,
                     data_efficiency_down,
                     signal_efficiency):
-    def compute_sf(data_efficiency, signal_efficiency):
-        sf = data_efficiency.Clone(uuid4().hex)
-        for i,x,nom,denom in zip(range(sf.GetN()),
-                                 sf.GetX(),
-                                 data_efficiency.GetY(),
-                                 signal_efficiency.GetY()):
-            try:
-                sf.SetPoint(i, x, nom/denom)
-            except ZeroDivisionError:
-                sf.SetPoint(i, x, 0.0)
-            sf.SetPointEYlow(i, 0.0)
-            sf.SetPointEYhigh(i, 0.0)
-        return sf
-
-    def normalize_stat_error(efficiency):
-        errors = get_error(efficiency)
-        for i,low,high,y in zip(range(errors.GetN()),
-                                errors.GetEYlow(),
-                                errors.GetEYhigh(),
-                                efficiency.GetY()):
-            try:
-                errors.SetPointEYlow(i, low/y)
-            except ZeroDivisionError:
-                errors.SetPointEYlow(i, 0.0)
-            try:
-                errors.SetPointEYhigh(i, high/y)
-            except ZeroDivisionError:
-                errors.SetPointEYhigh(i, 0.0)
-
-        return errors
+    signal_values = signal_efficiency.values()[0]
+    safe_signal_values = numpy.where(signal_values != 0, signal_values, 1.0)
+
+    def compute_sf(efficiencies):
+        return numpy.where(signal_values != 0,
+                           efficiencies / safe_signal_values,
+                           0.0)
 
     ##############################################################
     # COMPUTE SCALE FACTORS
     ##############################################################
-    nominal = compute_sf(data_efficiency, signal_efficiency)
+    nominal = compute_sf(data_efficiency.values()[0])
 
-    up_variations = [compute_sf(up, signal_efficiency)
-                     for up
-                     in data_efficiency_up]
-    down_variations = [compute_sf(down, signal_efficiency)
-                     for down
-                     in data_efficiency_down]
-
-    syst_uncertainty = compute_syst_error(nominal,
-                                          up_variations,
-                                          down_variations)
-    syst_uncertainty.SetTitle('SYST')
+    syst_uncertainty = syst_errors(nominal,
+                                   compute_sf(data_efficiency_up.values()),
+                                   compute_sf(data_efficiency_down.values()))
 
     # TODO: The statistical errors are normalized to 1, but perhaps they
-    # should be normalized to the SF instead? I.e. that we should supply
-    # nominal to normalize_stat_error and do low = eff_low/eff_y * sf_y. I'm
+    # should be normalized to the SF instead? I.e. that we should multiply
+    # the relative errors by nominal, so that low = eff_low/eff_y * sf_y. I'm
     # not sure that is correct.
-    data_stat_uncertainty = normalize_stat_error(data_efficiency)
-    data_stat_uncertainty.SetTitle('DATA STAT')
-
-    signal_stat_uncertainty = flip_error(normalize_stat_error(signal_efficiency))
-    signal_stat_uncertainty.SetTitle('SIGNAL STAT')
+    data_stat_uncertainty = relative(data_efficiency.values()[0],
+                                     data_efficiency.errors(0))
 
-    set_error(nominal, combine_errors(syst_uncertainty,
-                                      data_stat_uncertainty,
-                                      signal_stat_uncertainty))
-    nominal.SetTitle('Data / exp.')
+    signal_stat_uncertainty = flipped(relative(signal_values,
+                                               signal_efficiency.errors(0)))
 
     return nominal, (syst_uncertainty,
                      data_stat_uncertainty,
@@ -796,11 +807,18 @@ def do_scale_factor(data_efficiency,
          #extensions = arguments.extensions)
 
 def get_weighted_efficiency(centres, efficiencies, weights):
+    # scipy is only needed here, so only import it when it's used
+    from scipy.optimize import curve_fit
+
     # Constant function for regression
     def const_func(x, a):
         return a
-    # Perform the regression
-    popt, _ = curve_fit(const_func, centres, efficiencies, sigma = weights)
+    # Perform the regression, skipping empty bins, which have no uncertainty
+    fitted = weights > 0
+    popt, _ = curve_fit(const_func,
+                        centres[fitted],
+                        efficiencies[fitted],
+                        sigma = weights[fitted])
     # popt is a list of curve fit parameters; we're only interested in the
     # constant term (a)
     return popt[0]
@@ -809,72 +827,50 @@ def get_weighted_uncertainty_efficiencies(centres,
                                           nominal,
                                           weights,
                                           uncertainty):
-    nominal_up = [y+e for y, e in zip(nominal, uncertainty.GetEYhigh())]
-    nominal_down = [y-e for y, e in zip(nominal, uncertainty.GetEYlow())]
-    weighted_up = get_weighted_efficiency(centres, nominal_up, weights)
-    weighted_down = get_weighted_efficiency(centres, nominal_down, weights)
+    low, high = uncertainty
+    weighted_up = get_weighted_efficiency(centres, nominal + high, weights)
+    weighted_down = get_weighted_efficiency(centres, nominal - low, weights)
     return (weighted_up, weighted_down)
 
 def estimate_systematic_effects(data_efficiency,
                                 data_efficiency_up,
                                 data_efficiency_down):
-    n = data_efficiency.GetN()
-    centres = [x for i, x in zip(range(n), data_efficiency.GetX())]
-    efficiencies = [x for i, x in zip(range(n), data_efficiency.GetY())]
-    stat_up = [x for i, x in zip(range(n), data_efficiency.GetEYhigh())]
-    stat_down = [x for i, x in zip(range(n), data_efficiency.GetEYlow())]
+    centres = data_efficiency.centers()
+    efficiencies = data_efficiency.values()[0]
+    stat_down, stat_up = data_efficiency.errors(0)
+    n = len(centres)
     # Average uncertainty
-    # weights = [((u + d)/2)
-               # for i, u, d
-               # in zip(range(n), stat_up, stat_down)]
+    # weights = (stat_up + stat_down) / 2
     # Largest uncertainty
-    weights = [max(u, d)
-               for i, u, d
-               in zip(range(n), stat_up, stat_down)]
+    weights = numpy.maximum(stat_up, stat_down)
 
     weighted_efficiency = \
             get_weighted_efficiency(centres, efficiencies, weights)
 
+    def uncertainty(keyword):
+        return syst_errors(efficiencies,
+                           data_efficiency_up.selected(keyword),
+                           data_efficiency_down.selected(keyword))
 
-    rqcd_variations = ([u for u in data_efficiency_up
-                        if 'RQCD' in u.GetTitle()],
-                       [u for u in data_efficiency_down
-                        if 'RQCD' in u.GetTitle()])
-    bjet_variations = ([u for u in data_efficiency_up
-                        if 'BJET' in u.GetTitle()],
-                       [u for u in data_efficiency_down
-                        if 'BJET' in u.GetTitle()])
-    prw_variations = ([u for u in data_efficiency_up
-                       if 'PRW' in u.GetTitle()],
-                      [u for u in data_efficiency_down
-                       if 'PRW' in u.GetTitle()])
-    muon_variations = ([u for u in data_efficiency_up
-                        if 'MUON' in u.GetTitle()],
-                       [u for u in data_efficiency_down
-                        if 'MUON' in u.GetTitle()])
-
-    rqcd_uncertainty = compute_syst_error(data_efficiency, *rqcd_variations)
-    bjet_uncertainty = compute_syst_error(data_efficiency, *bjet_variations)
-    prw_uncertainty = compute_syst_error(data_efficiency, *prw_variations)
-    muon_uncertainty = compute_syst_error(data_efficiency, *muon_variations)
-    all_uncertainty = compute_syst_error(data_efficiency,
-                                         data_efficiency_up,
-                                         data_efficiency_down)
-
-    # up = [y for x, y in zip(centres, all_uncertainty.GetEYhigh())]
-    # down = [y for x, y in zip(centres, all_uncertainty.GetEYlow())]
+    rqcd_uncertainty = uncertainty('RQCD')
+    bjet_uncertainty = uncertainty('BJET')
+    prw_uncertainty = uncertainty('PRW')
+    muon_uncertainty = uncertainty('MUON')
+    all_uncertainty = syst_errors(efficiencies,
+                                  data_efficiency_up.values(),
+                                  data_efficiency_down.values())
+
+    # down, up = all_uncertainty
     # print('ALL syst')
     # for x, y, u, d in zip(centres, efficiencies, up, down):
         # print('{:5.1f} {:.3f}({:.3f}↓ {:.3f}↑)'.format(x, y, d, u))
 
-    # up = [y for x, y in zip(centres, rqcd_uncertainty.GetEYhigh())]
-    # down = [y for x, y in zip(centres, rqcd_uncertainty.GetEYlow())]
+    # down, up = rqcd_uncertainty
     # print('RQCD syst')
     # for x, y, u, d in zip(centres, efficiencies, up, down):
         # print('{:5.1f} {:.3f}({:.3f}↓ {:.3f}↑)'.format(x, y, d, u))
 
-    # up = [y for x, y in zip(centres, prw_uncertainty.GetEYhigh())]
-    # down = [y for x, y in zip(centres, prw_uncertainty.GetEYlow())]
+    # down, up = prw_uncertainty
     # print('PRW syst')
     # for x, y, u, d in zip(centres, efficiencies, up, down):
         # print('{:5.1f} {:.3f}({:.3f}↓ {:.3f}↑)'.format(x, y, d, u))
@@ -916,8 +912,8 @@ def estimate_systematic_effects(data_efficiency,
         for i, x, e, u, d in zip(range(n),
                                  centres,
                                  efficiencies,
-                                 all_uncertainty.GetEYhigh(),
-                                 all_uncertainty.GetEYlow()):
+                                 all_uncertainty[1],
+                                 all_uncertainty[0]):
             text_file.write('{:4d} ({:5.1f}, {:5.3f}(↓{:5.3f}↑{:5.3f})) '
                             '{:.3f}%\n'. \
                             format(i, x, e, u, d, max(u, d)/e*100))
@@ -951,47 +947,71 @@ def estimate_systematic_effects(data_efficiency,
 def save_to_root(data_efficiency,
                  signal_efficiency,
                  data_syst_uncertainty,
-                 variation_efficiencies,
                  scale_factor,
                  scale_factor_uncertainties,
                  file_name):
     root_file.cd()
 
-    # NOTE: The statistical uncertainties on the efficiencies are attached to
-    # the graphs
-    clone = data_efficiency.Clone(uuid4().hex)
-    clone.SetName('_'.join(['eff', file_name, 'data']))
-    clone.Write()
+    centers = data_efficiency.centers()
+    widths = data_efficiency.widths()
+    zeros = numpy.zeros(len(centers))
 
-    clone = signal_efficiency.Clone(uuid4().hex)
-    clone.SetName('_'.join(['eff', file_name, 'mc']))
-    clone.Write()
+    # Bins without total counts are left out of the graphs, and scale
+    # factors need both efficiencies
+    data_valid = data_efficiency.valid(0)
+    sf_valid = data_valid & signal_efficiency.valid(0)
 
-    clone = data_syst_uncertainty.Clone(uuid4().hex)
-    clone.SetName('_'.join(['eff', file_name, 'SYST']))
-    clone.SetTitle(clone.GetTitle() + ' SYST')
-    clone.Write()
+    # NOTE: The statistical uncertainties on the efficiencies are attached to
+    # the graphs
+    result = data_efficiency.graph()
+    result.SetName('_'.join(['eff', file_name, 'data']))
+    result.Write()
+
+    result = signal_efficiency.graph()
+    result.SetName('_'.join(['eff', file_name, 'mc']))
+    result.Write()
+
+    result = graph(centers,
+                   widths,
+                   zeros,
+                   data_syst_uncertainty,
+                   data_efficiency.titles()[0] + ' SYST',
+                   valid = data_valid)
+    result.SetName('_'.join(['eff', file_name, 'SYST']))
+    result.Write()
 
     # NOTE: The individual syst uncertainties are not that useful.
-    # for eff in variation_efficiencies:
-        # clone = eff.Clone(uuid4().hex)
-        # clone.SetName('_'.join(['eff', file_name, clone.GetTitle()]))
-        # clone.Write()
-
-    clone = scale_factor.Clone(uuid4().hex)
-    clone.SetName('_'.join(['sf', file_name]))
-    clone.Write()
-
-    for uncertainty,name in zip(scale_factor_uncertainties,
-                                ['SYST', 'DATA_STAT', 'SIGNAL_STAT']):
-        clone = uncertainty.Clone(uuid4().hex)
-        clone.SetName('_'.join(['sf', file_name, name]))
-        clone.Write()
-    clone = combine_errors(scale_factor_uncertainties[1],
-                           scale_factor_uncertainties[2])
-    clone.SetName('_'.join(['sf', file_name, 'STAT']))
-    clone.SetTitle('_'.join(['sf', file_name, 'STAT']))
-    clone.Write()
+    # for variations in (data_efficiency_up, data_efficiency_down):
+        # for i, title in enumerate(variations.titles()):
+            # result = variations.graph(i)
+            # result.SetName('_'.join(['eff', file_name, title]))
+            # result.Write()
+
+    result = graph(centers,
+                   widths,
+                   scale_factor,
+                   combined(*scale_factor_uncertainties),
+                   'Data / exp.',
+                   valid = sf_valid)
+    result.SetName('_'.join(['sf', file_name]))
+    result.Write()
+
+    for uncertainty, name, title in zip(scale_factor_uncertainties,
+                                        ['SYST', 'DATA_STAT', 'SIGNAL_STAT'],
+                                        ['SYST', 'DATA STAT', 'SIGNAL STAT']):
+        result = graph(centers, widths, zeros, uncertainty, title,
+                       valid = sf_valid)
+        result.SetName('_'.join(['sf', file_name, name]))
+        result.Write()
+    result = graph(centers,
+                   widths,
+                   zeros,
+                   combined(scale_factor_uncertainties[1],
+                            scale_factor_uncertainties[2]),
+                   '_'.join(['sf', file_name, 'STAT']),
+                   valid = sf_valid)
+    result.SetName('_'.join(['sf', file_name, 'STAT']))
+    result.Write()
 
 def write_counts(message, total, passed):
     if arguments.text_output:
@@ -1046,17 +1066,15 @@ def write_total_syst(what, nominal_count, up_offset, down_offset):
 def write_efficiency(signal, data):
     if arguments.text_output:
         text_file.write('--- Efficiency (stat. unc.) ---\n')
-        x = signal.GetX()
-        signal_y = signal.GetY()
-        signal_yel = signal.GetEYlow()
-        signal_yeh = signal.GetEYhigh()
-        data_y = data.GetY()
-        data_yel = data.GetEYlow()
-        data_yeh = data.GetEYhigh()
+        x = signal.centers()
+        signal_y = signal.values()[0]
+        signal_yel, signal_yeh = signal.errors(0)
+        data_y = data.values()[0]
+        data_yel, data_yeh = data.errors(0)
 
         text_file.write('      {:>5s}  {:18s}  {:18s}\n'. \
                         format('pT', 'Signal (MC)', 'Data-bkg'))
-        for i in range(signal.GetN()):
+        for i in range(len(x)):
             text_file.write('{:4d} ({:5.1f}, {:5.3f}(↓{:5.3f}↑{:5.3f}) '
                             '{:5.3f}(↓{:5.3f}↑{:5.3f}))\n'. \
                             format(i, x[i],
@@ -1098,6 +1116,37 @@ def close_files():
         root_file.ls()
         root_file.Close()
 
+# Open the store of systematic variations
+store = None
+if arguments.store is not None:
+    store = Store(arguments.store,
+                  inputs_digest((arguments.model_file,
+                                 arguments.regions_file,
+                                 arguments.distributions_file),
+                                definitions),
+                  arguments.model)
+
+# Measure the effects of the systematics on the yield and, bin by bin, on a
+# coarse version of the distribution in the total and passed regions of each
+# efficiency, and prune the small ones
+pruning = Pruning(arguments.prune_threshold, arguments.prune_stat_threshold)
+if pruning.enabled():
+    print('Measuring systematic effects for pruning...')
+    pruning_regions = {}
+    for eff_name, eff in iteritems(efficiencies):
+        pruning_regions[eff_name + '_total'], \
+                pruning_regions[eff_name + '_passed'] = \
+                efficiency_regions(eff['region'],
+                                   eff['rqcd_addons'],
+                                   eff['filter'])
+    with caching_into(cache):
+        measure(ParallelizedEnvironment(backend),
+                pruning,
+                pruning_regions,
+                backgrounds,
+                coarse(distribution))
+    pruning.write_report(join(base_path, 'pruning.txt'))
+
 # Run in a cached environment
 with caching_into(cache):
 
@@ -1129,7 +1178,8 @@ with caching_into(cache):
             # Compute and plot the efficiencies
             data_efficiency, signal_efficiency, \
                     data_efficiency_up, data_efficiency_down = \
-                    do_efficiencies(distribution,
+                    do_efficiencies(eff_name,
+                                    distribution,
                                     region,
                                     rqcd_addons,
                                     efficiency_filter)
@@ -1150,9 +1200,10 @@ with caching_into(cache):
                                 data_efficiency_down,
                                 signal_efficiency)
 
-            data_syst_uncertainty = compute_syst_error(data_efficiency,
-                                                       data_efficiency_up,
-                                                       data_efficiency_down)
+            data_syst_uncertainty = \
+                    syst_errors(data_efficiency.values()[0],
+                                data_efficiency_up.values(),
+                                data_efficiency_down.values())
             plot_efficiencies(data_efficiency,
                               data_syst_uncertainty,
                               signal_efficiency,
@@ -1176,7 +1227,6 @@ with caching_into(cache):
                 save_to_root(data_efficiency,
                              signal_efficiency,
                              data_syst_uncertainty,
-                             data_efficiency_up + data_efficiency_down,
                              scale_factor,
                              scale_factor_uncertainties,
                              eff_name)
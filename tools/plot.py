@@ -8,28 +8,13 @@ from os import makedirs
 from os.path import join, exists, isdir
 from itertools import product, chain
 from math import sqrt
-from copy import copy
+from collections import OrderedDict
+from multiprocessing import Pool
 
 # Six imports
-from six import itervalues
+from six import itervalues, iteritems
 from six.moves import range
 
-# owls-cache imports
-from owls_cache.persistent import caching_into
-
-# owls-parallel imports
-from owls_parallel import ParallelizedEnvironment
-
-# owls-hep imports
-from owls_hep.module import load as load_module
-from owls_hep.uncertainty import uncertainty_band, combined_uncertainty_band, \
-    ratio_uncertainty_band, to_overall, sum_quadrature
-from owls_hep.plotting import Plot, histogram_stack, combined_histogram, \
-    ratio_histogram
-from owls_hep.utility import integral, get_bins_errors
-
-Plot.PLOT_HEADER_HEIGHT = 500
-Plot.PLOT_LEGEND_LEFT = 0.70
 
 # Parse command line arguments
 parser = argparse.ArgumentParser(
@@ -58,7 +43,8 @@ parser.add_argument('-R',
 parser.add_argument('-r',
                     '--regions',
                     nargs = '+',
-                    help = 'the regions to plot',
+                    help = 'the regions to plot, where <name>* selects all '
+                    'regions of a region family, which are filled together',
                     metavar = '<region>')
 parser.add_argument('-D',
                     '--distributions-file',
@@ -111,33 +97,83 @@ parser.add_argument('-x',
                     nargs = '+',
                     default = ['pdf'],
                     help = 'save these extensions (default: pdf)')
+parser.add_argument('--prune-threshold',
+                    type = float,
+                    default = None,
+                    help = 'prune systematics with a smaller relative shift '
+                    'of the yield and of every bin of a coarse reference '
+                    'distribution',
+                    metavar = '<fraction>')
+parser.add_argument('--prune-stat-threshold',
+                    type = float,
+                    default = None,
+                    help = 'prune systematics with a shift of the yield '
+                    'and of every reference bin smaller than this fraction '
+                    'of its statistical uncertainty',
+                    metavar = '<fraction>')
+parser.add_argument('--store',
+                    help = 'the directory of the systematic variation store',
+                    metavar = '<store>')
+parser.add_argument('--render-workers',
+                    type = int,
+                    default = 0,
+                    help = 'the number of worker processes rendering plots '
+                    'while histograms are computed (default: render in the '
+                    'main process)',
+                    metavar = '<count>')
+parser.add_argument('--render-queue',
+                    type = int,
+                    default = None,
+                    help = 'the maximum number of plots waiting to be '
+                    'rendered (default: twice the number of render workers)',
+                    metavar = '<count>')
+parser.add_argument('--force-render',
+                    action = 'store_true',
+                    help = 'render all plots, even if their inputs are '
+                    'unchanged')
 parser.add_argument('definitions',
                     nargs = '*',
                     help = 'definitions to use within modules in the form x=y',
                     metavar = '<definition>')
 arguments = parser.parse_args()
 
-# Style for tau triger public plots
-# TODO: Plotting style should be more configurable
-if arguments.publish:
-    Plot.PLOT_MARGINS_WITH_RATIO = (0.125, 0.025, 0.025, 0.025)
-    Plot.PLOT_RATIO_MARGINS = (0.125, 0.025, 0.325, 0.035)
-    Plot.PLOT_HEADER_HEIGHT = 450 # px
-    Plot.PLOT_LEGEND_TOP_WITH_RATIO = 0.95
-    Plot.PLOT_LEGEND_LEFT = 0.62
-    Plot.PLOT_LEGEND_TEXT_SIZE_WITH_RATIO = 0.055
-    Plot.PLOT_LEGEND_ROW_SIZE_WITH_RATIO = 0.08
-    Plot.PLOT_ATLAS_STAMP_TOP_WITH_RATIO = 0.88
-    Plot.PLOT_ATLAS_STAMP_LEFT = 0.18
-    Plot.PLOT_ATLAS_STAMP_TEXT_SIZE_WITH_RATIO = 0.065
-    Plot.PLOT_RATIO_Y_AXIS_MINIMUM = 0.6
-    Plot.PLOT_RATIO_Y_AXIS_MAXIMUM = 1.4
-    Plot.PLOT_RATIO_Y_AXIS_NDIVISIONS = 204
-
-    Plot.PLOT_ERROR_BAND_FILL_STYLE = 3013
-    Plot.PLOT_ERROR_BAND_FILL_COLOR = 1
-    Plot.PLOT_RATIO_ERROR_BAND_FILL_STYLE = 3001
-    Plot.PLOT_RATIO_ERROR_BAND_FILL_COLOR = 632
+# Start the render workers. They are forked before PyROOT is initialized and
+# the model is loaded, and receive finished plots through a bounded queue, so
+# that rendering overlaps with the computation of the next plots. Plots are
+# sent as plain values, with their ROOT objects serialized into temporary
+# files (see owls_mutau.rendering).
+render_pool = None
+if arguments.render_workers > 0:
+    render_pool = Pool(arguments.render_workers)
+render_queue = arguments.render_queue
+if render_queue is None:
+    render_queue = 2 * max(arguments.render_workers, 1)
+pending_renders = []
+
+
+# Import the ROOT-based modules only once the arguments are parsed, so that
+# --help and argument errors return without initializing PyROOT
+
+# owls-cache imports
+from owls_cache.persistent import caching_into
+
+# owls-parallel imports
+from owls_parallel import ParallelizedEnvironment
+
+# owls-hep imports
+from owls_hep.module import load as load_module
+from owls_hep.uncertainty import uncertainty_band, combined_uncertainty_band, \
+    to_overall, sum_quadrature
+from owls_hep.plotting import combined_histogram
+from owls_hep.utility import integral, get_bins_errors
+
+# owls-mutau imports
+from owls_mutau.pruning import Pruning, measure, coarse
+from owls_mutau.store import Store, inputs_digest
+from owls_mutau.estimation import estimation_digest
+from owls_mutau.manifest import Manifest, plot_digest
+from owls_mutau.histogramming import fill_together
+from owls_mutau.rendering import render, serialized, render_serialized
 
 # Parse definitions
 definitions = dict((d.split('=') for d in arguments.definitions))
@@ -165,12 +201,30 @@ else:
     signals = {}
 backgrounds = model['backgrounds']
 
-# Extract regions
-regions = dict((
-    (r, getattr(regions_file, r))
-    for r
-    in arguments.regions
-))
+# Plot settings shared by all plots, as plain values for the render workers
+settings = {
+    'ratio': data is not None,
+    'subtract_background': model.get('subtract_background', False),
+    'error_label': arguments.error_label,
+    'ratio_title': arguments.ratio_title,
+    'label': arguments.label,
+    'atlas_label': arguments.atlas_label,
+    'luminosity': luminosity,
+    'sqrt_s': sqrt_s,
+    'extensions': arguments.extensions,
+    'publish': arguments.publish,
+}
+
+# Extract regions, expanding region families
+families = getattr(regions_file, 'families', {})
+regions = OrderedDict()
+for r in arguments.regions:
+    if r.endswith('*') and r[:-1] in families:
+        family = families[r[:-1]]
+        family.enable()
+        regions.update(family.named_regions())
+    else:
+        regions[r] = getattr(regions_file, r)
 
 
 # Extract histogram distributions
@@ -180,6 +234,11 @@ distributions = dict((
     in arguments.distributions
 ))
 
+# Fill all requested distributions of a selection in a single pass. The fills
+# are cached per distribution, so later runs with other distributions only
+# fill the ones which aren't cached yet.
+fill_together(distributions[d] for d in sorted(distributions))
+
 # Get computation environment
 cache = getattr(environment_file, 'persistent_cache', None)
 backend = getattr(environment_file, 'parallelization_backend', None)
@@ -196,6 +255,42 @@ for region_name in regions:
     if not exists(region_path):
         makedirs(region_path)
 
+# Load the manifest of rendered plots
+manifest = Manifest(arguments.output)
+
+
+# Open the store of systematic variations
+store = None
+if arguments.store is not None:
+    store = Store(arguments.store,
+                  inputs_digest((arguments.model_file,
+                                 arguments.regions_file,
+                                 arguments.distributions_file),
+                                definitions),
+                  arguments.model)
+
+# Measure the effects of the systematics on the yield and, bin by bin, on a
+# coarse version of the first requested distribution, and prune the small
+# ones before the requested distributions are filled
+pruning = Pruning(arguments.prune_threshold, arguments.prune_stat_threshold)
+if pruning.enabled():
+    print('Measuring systematic effects for pruning...')
+    with caching_into(cache):
+        measure(ParallelizedEnvironment(backend),
+                pruning,
+                regions,
+                backgrounds,
+                coarse(distributions[sorted(distributions)[0]]))
+    pruning.write_report(join(arguments.output, 'pruning.txt'))
+
+
+def finish_render():
+    """Waits for the oldest pending plot and records it in the manifest.
+    """
+    plot_output_path, digest, result = pending_renders.pop(0)
+    result.get()
+    manifest.record(plot_output_path, digest)
+
 
 # Run in a cached environment
 with caching_into(cache):
@@ -210,6 +305,14 @@ with caching_into(cache):
             region = regions[region_name]
             distribution = distributions[distribution_name]
 
+            # Look up stored systematic variations
+            entry = None
+            if store is not None:
+                entry = store.entry(region_name, distribution_name)
+            stored = True
+            results = OrderedDict()
+            digests = {}
+
             # Create the data histogram
             data_histogram = None
             if data is not None:
@@ -262,15 +365,34 @@ with caching_into(cache):
             background_histograms = []
             background_uncertainty_sizes = []
             background_uncertainty_bands = []
-            for background in itervalues(backgrounds):
+            for background_name, background in iteritems(backgrounds):
                 # Extract parameters
                 process = background['process']
                 estimation = background['estimation']
-                uncertainties = background.get('uncertainties', [])
+                uncertainties = pruning.kept(
+                    background.get('uncertainties', []),
+                    background_name,
+                    region_name
+                )
+
+                # Read stored systematic variations and compute only the missing
+                # ones. Samples are only read if their estimation (including
+                # the rQCD values of this region) is unchanged.
+                digest = estimation_digest(estimation, region)
+                digests[background_name] = digest
+                if entry is not None:
+                    estimation = entry.estimation(estimation,
+                                                  background_name,
+                                                  digest)
+                if entry is None or not entry.covers(background_name,
+                                                     uncertainties,
+                                                     digest):
+                    stored = False
 
                 # Compute the nominal histogram
                 histogram = estimation(distribution)(process, region)
                 background_histograms.append(histogram)
+                results[background_name] = (histogram, OrderedDict())
 
                 # Add to the signal or background count
                 if background.get('treat_as_signal', False):
@@ -295,8 +417,10 @@ with caching_into(cache):
 
                 # Compute systematic uncertainties
                 for uncertainty in uncertainties:
-                    overall_up, overall_down, shape_up, shape_down = \
+                    result = \
                             estimation(uncertainty(distribution))(process, region)
+                    results[background_name][1][uncertainty] = result
+                    overall_up, overall_down, shape_up, shape_down = result
                     up_variations = []
                     down_variations = []
                     if overall_up is not None:
@@ -333,6 +457,10 @@ with caching_into(cache):
             if parallel.capturing():
                 continue
 
+            # Store the systematic variations for the next run
+            if store is not None and not stored:
+                store.write(region_name, distribution_name, results, digests)
+
             # Create combined background and signal histograms
             background_histogram = combined_histogram(background_histograms)
             background_histogram.SetTitle('Total background')
@@ -407,99 +535,67 @@ with caching_into(cache):
                     h.SetTitle('{0} ({1:.1f})'. \
                                format(h.GetTitle(), integral(h, False)))
 
-            # Create a plot
-            plot = Plot('',
-                        distribution.x_label(),
-                        distribution.y_label(),
-                        ratio = (data is not None))
-
-            # Plot data with background subtraction vs signal
-            if signal_histogram is not None \
-               and model.get('subtract_background', False):
-                # Create a signal stack
-                signal_stack = histogram_stack(*signal_histograms)
-
-                # Compute combined uncertainties on the signal
-                uncertainty = combined_uncertainty_band(
-                    signal_uncertainty_bands,
-                    signal_histogram,
-                    arguments.error_label
-                )
-                ratio_uncertainty = ratio_uncertainty_band(
-                    signal_histogram,
-                    uncertainty
-                )
-
-                # Subtract background from data
-                data_histogram = data_histogram - background_histogram
-
-                # Draw the histograms
-                plot.draw(((signal_stack, uncertainty), None, 'hist'),
-                          (data_histogram, None, 'ep'))
-
-                # Draw the ratio plot
-                if data_histogram is not None:
-                    ratio = ratio_histogram(data_histogram,
-                                            signal_stack,
-                                            arguments.ratio_title)
-                    plot.draw_ratio_histogram(ratio,
-                                              error_band = ratio_uncertainty)
-
-                legend_entries = (data_histogram,
-                                  signal_stack,
-                                  uncertainty)
-
-            # Plot data vs background model with optional signal overlay
-            else:
-
-                # Create a background stack
-                background_stack = histogram_stack(*background_histograms)
-
-                # Compute combined uncertainties
-                uncertainty = combined_uncertainty_band(
-                    background_uncertainty_bands,
-                    background_histogram,
-                    arguments.error_label
-                )
-                ratio_uncertainty = ratio_uncertainty_band(
-                    background_histogram,
-                    uncertainty
-                )
-
-                # Draw the histograms
-                plot.draw(((background_stack, uncertainty), None, 'hist'),
-                          (signal_histogram, None, 'hist'),
-                          (data_histogram, None, 'ep'))
-
-                # Draw the ratio plot
-                if data_histogram is not None:
-                    ratio = ratio_histogram(data_histogram,
-                                            background_stack,
-                                            arguments.ratio_title)
-                    plot.draw_ratio_histogram(ratio,
-                                              error_band = ratio_uncertainty)
-
-                legend_entries = (data_histogram,
-                                  signal_histogram,
-                                  background_stack,
-                                  uncertainty)
-
-            # Draw a legend
-            plot.draw_legend(legend_entries = legend_entries)
-
-            # Draw an ATLAS stamp
-            label = copy(region.label())
-            if arguments.label:
-                label += arguments.label
-            plot.draw_atlas_label(luminosity,
-                                  sqrt_s,
-                                  custom_label = label,
-                                  atlas_label = arguments.atlas_label)
-
             # Compute the plot output path
             plot_output_path = join(arguments.output,
                                     region_name,
                                     distribution_name)
 
-            # Save plot
-            plot.save(plot_output_path, arguments.extensions)
+            # Skip rendering if the plot's inputs are unchanged
+            digest = plot_digest(data_histogram,
+                                 signal_histograms,
+                                 signal_uncertainty_bands,
+                                 background_histograms,
+                                 background_uncertainty_bands,
+                                 region.label(),
+                                 distribution.x_label(),
+                                 distribution.y_label(),
+                                 luminosity,
+                                 sqrt_s,
+                                 model.get('subtract_background', False),
+                                 arguments.label,
+                                 arguments.atlas_label,
+                                 arguments.error_label,
+                                 arguments.ratio_title,
+                                 arguments.publish)
+            if not arguments.force_render \
+                    and manifest.unchanged(plot_output_path,
+                                           arguments.extensions,
+                                           digest):
+                continue
+
+            # Render the plot, handing it to the render workers if there
+            # are any
+            job = (plot_output_path,
+                   distribution.x_label(),
+                   distribution.y_label(),
+                   region.label(),
+                   settings,
+                   data_histogram,
+                   signal_histograms,
+                   signal_histogram,
+                   signal_uncertainty_bands,
+                   background_histograms,
+                   background_histogram,
+                   background_uncertainty_bands)
+            if render_pool is None:
+                render(job)
+                manifest.record(plot_output_path, digest)
+            else:
+                while len(pending_renders) >= render_queue:
+                    finish_render()
+                pending_renders.append((
+                    plot_output_path,
+                    digest,
+                    render_pool.apply_async(render_serialized,
+                                            serialized(job))
+                ))
+
+# Wait for the remaining plots
+while len(pending_renders) > 0:
+    finish_render()
+if render_pool is not None:
+    render_pool.close()
+    render_pool.join()
+
+# Write the manifest of rendered plots
+manifest.save()